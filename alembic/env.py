@@ -12,6 +12,7 @@ from app.core.config import settings
 from app.models.base import Base
 from app.models.user import User
 from app.models.report import Report
+from app.models.vk_stats import VKAdAccount, VKCampaign, VKCampaignStat
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -0,0 +1,24 @@
+"""add report queue fields
+
+Revision ID: 3f9c1a7d2b64
+Revises: ece4345fd4e9
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c1a7d2b64'
+down_revision = 'ece4345fd4e9'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('reports', sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('reports', sa.Column('task_id', sa.String(), nullable=True))
+
+def downgrade():
+    op.drop_column('reports', 'task_id')
+    op.drop_column('reports', 'attempts')
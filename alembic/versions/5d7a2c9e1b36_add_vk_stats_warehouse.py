@@ -0,0 +1,71 @@
+"""add vk stats warehouse
+
+Revision ID: 5d7a2c9e1b36
+Revises: c41d7e9a0f25
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d7a2c9e1b36'
+down_revision = 'c41d7e9a0f25'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('vk_ad_accounts',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('account_id', sa.BigInteger(), nullable=False),
+        sa.Column('account_type', sa.String(), nullable=True),
+        sa.Column('stats_synced_through', sa.Date(), nullable=True),
+        sa.Column('synced_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'account_id', name='uq_vk_ad_accounts_user_account')
+    )
+    op.create_index(op.f('ix_vk_ad_accounts_id'), 'vk_ad_accounts', ['id'], unique=False)
+    op.create_index(op.f('ix_vk_ad_accounts_user_id'), 'vk_ad_accounts', ['user_id'], unique=False)
+
+    op.create_table('vk_campaigns',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('account_id', sa.BigInteger(), nullable=False),
+        sa.Column('campaign_id', sa.BigInteger(), nullable=False),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('status', sa.Integer(), nullable=True),
+        sa.Column('create_time', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('account_id', 'campaign_id', name='uq_vk_campaigns_account_campaign')
+    )
+    op.create_index(op.f('ix_vk_campaigns_id'), 'vk_campaigns', ['id'], unique=False)
+
+    op.create_table('vk_campaign_stats',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('account_id', sa.BigInteger(), nullable=False),
+        sa.Column('campaign_id', sa.BigInteger(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('impressions', sa.BigInteger(), nullable=True),
+        sa.Column('clicks', sa.BigInteger(), nullable=True),
+        sa.Column('spent', sa.Numeric(14, 2), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('account_id', 'campaign_id', 'date', name='uq_vk_campaign_stats_account_campaign_date')
+    )
+    op.create_index(op.f('ix_vk_campaign_stats_id'), 'vk_campaign_stats', ['id'], unique=False)
+
+def downgrade():
+    op.drop_index(op.f('ix_vk_campaign_stats_id'), table_name='vk_campaign_stats')
+    op.drop_table('vk_campaign_stats')
+    op.drop_index(op.f('ix_vk_campaigns_id'), table_name='vk_campaigns')
+    op.drop_table('vk_campaigns')
+    op.drop_index(op.f('ix_vk_ad_accounts_user_id'), table_name='vk_ad_accounts')
+    op.drop_index(op.f('ix_vk_ad_accounts_id'), table_name='vk_ad_accounts')
+    op.drop_table('vk_ad_accounts')
@@ -0,0 +1,22 @@
+"""add report rows_committed checkpoint
+
+Revision ID: 8b2e5d0c4a17
+Revises: 3f9c1a7d2b64
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e5d0c4a17'
+down_revision = '3f9c1a7d2b64'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('reports', sa.Column('rows_committed', sa.Integer(), nullable=False, server_default='0'))
+
+def downgrade():
+    op.drop_column('reports', 'rows_committed')
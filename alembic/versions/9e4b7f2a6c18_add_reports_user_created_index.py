@@ -0,0 +1,27 @@
+"""add reports (user_id, created_at) index
+
+Revision ID: 9e4b7f2a6c18
+Revises: 5d7a2c9e1b36
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4b7f2a6c18'
+down_revision = '5d7a2c9e1b36'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_index(
+        'ix_reports_user_id_created_at',
+        'reports',
+        ['user_id', sa.text('created_at DESC'), sa.text('id DESC')],
+        unique=False
+    )
+
+def downgrade():
+    op.drop_index('ix_reports_user_id_created_at', table_name='reports')
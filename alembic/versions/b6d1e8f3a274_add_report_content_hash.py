@@ -0,0 +1,24 @@
+"""add report content_hash
+
+Revision ID: b6d1e8f3a274
+Revises: 9e4b7f2a6c18
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d1e8f3a274'
+down_revision = '9e4b7f2a6c18'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('reports', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.create_index('ix_reports_user_id_content_hash', 'reports', ['user_id', 'content_hash'], unique=False)
+
+def downgrade():
+    op.drop_index('ix_reports_user_id_content_hash', table_name='reports')
+    op.drop_column('reports', 'content_hash')
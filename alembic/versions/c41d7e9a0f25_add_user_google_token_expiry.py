@@ -0,0 +1,22 @@
+"""add user google_token_expiry
+
+Revision ID: c41d7e9a0f25
+Revises: 8b2e5d0c4a17
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41d7e9a0f25'
+down_revision = '8b2e5d0c4a17'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('users', sa.Column('google_token_expiry', sa.DateTime(), nullable=True))
+
+def downgrade():
+    op.drop_column('users', 'google_token_expiry')
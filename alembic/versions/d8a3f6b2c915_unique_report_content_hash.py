@@ -0,0 +1,34 @@
+"""unique report content_hash per user
+
+Revision ID: d8a3f6b2c915
+Revises: b6d1e8f3a274
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a3f6b2c915'
+down_revision = 'b6d1e8f3a274'
+branch_labels = None
+depends_on = None
+
+# Отчеты с ошибкой не мешают загрузить тот же файл повторно
+ACTIVE_REPORTS = sa.text("status NOT IN ('error', 'dead_letter')")
+
+def upgrade():
+    op.drop_index('ix_reports_user_id_content_hash', table_name='reports')
+    op.create_index(
+        'ix_reports_user_id_content_hash',
+        'reports',
+        ['user_id', 'content_hash'],
+        unique=True,
+        postgresql_where=ACTIVE_REPORTS,
+        sqlite_where=ACTIVE_REPORTS
+    )
+
+def downgrade():
+    op.drop_index('ix_reports_user_id_content_hash', table_name='reports')
+    op.create_index('ix_reports_user_id_content_hash', 'reports', ['user_id', 'content_hash'], unique=False)
@@ -1,23 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from typing import Optional, Dict, Any
-import hashlib
-import hmac
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, Dict, Any, List
+from datetime import date, datetime, timedelta
 import time
 from fastapi import Request
-from urllib.parse import parse_qs, unquote
 import logging
 from pydantic import BaseModel
-import requests
+import httpx
 import traceback
 
-from app.core.database import get_db
+from app.core.database import get_async_db
 from app.core.config import settings
 from app.models.user import User
-from app.services.auth import create_access_token, verify_telegram_auth, get_current_user
-from app.services.google_sheets import get_google_auth_url, exchange_code_for_tokens, get_user_spreadsheets
-from app.services.vk_ads import get_vk_auth_url, exchange_vk_code_for_tokens, get_vk_ad_campaigns
+from app.models.vk_stats import VKAdAccount
+from app.services.auth import create_access_token, verify_telegram_auth, verify_web_app_init_data, get_current_user, invalidate_user_cache
+from app.services.google_sheets import get_google_auth_url, exchange_code_for_tokens, get_user_spreadsheets, invalidate_user_services, refresh_credentials
+from app.services.vk_ads import get_vk_auth_url, exchange_vk_code_for_tokens
+from app.services.vk_stats_query import GRANULARITY_PERIODS, aggregate_vk_stats
+from app.services.vk_stats_sync import needs_sync, get_local_vk_campaigns, schedule_vk_stats_sync
+from app.services.vk_client import vk_client
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -46,10 +50,61 @@ class GoogleCallbackRequest(BaseModel):
 class VKCallbackRequest(BaseModel):
     code: str
 
+async def get_or_update_telegram_user(db: AsyncSession, telegram_data: Dict[str, Any]) -> User:
+    """
+    Найти или создать пользователя по данным Telegram.
+    Существующий пользователь сохраняется, только если его данные изменились.
+    """
+    telegram_id = str(telegram_data.get("id"))
+    username = telegram_data.get("username", "")
+    first_name = telegram_data.get("first_name", "")
+    last_name = telegram_data.get("last_name", "")
+    
+    user = (await db.execute(select(User).filter(User.telegram_id == telegram_id))).scalars().first()
+    if not user:
+        user = User(
+            telegram_id=telegram_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name
+        )
+        db.add(user)
+        await db.commit()
+        await db.refresh(user)
+        logger.info(f"New user created with ID: {user.id}")
+    elif (user.username != username or
+          user.first_name != first_name or
+          user.last_name != last_name):
+        user.username = username
+        user.first_name = first_name
+        user.last_name = last_name
+        await db.commit()
+        invalidate_user_cache(user.id)
+    return user
+
+def login_response(user: User) -> Dict[str, Any]:
+    """
+    Ответ на успешную авторизацию: JWT токен и профиль пользователя
+    """
+    return {
+        "access_token": create_access_token(data={"sub": str(user.id)}),
+        "token_type": "bearer",
+        "user": {
+            "id": user.id,
+            "telegram_id": user.telegram_id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "email": user.email,
+            "has_google_sheet": bool(user.google_sheet_id),
+            "has_vk_account": bool(getattr(user, 'vk_access_token', None))
+        }
+    }
+
 @router.post("/telegram")
 async def telegram_auth(
     telegram_data: dict,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Авторизация через Telegram
@@ -67,50 +122,8 @@ async def telegram_auth(
         )
     
     try:
-        telegram_id = str(telegram_data.get("id"))
-        username = telegram_data.get("username", "")
-        first_name = telegram_data.get("first_name", "")
-        last_name = telegram_data.get("last_name", "")
-        
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
-        
-        if not user:
-            user = User(
-                telegram_id=telegram_id,
-                username=username,
-                first_name=first_name,
-                last_name=last_name
-            )
-            db.add(user)
-            db.commit()
-            db.refresh(user)
-        else:
-            if (user.username != username or 
-                user.first_name != first_name or 
-                user.last_name != last_name):
-                user.username = username
-                user.first_name = first_name
-                user.last_name = last_name
-                db.commit()
-                db.refresh(user)
-        
-        access_token = create_access_token(data={"sub": str(user.id)})
-        
-        return {
-            "access_token": access_token,
-            "token_type": "bearer",
-            "user": {
-                "id": user.id,
-                "telegram_id": user.telegram_id,
-                "username": user.username,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "email": user.email,
-                "has_google_sheet": bool(user.google_sheet_id),
-                "has_vk_account": bool(getattr(user, 'vk_access_token', None))
-            }
-        }
-        
+        user = await get_or_update_telegram_user(db, telegram_data)
+        return login_response(user)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -128,7 +141,7 @@ def get_google_auth_url_route():
 @router.post("/google/callback")
 async def google_auth_callback(
     data: GoogleCallbackRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """
@@ -140,7 +153,10 @@ async def google_auth_callback(
         # Сохраняем токены для пользователя
         current_user.google_access_token = tokens['access_token']  # type: ignore[assignment]
         current_user.google_refresh_token = tokens['refresh_token']  # type: ignore[assignment]
-        db.commit()
+        current_user.google_token_expiry = tokens.get('expiry')  # type: ignore[assignment]
+        await db.commit()
+        invalidate_user_cache(current_user.id)
+        invalidate_user_services(current_user.id)
         # Создаём новый access_token для пользователя
         access_token = create_access_token(data={"sub": str(current_user.id)})
         return {
@@ -175,7 +191,7 @@ def get_vk_auth_url_route():
 @router.post("/vk/callback")
 async def vk_auth_callback(
     data: VKCallbackRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """
@@ -184,13 +200,14 @@ async def vk_auth_callback(
     try:
         code = data.code
         logger.info(f"VK CALLBACK: code={code}")
-        tokens = exchange_vk_code_for_tokens(code)
+        tokens = await exchange_vk_code_for_tokens(code)
         logger.info(f"VK CALLBACK: tokens={tokens}")
         # Сохраняем токены для пользователя
         current_user.vk_access_token = tokens['access_token']
         current_user.vk_refresh_token = tokens.get('refresh_token', '')
-        db.commit()
-        db.refresh(current_user)
+        await db.commit()
+        invalidate_user_cache(current_user.id)
+        await db.refresh(current_user)
         logger.info(f"VK CALLBACK: user.vk_access_token={current_user.vk_access_token}")
         # Создаём новый access_token для пользователя
         access_token = create_access_token(data={"sub": str(current_user.id)})
@@ -218,7 +235,7 @@ async def vk_auth_callback(
 @router.post("/vk-callback")
 async def vk_callback(
     request: Request,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """
@@ -243,18 +260,19 @@ async def vk_callback(
             'device_id': device_id,
             'code_verifier': code_verifier
         }
-        result = handle_vk_id_callback(callback_params)
+        result = await handle_vk_id_callback(callback_params)
         if not result.get('success'):
             raise HTTPException(status_code=400, detail=result)
         token_data = result['token_data']
         # Сохраняем VK access_token и refresh_token в профиль текущего пользователя
         current_user.vk_access_token = token_data['access_token']
         current_user.vk_refresh_token = token_data.get('refresh_token', '')
-        db.commit()
-        db.refresh(current_user)
+        await db.commit()
+        await db.refresh(current_user)
         setattr(current_user, 'has_vk_account', bool(current_user.vk_access_token))
-        db.commit()
-        db.refresh(current_user)
+        await db.commit()
+        invalidate_user_cache(current_user.id)
+        await db.refresh(current_user)
         access_token = create_access_token(data={"sub": str(current_user.id)})
         return {
             "access_token": access_token,
@@ -274,118 +292,30 @@ async def vk_callback(
         logger.error(f"VK ID callback error: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Ошибка обработки VK ID callback: {e}\n{traceback.format_exc()}")
 
-def validate(hash_str, init_data, token, c_str="WebAppData"):
+@router.post("/web-app/auth/telegram")
+async def auth_telegram(data: Dict[str, Any], db: AsyncSession = Depends(get_async_db)):
     """
-    Validates the data received from the Telegram web app, using the
-    method documented here:
-    https://core.telegram.org/bots/webapps#validating-data-received-via-the-web-app
-
-    hash_str - the has string passed by the webapp
-    init_data - the query string passed by the webapp
-    token - Telegram bot's token
-    c_str - constant string (default = "WebAppData")
+    Авторизация из Telegram Mini App по initData
     """
-
-    init_data = sorted([chunk.split("=")
-                        for chunk in unquote(init_data).split("&")
-                        if chunk[:len("hash=")] != "hash="],
-                       key=lambda x: x[0])
-    init_data = "\n".join([f"{rec[0]}={rec[1]}" for rec in init_data])
-
-    secret_key = hmac.new(c_str.encode(), token.encode(),
-                          hashlib.sha256).digest()
-    data_check = hmac.new(secret_key, init_data.encode(),
-                          hashlib.sha256)
-
-    return data_check.hexdigest() == hash_str
-
-@router.post("/web-app/auth/telegram")
-async def auth_telegram(data: Dict[str, Any], db: Session = Depends(get_db)):
-
-    logger.info(f"Telegram WebApp auth request received: {data}")
     init_data_str = data.get("initData")
-
     if not init_data_str:
         logger.error("initData is missing in request")
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail="initData is missing"
         )
-
+    
+    user_info = verify_web_app_init_data(init_data_str)
+    if user_info is None:
+        logger.warning("Telegram signature validation failed")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Неверная подпись Telegram"
+        )
+    
     try:
-        logger.info(f"Processing initData: {init_data_str[:100]}...")
-        hash_str = init_data_str.split("&hash=")[1]
-        decoded_query = parse_qs(init_data_str)
-        user_info_str = decoded_query['user'][0]
-        
-        logger.info(f"User info string: {user_info_str}")
-        
-        # Парсим JSON из строки user_info
-        import json
-        user_info = json.loads(user_info_str)
-        logger.info(f"Parsed user info: {user_info}")
-        
-        if validate(hash_str, init_data_str, settings.TELEGRAM_BOT_TOKEN):
-            logger.info("Telegram signature validation successful")
-            # Находим или создаем пользователя
-            telegram_id = str(user_info.get("id"))
-            username = user_info.get("username", "")
-            first_name = user_info.get("first_name", "")
-            last_name = user_info.get("last_name", "")
-            
-            logger.info(f"Looking for user with telegram_id: {telegram_id}")
-            user = db.query(User).filter(User.telegram_id == telegram_id).first()
-            
-            if not user:
-                logger.info(f"Creating new user with telegram_id: {telegram_id}")
-                user = User(
-                    telegram_id=telegram_id,
-                    username=username,
-                    first_name=first_name,
-                    last_name=last_name
-                )
-                db.add(user)
-                db.commit()
-                db.refresh(user)
-                logger.info(f"New user created with ID: {user.id}")
-            else:
-                logger.info(f"Found existing user with ID: {user.id}")
-                if (user.username != username or 
-                    user.first_name != first_name or 
-                    user.last_name != last_name):
-                    logger.info("Updating user information")
-                    user.username = username
-                    user.first_name = first_name
-                    user.last_name = last_name
-                    db.commit()
-                    db.refresh(user)
-            
-            access_token = create_access_token(data={"sub": str(user.id)})
-            logger.info(f"Created access token for user {user.id}")
-            
-            response_data = {
-                "access_token": access_token,
-                "token_type": "bearer",
-                "user": {
-                    "id": user.id,
-                    "telegram_id": user.telegram_id,
-                    "username": user.username,
-                    "first_name": user.first_name,
-                    "last_name": user.last_name,
-                    "email": user.email,
-                    "has_google_sheet": bool(user.google_sheet_id),
-                    "has_vk_account": bool(getattr(user, 'vk_access_token', None))
-                }
-            }
-            
-            logger.info(f"Returning response: {response_data}")
-            return response_data
-        else:
-            logger.error("Telegram signature validation failed")
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Неверная подпись Telegram"
-            )
+        user = await get_or_update_telegram_user(db, user_info)
+        return login_response(user)
     except Exception as e:
         logger.error(f"Telegram WebApp auth error: {e}")
         raise HTTPException(
@@ -394,12 +324,17 @@ async def auth_telegram(data: Dict[str, Any], db: Session = Depends(get_db)):
         )
 
 @router.get("/google/spreadsheets")
-async def list_google_spreadsheets(current_user: User = Depends(get_current_user)):
+async def list_google_spreadsheets(
+    search: Optional[str] = None,
+    limit: int = Query(settings.DRIVE_LISTING_LIMIT, ge=1, le=1000),
+    current_user: User = Depends(get_current_user)
+):
     """
-    Получить список Google-таблиц пользователя
+    Получить список Google-таблиц пользователя (поиск по названию, не более limit штук)
     """
     try:
-        spreadsheets = get_user_spreadsheets(current_user)
+        await refresh_credentials(current_user)
+        spreadsheets = await run_in_threadpool(get_user_spreadsheets, current_user, search=search, limit=limit)
         return {"spreadsheets": spreadsheets}
     except Exception as e:
         raise HTTPException(
@@ -420,17 +355,63 @@ async def vk_debug_info():
     }
 
 @router.get("/vk_ads/campaigns")
-async def get_vk_ads_campaigns(current_user: User = Depends(get_current_user)):
+async def get_vk_ads_campaigns(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
-    Получить последние 10 рекламных кампаний VK с нужными полями для текущего пользователя
+    Получить рекламные кампании VK всех аккаунтов текущего пользователя.
+    Данные читаются из локального хранилища статистики; отсутствующие или устаревшие
+    данные загружаются фоновой синхронизацией (sync_pending=true, пока она нужна).
     """
     vk_access_token = getattr(current_user, 'vk_access_token', None)
     if not vk_access_token:
         raise HTTPException(status_code=400, detail="VK аккаунт не привязан")
-    campaigns = get_vk_ad_campaigns(vk_access_token)
-    return {"campaigns": campaigns}
+    
+    accounts_query = select(VKAdAccount).filter(VKAdAccount.user_id == current_user.id)
+    accounts = (await db.execute(accounts_query)).scalars().all()
+    sync_pending = needs_sync(accounts)
+    if sync_pending:
+        # Повторная постановка в очередь отсекается ключом в Redis, пока синхронизация не завершится;
+        # запись в Redis и публикация задачи блокирующие, поэтому идут в пуле потоков
+        await run_in_threadpool(schedule_vk_stats_sync, current_user.id)
+    if not accounts:
+        return {"campaigns": [], "synced_at": None, "sync_pending": sync_pending}
+    
+    synced = [account.synced_at for account in accounts if account.synced_at]
+    return {
+        "campaigns": [record.to_dict() for record in await db.run_sync(get_local_vk_campaigns, current_user.id)],
+        "synced_at": min(synced).isoformat() if synced else None,
+        "sync_pending": sync_pending
+    }
+
+@router.get("/vk_ads/stats")
+async def get_vk_ads_stats(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    granularity: str = "day",
+    campaign_ids: Optional[List[int]] = Query(default=None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Статистика кампаний VK за период с агрегацией по дням, неделям или месяцам.
+    По умолчанию - последние 30 дней по всем кампаниям пользователя.
+    """
+    if granularity not in GRANULARITY_PERIODS:
+        raise HTTPException(status_code=400, detail="Детализация должна быть одной из: day, week, month")
+    
+    date_to = date_to or datetime.utcnow().date()
+    date_from = date_from or date_to - timedelta(days=30)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from не может быть позже date_to")
+    
+    result = await db.run_sync(aggregate_vk_stats, current_user.id, date_from, date_to, granularity, campaign_ids)
+    return {
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "granularity": granularity,
+        **result
+    }
 
-def get_vk_user_info(access_token: str) -> dict:
+async def get_vk_user_info(access_token: str) -> dict:
     """
     Получить информацию о пользователе через VK API
     """
@@ -446,7 +427,7 @@ def get_vk_user_info(access_token: str) -> dict:
     logger.info(f"Getting VK user info. URL: {url}")
     
     try:
-        response = requests.get(url, params=params)
+        response = await vk_client.get(url, params=params)
         logger.info(f"VK user info response status: {response.status_code}")
         logger.info(f"VK user info response: {response.text}")
         
@@ -470,31 +451,33 @@ def get_vk_user_info(access_token: str) -> dict:
             logger.error(f"VK API Error {response.status_code}: {response.text}")
             raise Exception(f"VK API Error {response.status_code}")
             
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"VK user info request failed: {e}")
-        if hasattr(e, 'response') and e.response:
-            logger.error(f"Response text: {e.response.text}")
         raise
 
 @router.post("/vk/unlink")
-async def unlink_vk_account(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def unlink_vk_account(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
     Отвязка VK: очищает токены и флаг VK в профиле пользователя.
     """
     setattr(current_user, 'vk_access_token', '')
     setattr(current_user, 'vk_refresh_token', '')
     setattr(current_user, 'has_vk_account', False)
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
+    invalidate_user_cache(current_user.id)
+    await db.refresh(current_user)
     return {"message": "VK аккаунт отвязан", "has_vk_account": False}
 
 @router.post("/google/unlink")
-async def unlink_google_account(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def unlink_google_account(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """
     Отвязка Google: очищает токены и флаг Google в профиле пользователя.
     """
     setattr(current_user, 'google_access_token', '')
     setattr(current_user, 'google_refresh_token', '')
-    db.commit()
-    db.refresh(current_user)
+    setattr(current_user, 'google_token_expiry', None)
+    await db.commit()
+    invalidate_user_cache(current_user.id)
+    await db.refresh(current_user)
+    invalidate_user_services(current_user.id)
     return {"message": "Google аккаунт отвязан", "has_google_account": False}
\ No newline at end of file
@@ -1,12 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 
-from app.core.database import get_db
+from app.core.database import get_async_db
 from app.models.user import User
-from app.services.auth import get_current_user
-from app.services.google_sheets import get_sheet_info
+from app.services.auth import get_current_user, invalidate_user_cache
+from app.services.google_sheets import get_sheet_info, invalidate_user_services
 from app.api.routes.auth import HTTPBearer401
 
 router = APIRouter()
@@ -19,7 +19,7 @@ class SheetConnectRequest(BaseModel):
 async def connect_google_sheet(
     request: SheetConnectRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Подключить Google таблицу
@@ -30,7 +30,8 @@ async def connect_google_sheet(
         
         # Сохраняем ID таблицы в профиле пользователя
         current_user.google_sheet_id = request.sheet_id
-        db.commit()
+        await db.commit()
+        invalidate_user_cache(current_user.id)
         
         return {
             "message": "Google таблица успешно подключена",
@@ -46,7 +47,7 @@ async def connect_google_sheet(
 @router.get("/info")
 async def get_connected_sheet_info(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Получить информацию о подключенной таблице
@@ -69,7 +70,7 @@ async def get_connected_sheet_info(
 @router.delete("/disconnect", response_model=dict, status_code=200)
 async def disconnect_google_sheet(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Отключить Google-аккаунт и таблицу пользователя.
@@ -89,5 +90,8 @@ async def disconnect_google_sheet(
     setattr(current_user, 'google_sheet_id', '')
     setattr(current_user, 'google_access_token', '')
     setattr(current_user, 'google_refresh_token', '')
-    db.commit()
+    setattr(current_user, 'google_token_expiry', None)
+    await db.commit()
+    invalidate_user_cache(current_user.id)
+    invalidate_user_services(current_user.id)
     return {"success": True, "message": "Google-аккаунт и таблица успешно отключены"} 
\ No newline at end of file
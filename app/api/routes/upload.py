@@ -1,43 +1,133 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from fastapi.routing import APIRoute
 from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+import hashlib
 import os
 import uuid
 from datetime import datetime
+from typing import Callable, Optional, Tuple
 
-from app.core.database import get_db
+from app.core.database import get_async_db
 from app.core.config import settings
 from app.models.user import User
-from app.models.report import Report
+from app.models.report import FAILED_STATUSES, Report
 from app.services.auth import get_current_user
-from app.services.file_processor import process_excel_file
+from app.services.file_processor import ReportStructureError, validate_excel_structure
+from app.services.report_readers import SUPPORTED_EXTENSIONS
+from app.services.report_tasks import enqueue_report
 from app.api.routes.auth import HTTPBearer401
 
-router = APIRouter()
+def _file_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f"Размер файла превышает {settings.MAX_FILE_SIZE // (1024*1024)}MB"
+    )
+
+def _limited_receive(receive: Callable, limit: int) -> Callable:
+    """
+    Обертка receive, прерывающая чтение тела запроса, как только оно превысит limit байт
+    """
+    received = 0
+
+    async def limited():
+        nonlocal received
+        message = await receive()
+        if message['type'] == 'http.request':
+            received += len(message.get('body', b''))
+            if received > limit:
+                raise _file_too_large()
+        return message
+    return limited
+
+class UploadSizeLimitRoute(APIRoute):
+    """
+    Маршрут с ограничением размера тела запроса.
+    Starlette разбирает multipart-форму целиком (с записью файла во временный файл)
+    еще до вызова обработчика и его зависимостей, поэтому ограничение проверяется здесь:
+    по заголовку Content-Length до чтения тела, а для запросов без него - по мере чтения потока.
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def limited_handler(request: Request) -> Response:
+            limit = settings.MAX_FILE_SIZE + settings.UPLOAD_FORM_OVERHEAD
+            content_length = request.headers.get('content-length')
+            if content_length and content_length.isdigit() and int(content_length) > limit:
+                raise _file_too_large()
+            return await handler(Request(request.scope, _limited_receive(request.receive, limit)))
+        return limited_handler
+
+router = APIRouter(route_class=UploadSizeLimitRoute)
 security = HTTPBearer401()
 
+async def find_active_report(db: AsyncSession, user_id: int, content_hash: str) -> Optional[Report]:
+    """
+    Отчет пользователя с тем же содержимым, кроме завершившихся ошибкой
+    """
+    return (await db.execute(select(Report).filter(
+        Report.user_id == user_id,
+        Report.content_hash == content_hash,
+        Report.status.notin_(FAILED_STATUSES)
+    ))).scalars().first()
+
+def _duplicate_response(report: Report, filename: str) -> dict:
+    return {
+        "message": "Этот файл уже загружен",
+        "report_id": report.id,
+        "filename": filename,
+        "status": report.status,
+        "duplicate": True
+    }
+
+async def save_upload(file: UploadFile, file_path: str) -> Tuple[int, str]:
+    """
+    Переписать загруженный файл из временного файла Starlette в UPLOAD_DIR блоками
+    по UPLOAD_CHUNK_SIZE, считая размер и SHA-256. Запись идет в пуле потоков.
+    Размер тела запроса уже ограничен UploadSizeLimitRoute (с запасом на служебные части формы),
+    здесь проверяется точный размер файла: при превышении MAX_FILE_SIZE файл удаляется.
+    Возвращает размер файла и хеш содержимого.
+    """
+    digest = hashlib.sha256()
+    file_size = 0
+    buffer = await run_in_threadpool(open, file_path, "wb")
+    try:
+        while chunk := await file.read(settings.UPLOAD_CHUNK_SIZE):
+            file_size += len(chunk)
+            if file_size > settings.MAX_FILE_SIZE:
+                raise _file_too_large()
+            digest.update(chunk)
+            await run_in_threadpool(buffer.write, chunk)
+    except BaseException:
+        await run_in_threadpool(buffer.close)
+        await run_in_threadpool(os.remove, file_path)
+        raise
+    await run_in_threadpool(buffer.close)
+    return file_size, digest.hexdigest()
+
 @router.post("/report")
 async def upload_report(
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
-    Загрузить отчет в формате XLSX
+    Загрузить отчет в формате XLSX, XLS, CSV, TSV или Parquet
     """
     # Проверяем тип файла
-    if not file.filename.endswith(('.xlsx', '.xls')):
+    if not file.filename.lower().endswith(SUPPORTED_EXTENSIONS):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Поддерживаются только файлы Excel (.xlsx, .xls)"
+            detail="Поддерживаются только файлы Excel (.xlsx, .xls), CSV (.csv, .tsv) и Parquet (.parquet)"
         )
     
-    # Проверяем размер файла
-    if file.size > settings.MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Размер файла превышает {settings.MAX_FILE_SIZE // (1024*1024)}MB"
-        )
+    # Проверяем размер файла из разобранной формы (тело запроса уже ограничено маршрутом)
+    if file.size is not None and file.size > settings.MAX_FILE_SIZE:
+        raise _file_too_large()
     
     try:
         # Генерируем уникальное имя файла
@@ -45,10 +135,24 @@ async def upload_report(
         unique_filename = f"{uuid.uuid4()}{file_extension}"
         file_path = os.path.join(settings.UPLOAD_DIR, unique_filename)
         
-        # Сохраняем файл
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        # Сохраняем файл, считая размер и хеш содержимого по мере чтения потока
+        file_size, content_hash = await save_upload(file, file_path)
+        
+        # Тот же файл уже загружен: возвращаем существующий отчет без повторной обработки
+        existing = await find_active_report(db, current_user.id, content_hash)
+        if existing:
+            await run_in_threadpool(os.remove, file_path)
+            return _duplicate_response(existing, file.filename)
+        
+        # Проверяем заголовок файла сразу, чтобы не ставить в очередь заведомо негодный отчет
+        try:
+            await run_in_threadpool(validate_excel_structure, file_path)
+        except ReportStructureError as e:
+            await run_in_threadpool(os.remove, file_path)
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
         
         # Создаем запись в базе данных
         report = Report(
@@ -56,15 +160,32 @@ async def upload_report(
             filename=unique_filename,
             original_filename=file.filename,
             file_path=file_path,
-            file_size=len(content),
+            file_size=file_size,
+            content_hash=content_hash,
             status="uploaded"
         )
         db.add(report)
-        db.commit()
-        db.refresh(report)
+        try:
+            await db.commit()
+        except IntegrityError:
+            # Тот же файл параллельно загружен другим запросом: уникальный индекс не дал создать дубликат
+            await db.rollback()
+            await run_in_threadpool(os.remove, file_path)
+            # После отката объекты сессии сброшены, id пользователя берем из несохраненного отчета
+            existing = await find_active_report(db, report.user_id, content_hash)
+            if existing is None:
+                raise
+            return _duplicate_response(existing, file.filename)
+        await db.refresh(report)
         
-        # Запускаем обработку файла в фоновом режиме
-        await process_excel_file(report.id, file_path, current_user)
+        # Ставим обработку файла в очередь фоновых задач
+        try:
+            await enqueue_report(report, db)
+        except Exception:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Очередь обработки недоступна, попробуйте позже"
+            )
         
         return {
             "message": "Файл успешно загружен",
@@ -73,6 +194,8 @@ async def upload_report(
             "status": report.status
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -83,15 +206,15 @@ async def upload_report(
 async def get_report_status(
     report_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Получить статус обработки отчета
     """
-    report = db.query(Report).filter(
+    report = (await db.execute(select(Report).filter(
         Report.id == report_id,
         Report.user_id == current_user.id
-    ).first()
+    ))).scalars().first()
     
     if not report:
         raise HTTPException(
@@ -103,6 +226,7 @@ async def get_report_status(
         "id": report.id,
         "filename": report.original_filename,
         "status": report.status,
+        "attempts": report.attempts,
         "created_at": report.created_at,
         "error_message": report.error_message
     } 
\ No newline at end of file
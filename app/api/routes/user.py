@@ -1,13 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import base64
+import json
+from datetime import date, datetime, time, timedelta
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional, Tuple
 from pydantic import BaseModel
 
-from app.core.database import get_db
+from app.core.config import settings
+from app.core.database import get_async_db
 from app.models.user import User
 from app.models.report import Report
-from app.services.auth import get_current_user
+from app.services.auth import get_current_user, invalidate_user_cache
 from app.api.routes.auth import HTTPBearer401
 
 router = APIRouter()
@@ -19,7 +24,7 @@ class UserProfileUpdate(BaseModel):
 @router.get("/profile")
 async def get_user_profile(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Получить профиль пользователя
@@ -42,7 +47,7 @@ async def get_user_profile(
 async def update_user_profile(
     profile_data: UserProfileUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Обновить профиль пользователя
@@ -50,8 +55,9 @@ async def update_user_profile(
     if profile_data.email:
         current_user.email = profile_data.email
     
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
+    invalidate_user_cache(current_user.id)
+    await db.refresh(current_user)
     
     return {
         "message": "Профиль обновлен",
@@ -61,15 +67,58 @@ async def update_user_profile(
         }
     }
 
+def _encode_cursor(report: Report) -> str:
+    """
+    Курсор следующей страницы: позиция последнего отчета в порядке (created_at, id)
+    """
+    payload = json.dumps([report.created_at.isoformat(), report.id])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, report_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(report_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор")
+
 @router.get("/reports")
 async def get_user_reports(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=settings.REPORTS_PAGE_SIZE_MAX),
+    report_status: Optional[List[str]] = Query(None, alias="status"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
-    Получить список отчетов пользователя
+    Получить отчеты пользователя, от новых к старым.
+    Без limit и cursor возвращается весь список, как раньше. С limit или cursor
+    отдается страница (по умолчанию REPORTS_PAGE_SIZE отчетов), курсор следующей
+    страницы возвращается в заголовке X-Next-Cursor.
     """
-    reports = db.query(Report).filter(Report.user_id == current_user.id).all()
+    query = select(Report).filter(Report.user_id == current_user.id)
+    if report_status:
+        query = query.filter(Report.status.in_(report_status))
+    if date_from:
+        query = query.filter(Report.created_at >= datetime.combine(date_from, time.min))
+    if date_to:
+        query = query.filter(Report.created_at < datetime.combine(date_to + timedelta(days=1), time.min))
+    if cursor:
+        # Keyset-пагинация: страница начинается сразу за последним отчетом предыдущей
+        query = query.filter(tuple_(Report.created_at, Report.id) < tuple_(*_decode_cursor(cursor)))
+
+    query = query.order_by(Report.created_at.desc(), Report.id.desc())
+    if limit is None and cursor:
+        limit = settings.REPORTS_PAGE_SIZE
+    if limit is not None:
+        # Лишняя строка показывает, есть ли следующая страница
+        query = query.limit(limit + 1)
+    reports = (await db.execute(query)).scalars().all()
+    if limit is not None and len(reports) > limit:
+        reports = reports[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(reports[-1])
     
     return [
         {
@@ -81,4 +130,4 @@ async def get_user_reports(
             "error_message": report.error_message
         }
         for report in reports
-    ] 
\ No newline at end of file
+    ]
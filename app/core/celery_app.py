@@ -0,0 +1,28 @@
+from celery import Celery
+
+from app.core.config import settings
+
+# Приложение Celery для фоновой обработки отчетов и синхронизации статистики VK.
+# Запуск воркера: celery -A app.core.celery_app worker -Q reports --loglevel=info
+# Периодические задачи: celery -A app.core.celery_app beat --loglevel=info
+celery_app = Celery(
+    "adstat",
+    broker=settings.CELERY_BROKER_URL or settings.REDIS_URL,
+    include=["app.services.report_tasks", "app.services.vk_stats_sync"]
+)
+
+celery_app.conf.update(
+    task_default_queue="reports",
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    task_ignore_result=True,
+    worker_prefetch_multiplier=1,
+    task_always_eager=settings.CELERY_TASK_ALWAYS_EAGER,
+    broker_connection_retry_on_startup=True,
+    beat_schedule={
+        "vk-stats-sync": {
+            "task": "vk.sync_all_stats",
+            "schedule": settings.VK_STATS_SYNC_INTERVAL
+        }
+    }
+)
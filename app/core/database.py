@@ -1,18 +1,112 @@
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from app.core.config import settings
+from app.core.metrics import DB_POOL_CHECKOUT_WAIT
+from app.core.timing import record_span
 
-# Создаем движок базы данных
+# Асинхронные драйверы для API: синхронный URL из настроек переводится на них автоматически
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite'
+}
+
+def get_async_database_url(database_url: str) -> str:
+    """
+    URL базы данных для асинхронного движка
+    """
+    url = make_url(database_url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername)).render_as_string(hide_password=False)
+
+class _TimedCheckoutMixin:
+    """Замер ожидания свободного соединения при выдаче его из пула"""
+    metrics_engine = ''
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.labels(self.metrics_engine).observe(time.perf_counter() - started)
+
+class TimedQueuePool(_TimedCheckoutMixin, QueuePool):
+    metrics_engine = 'sync'
+
+class TimedAsyncQueuePool(_TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    metrics_engine = 'async'
+
+def _engine_options(async_driver: bool) -> dict:
+    """
+    Параметры пула и таймаут запросов из настроек (для SQLite пул не настраивается).
+    Синхронному движку нужно немного соединений, его пул настраивается отдельно.
+    """
+    if settings.DATABASE_URL.startswith('sqlite'):
+        return {}
+
+    options = {
+        'poolclass': TimedAsyncQueuePool if async_driver else TimedQueuePool,
+        'pool_size': settings.DB_POOL_SIZE if async_driver else settings.DB_SYNC_POOL_SIZE,
+        'max_overflow': settings.DB_MAX_OVERFLOW if async_driver else settings.DB_SYNC_MAX_OVERFLOW,
+        'pool_timeout': settings.DB_POOL_TIMEOUT,
+        'pool_recycle': settings.DB_POOL_RECYCLE
+    }
+    if settings.DB_STATEMENT_TIMEOUT_MS:
+        timeout = str(settings.DB_STATEMENT_TIMEOUT_MS)
+        if async_driver:
+            options['connect_args'] = {'server_settings': {'statement_timeout': timeout}}
+        else:
+            options['connect_args'] = {'options': f'-c statement_timeout={timeout}'}
+    return options
+
+# Создаем движок базы данных (фоновые задачи Celery, миграции)
 engine = create_engine(
     settings.DATABASE_URL,
     pool_pre_ping=True,
-    echo=False
+    echo=False,
+    **_engine_options(async_driver=False)
 )
 
 # Создаем фабрику сессий
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронный движок для API: запросы к базе не блокируют цикл событий
+async_engine = create_async_engine(
+    get_async_database_url(settings.DATABASE_URL),
+    pool_pre_ping=True,
+    echo=False,
+    **_engine_options(async_driver=True)
+)
+
+def _track_query_time(sync_engine) -> None:
+    """
+    Время SQL-запросов попадает в разбивку текущего HTTP запроса (фаза db)
+    """
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def _query_started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def _query_finished(conn, cursor, statement, parameters, context, executemany):
+        record_span('db', time.perf_counter() - conn.info['query_started'].pop())
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def _query_failed(exception_context):
+        started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+        if started:
+            record_span('db', time.perf_counter() - started.pop())
+
+_track_query_time(engine)
+_track_query_time(async_engine.sync_engine)
+
+# После commit объекты не сбрасываются: ленивая загрузка в асинхронной сессии невозможна
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 # Базовый класс для моделей
 Base = declarative_base()
 
@@ -22,4 +116,9 @@ def get_db():
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+# Асинхронная сессия для роутов API
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
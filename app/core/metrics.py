@@ -0,0 +1,106 @@
+import os
+from typing import Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Границы корзин для внешних вызовов и стадий обработки: от миллисекунд до минут
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HTTP_REQUEST_DURATION = Histogram(
+    'adstat_http_request_duration_seconds',
+    'Время обработки HTTP запроса',
+    ['method', 'route', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    'adstat_db_pool_checkout_wait_seconds',
+    'Ожидание соединения из пула базы данных',
+    ['engine'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+)
+
+EXTERNAL_CALL_DURATION = Histogram(
+    'adstat_external_call_duration_seconds',
+    'Время вызова внешнего API (VK, Google)',
+    ['service', 'method'],
+    buckets=LATENCY_BUCKETS
+)
+
+EXTERNAL_CALL_ERRORS = Counter(
+    'adstat_external_call_errors_total',
+    'Ошибки вызовов внешнего API',
+    ['service', 'method', 'reason']
+)
+
+REPORT_STAGE_DURATION = Histogram(
+    'adstat_report_stage_duration_seconds',
+    'Время стадий обработки отчета',
+    ['stage'],
+    buckets=LATENCY_BUCKETS + (120, 300, 600)
+)
+
+REPORT_ROWS = Counter(
+    'adstat_report_rows_total',
+    'Строк отчетов, записанных в Google Sheets'
+)
+
+REPORT_ROWS_PER_SECOND = Histogram(
+    'adstat_report_rows_per_second',
+    'Скорость обработки отчета (строк в секунду)',
+    buckets=(10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+)
+
+def observe_external_call(service: str, method: str, seconds: float, error: Optional[str] = None) -> None:
+    """
+    Учесть вызов внешнего API: длительность и, при ошибке, ее причину
+    """
+    EXTERNAL_CALL_DURATION.labels(service, method).observe(seconds)
+    if error:
+        EXTERNAL_CALL_ERRORS.labels(service, method, error).inc()
+
+class VKSchedulerCollector:
+    """
+    Метрики планировщика квот VK, снимаемые в момент сбора
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def collect(self):
+        snapshot = self.limiter.snapshot()
+        yield GaugeMetricFamily('adstat_vk_scheduler_queue_depth', 'Запросов VK в ожидании квоты', value=snapshot['queue_depth'])
+        yield GaugeMetricFamily('adstat_vk_scheduler_buckets', 'Активных корзин токенов VK', value=snapshot['buckets'])
+        yield CounterMetricFamily(
+            'adstat_vk_scheduler_waited_seconds', 'Суммарное ожидание квоты VK', value=snapshot['waited_seconds_total']
+        )
+        throttled = CounterMetricFamily('adstat_vk_scheduler_throttled', 'Ответов VK о превышении лимита', labels=['method_class'])
+        for method_class, count in snapshot['throttled_total'].items():
+            throttled.add_metric([method_class], count)
+        yield throttled
+
+_process_collectors = []
+
+def register_process_collector(collector) -> None:
+    """
+    Зарегистрировать сборщик состояния текущего процесса
+    """
+    _process_collectors.append(collector)
+    REGISTRY.register(collector)
+
+def render_metrics() -> Tuple[bytes, str]:
+    """
+    Метрики в текстовом формате Prometheus.
+    Если задан PROMETHEUS_MULTIPROC_DIR, счетчики собираются со всех процессов
+    (воркеры uvicorn и Celery), а не только с текущего.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        for collector in _process_collectors:
+            registry.register(collector)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
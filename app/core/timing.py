@@ -0,0 +1,142 @@
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.config import settings
+from app.core.metrics import HTTP_REQUEST_DURATION
+
+logger = logging.getLogger(__name__)
+
+# Фазы текущего запроса: (название, длительность в секундах).
+# Вне запроса (воркер Celery, миграции) список не задан и замеры ничего не стоят.
+_request_spans: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar('request_spans', default=None)
+
+# Открытая фаза span(): сколько секунд заняли вложенные в нее фазы
+_open_span: ContextVar[Optional[List[float]]] = ContextVar('open_span', default=None)
+
+def start_request_timing() -> List[Tuple[str, float]]:
+    """
+    Начать сбор фаз для текущего запроса
+    """
+    spans = []
+    _request_spans.set(spans)
+    return spans
+
+def _add_to_open_span(seconds: float) -> None:
+    parent = _open_span.get()
+    if parent is not None:
+        parent[0] += seconds
+
+def record_span(name: str, seconds: float) -> None:
+    """
+    Добавить длительность фазы к текущему запросу (вне запроса игнорируется)
+    """
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+        _add_to_open_span(seconds)
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Замерить фазу обработки запроса: with span('db'): ...
+    В фазу записывается только собственное время: вложенные фазы (например, запросы db
+    внутри user) из нее вычитаются, и сумма фаз не превышает времени запроса.
+    """
+    nested = [0.0]
+    token = _open_span.set(nested)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _open_span.reset(token)
+        spans = _request_spans.get()
+        if spans is not None:
+            # Параллельные вложенные фазы могут в сумме превысить длительность внешней
+            spans.append((name, max(elapsed - nested[0], 0.0)))
+            _add_to_open_span(elapsed)
+
+def summarize_spans(spans: List[Tuple[str, float]]) -> Dict[str, Dict[str, float]]:
+    """
+    Сложить повторяющиеся фазы: название -> суммарная длительность (мс) и число замеров
+    """
+    summary: Dict[str, Dict[str, float]] = defaultdict(lambda: {'ms': 0.0, 'count': 0})
+    for name, seconds in spans:
+        summary[name]['ms'] += seconds * 1000
+        summary[name]['count'] += 1
+    return {name: {'ms': round(item['ms'], 2), 'count': item['count']} for name, item in summary.items()}
+
+def server_timing_header(summary: Dict[str, Dict[str, float]], total_ms: float) -> str:
+    """
+    Значение заголовка Server-Timing, например: db;dur=3.1;desc="x2", total;dur=12.4
+    (desc указывается для фаз, замеренных несколько раз; фазы не пересекаются)
+    """
+    parts = [
+        f'{name};dur={item["ms"]}' + (f';desc="x{item["count"]}"' if item["count"] > 1 else '')
+        for name, item in summary.items()
+    ]
+    parts.append(f'total;dur={round(total_ms, 2)}')
+    return ', '.join(parts)
+
+class TimedJSONResponse(JSONResponse):
+    """JSON-ответ, время сериализации которого попадает в разбивку запроса"""
+
+    def render(self, content) -> bytes:
+        with span('serialize'):
+            return super().render(content)
+
+class RequestTimingMiddleware:
+    """
+    ASGI middleware времени запросов: гистограмма по шаблону маршрута (а не по фактическому
+    пути), разбивка по фазам (jwt, user, db, vk, google, serialize) в заголовке Server-Timing
+    и, если включено, в логе. Заголовок добавляется в начало ответа через обертку send.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        spans = start_request_timing()
+        status_code = 500
+
+        async def send_with_timing(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                total_ms = (time.perf_counter() - started) * 1000
+                summary = summarize_spans(spans)
+                MutableHeaders(scope=message).append('Server-Timing', server_timing_header(summary, total_ms))
+                if settings.REQUEST_TIMING_LOG and total_ms >= settings.REQUEST_TIMING_LOG_MIN_MS:
+                    logger.info(json.dumps({
+                        "event": "request_timing",
+                        "method": scope['method'],
+                        "path": scope['path'],
+                        "status": status_code,
+                        "total_ms": round(total_ms, 2),
+                        "spans": summary
+                    }, ensure_ascii=False))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            route = scope.get('route')
+            HTTP_REQUEST_DURATION.labels(
+                scope['method'],
+                getattr(route, 'path', 'unmatched'),
+                str(status_code)
+            ).observe(time.perf_counter() - started)
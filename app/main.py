@@ -1,13 +1,17 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 import os
 
 from app.core.config import settings
 from app.api.routes import auth, user, sheets, upload
-from app.core.database import engine
+from app.core.database import engine, async_engine
+from app.core.metrics import VKSchedulerCollector, register_process_collector, render_metrics
+from app.core.timing import RequestTimingMiddleware, TimedJSONResponse
 from app.models import base
+from app.services.vk_client import vk_client
+from app.services.vk_rate_limiter import vk_rate_limiter
 
 # Создаем таблицы в базе данных только если не в тестовом режиме
 if not os.getenv("TESTING"):
@@ -16,7 +20,8 @@ if not os.getenv("TESTING"):
 app = FastAPI(
     title="Ads Statistics Dashboard",
     description="Личный кабинет для управления рекламными отчетами",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=TimedJSONResponse
 )
 
 # Настройка CORS
@@ -32,12 +37,27 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
+register_process_collector(VKSchedulerCollector(vk_rate_limiter))
+
+# Время запросов: метрики Prometheus и заголовок Server-Timing
+app.add_middleware(RequestTimingMiddleware)
+
 # Подключаем роуты с префиксом /api
 app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(user.router, prefix="/api/user", tags=["user"])
 app.include_router(sheets.router, prefix="/api/sheets", tags=["sheets"])
 app.include_router(upload.router, prefix="/api/upload", tags=["upload"])
 
+@app.on_event("shutdown")
+async def close_http_clients():
+    """Закрываем пулы HTTP соединений при остановке приложения"""
+    await vk_client.aclose()
+
+@app.on_event("shutdown")
+async def close_database():
+    """Закрываем пул соединений асинхронного движка"""
+    await async_engine.dispose()
+
 # Подключаем статические файлы для фронтенда
 if os.path.exists("frontend/dist"):
     app.mount("/static", StaticFiles(directory="frontend/dist"), name="static")
@@ -63,7 +83,17 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Проверка здоровья приложения"""
-    return {"status": "healthy", "message": "Ads Statistics Dashboard is running"}
+    return {
+        "status": "healthy",
+        "message": "Ads Statistics Dashboard is running",
+        "vk_scheduler": vk_rate_limiter.snapshot()
+    }
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Метрики приложения в формате Prometheus"""
+    payload, content_type = render_metrics()
+    return Response(content=payload, media_type=content_type)
 
 @app.get("/cors-test")
 async def cors_test(request: Request):
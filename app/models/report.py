@@ -1,7 +1,10 @@
-from sqlalchemy import Column, String, Text, ForeignKey, Integer
+from sqlalchemy import Column, String, Text, ForeignKey, Integer, Index
 from sqlalchemy.orm import relationship
 from app.models.base import BaseModel
 
+# Отчеты с этими статусами при повторной загрузке того же файла обрабатываются заново
+FAILED_STATUSES = ('error', 'dead_letter')
+
 class Report(BaseModel):
     """Модель отчета"""
     __tablename__ = "reports"
@@ -11,11 +14,27 @@ class Report(BaseModel):
     original_filename = Column(String, nullable=False)
     file_path = Column(String, nullable=False)
     file_size = Column(Integer, nullable=False)
-    status = Column(String, default="uploaded")  # uploaded, processing, completed, error
+    status = Column(String, default="uploaded")  # uploaded, queued, processing, retrying, completed, error, dead_letter
     error_message = Column(Text)
+    attempts = Column(Integer, default=0)  # количество попыток обработки воркером
+    task_id = Column(String)  # идентификатор задачи Celery
+    rows_committed = Column(Integer, default=0)  # чекпоинт: сколько строк уже записано в Google Sheets
+    content_hash = Column(String(64))  # SHA-256 содержимого файла для поиска повторных загрузок
     
     # Связи
     user = relationship("User", back_populates="reports")
     
     def __repr__(self):
-        return f"<Report(id={self.id}, filename={self.filename}, status={self.status})>" 
\ No newline at end of file
+        return f"<Report(id={self.id}, filename={self.filename}, status={self.status})>"
+
+# Индекс для постраничной истории отчетов: выборка страницы идет по индексу без сортировки
+Index("ix_reports_user_id_created_at", Report.user_id, Report.created_at.desc(), Report.id.desc())
+# Один активный отчет на файл пользователя: повторная загрузка не создает дубликат даже при гонке
+Index(
+    "ix_reports_user_id_content_hash",
+    Report.user_id,
+    Report.content_hash,
+    unique=True,
+    postgresql_where=Report.status.notin_(FAILED_STATUSES),
+    sqlite_where=Report.status.notin_(FAILED_STATUSES)
+)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean, Text
+from sqlalchemy import Column, String, Boolean, Text, DateTime
 from sqlalchemy.orm import relationship
 from app.models.base import BaseModel
 
@@ -16,6 +16,7 @@ class User(BaseModel):
     # Google интеграция
     google_access_token = Column(Text)
     google_refresh_token = Column(Text)
+    google_token_expiry = Column(DateTime)  # срок действия access token (UTC)
     google_sheet_id = Column(String)
     has_google_account = Column(Boolean, default=False)
     has_google_sheet = Column(Boolean, default=False)
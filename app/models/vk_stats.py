@@ -0,0 +1,51 @@
+from sqlalchemy import Column, String, ForeignKey, Integer, BigInteger, Date, DateTime, Numeric, UniqueConstraint
+from app.models.base import BaseModel
+
+class VKAdAccount(BaseModel):
+    """Рекламный аккаунт VK, доступный пользователю, и состояние синхронизации его статистики"""
+    __tablename__ = "vk_ad_accounts"
+    __table_args__ = (
+        UniqueConstraint("user_id", "account_id", name="uq_vk_ad_accounts_user_account"),
+    )
+
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    account_id = Column(BigInteger, nullable=False)
+    account_type = Column(String)
+    stats_synced_through = Column(Date)  # водяной знак: статистика загружена по эту дату включительно
+    synced_at = Column(DateTime)  # время последней успешной синхронизации (UTC)
+
+    def __repr__(self):
+        return f"<VKAdAccount(user_id={self.user_id}, account_id={self.account_id})>"
+
+class VKCampaign(BaseModel):
+    """Рекламная кампания VK"""
+    __tablename__ = "vk_campaigns"
+    __table_args__ = (
+        UniqueConstraint("account_id", "campaign_id", name="uq_vk_campaigns_account_campaign"),
+    )
+
+    account_id = Column(BigInteger, nullable=False)
+    campaign_id = Column(BigInteger, nullable=False)
+    name = Column(String)
+    status = Column(Integer)
+    create_time = Column(String)
+
+    def __repr__(self):
+        return f"<VKCampaign(account_id={self.account_id}, campaign_id={self.campaign_id}, name={self.name})>"
+
+class VKCampaignStat(BaseModel):
+    """Дневная статистика рекламной кампании VK"""
+    __tablename__ = "vk_campaign_stats"
+    __table_args__ = (
+        UniqueConstraint("account_id", "campaign_id", "date", name="uq_vk_campaign_stats_account_campaign_date"),
+    )
+
+    account_id = Column(BigInteger, nullable=False)
+    campaign_id = Column(BigInteger, nullable=False)
+    date = Column(Date, nullable=False)
+    impressions = Column(BigInteger, default=0)
+    clicks = Column(BigInteger, default=0)
+    spent = Column(Numeric(14, 2), default=0)
+
+    def __repr__(self):
+        return f"<VKCampaignStat(campaign_id={self.campaign_id}, date={self.date})>"
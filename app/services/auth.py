@@ -3,15 +3,32 @@ from typing import Optional
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 import hashlib
 import hmac
+import json
 import time
+from functools import lru_cache
+from urllib.parse import parse_qsl
 
+from app.core.cache import TTLCache
 from app.core.config import settings
-from app.core.database import get_db
+from app.core.database import get_async_db
+from app.core.timing import span
 from app.models.user import User
 
+# Снимки строк пользователей для get_current_user: user_id -> значения колонок.
+# Кеш локален для процесса; роуты, меняющие профиль или привязки, вызывают invalidate_user_cache.
+# Изменения из других процессов (например, токен Google, обновленный воркером) видны через USER_CACHE_TTL
+_user_cache = TTLCache(maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL)
+_user_columns = [column.key for column in User.__table__.columns]
+
+# Недавно проверенные initData Telegram WebApp: hash -> (initData, данные пользователя).
+# Запись живет, пока не истечет срок действия initData по auth_date
+_init_data_cache = TTLCache(maxsize=settings.TELEGRAM_INIT_DATA_CACHE_SIZE, ttl=settings.TELEGRAM_INIT_DATA_MAX_AGE)
+
 class HTTPBearer401(HTTPBearer):
     async def __call__(self, request: Request) -> HTTPAuthorizationCredentials:
         try:
@@ -45,7 +62,8 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 def verify_token(token: str):
     """Проверить JWT токен"""
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        with span('jwt'):
+            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         user_id_raw = payload.get("sub")
         if user_id_raw is None:
             return None
@@ -108,12 +126,8 @@ def verify_telegram_auth(telegram_data: dict) -> bool:
     
     # Правильная реализация проверки подписи Telegram
     try:
-        # Шаг 1: Создаем HMAC-SHA256 от токена бота с ключом "WebAppData"
-        secret_key = hmac.new(
-            "WebAppData".encode('utf-8'),
-            settings.TELEGRAM_BOT_TOKEN.encode('utf-8'),
-            hashlib.sha256
-        ).digest()
+        # Шаг 1: HMAC-SHA256 от токена бота с ключом "WebAppData" (вычисляется один раз)
+        secret_key = web_app_secret_key(settings.TELEGRAM_BOT_TOKEN)
         
         # Шаг 2: Создаем HMAC-SHA256 от строки данных с секретным ключом
         computed_hash = hmac.new(
@@ -127,20 +141,104 @@ def verify_telegram_auth(telegram_data: dict) -> bool:
     except Exception as e:
         return False
 
-def get_current_user(
+@lru_cache(maxsize=4)
+def web_app_secret_key(bot_token: str) -> bytes:
+    """
+    Секретный ключ проверки данных Telegram WebApp: HMAC-SHA256 токена бота с ключом "WebAppData"
+    """
+    return hmac.new(b"WebAppData", bot_token.encode('utf-8'), hashlib.sha256).digest()
+
+def verify_web_app_init_data(init_data: str) -> Optional[dict]:
+    """
+    Проверить initData Telegram WebApp и вернуть данные пользователя.
+    https://core.telegram.org/bots/webapps#validating-data-received-via-the-web-app
+    Возвращает None, если подпись неверна или срок действия initData истек.
+    Проверенные initData кешируются до истечения срока, повторное открытие
+    Mini App не требует разбора и проверки подписи.
+    """
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop('hash', '')
+    if not received_hash:
+        return None
+    
+    cached = _init_data_cache.get(received_hash)
+    if cached is not None and cached[0] == init_data:
+        return cached[1]
+    
+    try:
+        auth_date = int(fields.get('auth_date', 0))
+    except ValueError:
+        return None
+    ttl = auth_date + settings.TELEGRAM_INIT_DATA_MAX_AGE - time.time()
+    if ttl <= 0:
+        return None
+    
+    data_check_string = '\n'.join(f"{key}={value}" for key, value in sorted(fields.items()))
+    computed_hash = hmac.new(
+        web_app_secret_key(settings.TELEGRAM_BOT_TOKEN),
+        data_check_string.encode('utf-8'),
+        hashlib.sha256
+    ).hexdigest()
+    if not hmac.compare_digest(computed_hash, received_hash):
+        return None
+    
+    try:
+        user_info = json.loads(fields['user'])
+    except (KeyError, ValueError):
+        return None
+    _init_data_cache.set(received_hash, (init_data, user_info), ttl=ttl)
+    return user_info
+
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> User:
     token = credentials.credentials
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        with span('jwt'):
+            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         user_id_raw = payload.get("sub")
         if user_id_raw is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Не авторизован")
         user_id = int(str(user_id_raw))
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Не авторизован")
-    user = db.query(User).filter(User.id == user_id).first()
+    with span('user'):
+        user = await _load_user(db, user_id)
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Не авторизован")
-    return user 
\ No newline at end of file
+    return user
+
+async def _load_user(db: AsyncSession, user_id: int) -> Optional[User]:
+    """
+    Получить пользователя из кеша процесса или из базы.
+    Из кеша пользователь присоединяется к сессии без запроса к базе,
+    поэтому роуты могут изменять и сохранять его как обычно.
+    """
+    # Пользователь уже загружен в этой сессии
+    user = db.sync_session.identity_map.get(db.identity_key(User, user_id))
+    if user is not None:
+        return user
+    
+    snapshot = _user_cache.get(user_id)
+    if snapshot is not None:
+        cached = User(**snapshot)
+        make_transient_to_detached(cached)
+        return await db.merge(cached, load=False)
+    
+    user = (await db.execute(select(User).filter(User.id == user_id))).scalars().first()
+    if user is not None:
+        _user_cache.set(user_id, {key: getattr(user, key) for key in _user_columns})
+    return user
+
+def invalidate_user_cache(user_id: int) -> None:
+    """
+    Сбросить кешированного пользователя (после изменения профиля, Google или VK привязки)
+    """
+    _user_cache.pop(user_id)
+
+def clear_user_cache() -> None:
+    """
+    Очистить кеш пользователей
+    """
+    _user_cache.clear() 
\ No newline at end of file
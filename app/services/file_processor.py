@@ -1,110 +1,191 @@
-import pandas as pd
 import asyncio
+import difflib
+import time
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Union
 
-from app.core.database import SessionLocal
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import REPORT_ROWS, REPORT_ROWS_PER_SECOND, REPORT_STAGE_DURATION
 from app.models.report import Report
 from app.models.user import User
 from app.services.google_sheets import append_data_to_sheet
+from app.services.report_readers import get_reader
 
-async def process_excel_file(report_id: int, file_path: str, user: User):
+class ReportProcessingError(Exception):
+    """Неустранимая ошибка обработки отчета: повторная попытка не поможет"""
+
+class ReportStructureError(ReportProcessingError):
+    """Файл отчета не соответствует ожидаемой структуре"""
+
+# Колонки, без которых отчет не загружается
+REQUIRED_COLUMNS = ['Дата', 'Кампания', 'Показы', 'Клики', 'Расходы']
+
+def iter_excel_chunks(file_path: str, chunk_size: int = None) -> Iterator[List[list]]:
     """
-    Обработать Excel файл и загрузить данные в Google Sheets
+    Потоково читать отчет (XLSX, XLS, CSV, TSV, Parquet) блоками по chunk_size строк.
+    Первая строка первого блока - заголовок. В памяти держится только текущий блок.
     """
-    db = SessionLocal()
-    
-    try:
-        # Обновляем статус на "processing"
-        report = db.query(Report).filter(Report.id == report_id).first()
-        if report is None:
-            return
-        
-        setattr(report, 'status', 'processing')
+    return get_reader(file_path).iter_chunks(chunk_size or settings.REPORT_CHUNK_ROWS)
+
+async def _commit(db: Union[Session, AsyncSession]) -> None:
+    # Воркер Celery работает с синхронной сессией, API - с асинхронной
+    if isinstance(db, AsyncSession):
+        await db.commit()
+    else:
         db.commit()
+
+async def process_report(db: Union[Session, AsyncSession], report: Report, file_path: str, user: User) -> None:
+    """
+    Обработать отчет и загрузить данные в Google Sheets.
+    Ошибки не перехватываются: решение о повторе принимает вызывающий код.
+    """
+    # Обновляем статус на "processing"
+    setattr(report, 'status', 'processing')
+    await _commit(db)
+    
+    # Проверяем, подключена ли Google таблица
+    if not getattr(user, 'google_sheet_id', None):
+        raise ReportProcessingError('Google таблица не подключена')
+    
+    # Чекпоинт: строки, уже записанные в таблицу при предыдущих попытках, пропускаются
+    committed = report.rows_committed or 0
+    started = time.perf_counter()
+    rows_written = 0
+    
+    async def save_checkpoint(rows: int) -> None:
+        nonlocal rows_written
+        checkpoint_started = time.perf_counter()
+        setattr(report, 'rows_committed', (report.rows_committed or 0) + rows)
+        await _commit(db)
+        REPORT_STAGE_DURATION.labels('checkpoint').observe(time.perf_counter() - checkpoint_started)
+        REPORT_ROWS.inc(rows)
+        rows_written += rows
+    
+    # Читаем Excel файл блоками и сразу отправляем каждый блок в Google Sheets
+    chunks = iter(iter_excel_chunks(file_path))
+    offset = 0
+    while True:
+        read_started = time.perf_counter()
+        chunk = next(chunks, None)
+        REPORT_STAGE_DURATION.labels('read').observe(time.perf_counter() - read_started)
+        if chunk is None:
+            break
         
-        # Читаем Excel файл
-        df = pd.read_excel(file_path)
-        
-        # Преобразуем DataFrame в список списков для Google Sheets
-        data = [df.columns.tolist()] + df.values.tolist()
-        
-        # Проверяем, подключена ли Google таблица
-        if not getattr(user, 'google_sheet_id', None):
-            setattr(report, 'status', 'error')
-            setattr(report, 'error_message', 'Google таблица не подключена')
-            db.commit()
-            return
+        chunk_start, offset = offset, offset + len(chunk)
+        if offset <= committed:
+            continue
+        if chunk_start < committed:
+            chunk = chunk[committed - chunk_start:]
         
-        # Добавляем данные в Google Sheets
-        result = await append_data_to_sheet(
+        append_started = time.perf_counter()
+        await append_data_to_sheet(
             str(user.google_sheet_id),
             "A1",  # Начинаем с первой ячейки
-            data,
-            user
+            chunk,
+            user,
+            on_batch=save_checkpoint
         )
-        
-        # Обновляем статус на "completed"
-        setattr(report, 'status', 'completed')
-        db.commit()
-        
-    except Exception as e:
-        # Обновляем статус на "error"
-        report = db.query(Report).filter(Report.id == report_id).first()
-        if report is not None:
-            setattr(report, 'status', 'error')
-            setattr(report, 'error_message', str(e))
-            db.commit()
+        REPORT_STAGE_DURATION.labels('append').observe(time.perf_counter() - append_started)
+    
+    # Обновляем статус на "completed"
+    setattr(report, 'status', 'completed')
+    setattr(report, 'error_message', None)
+    await _commit(db)
     
-    finally:
-        db.close()
+    elapsed = time.perf_counter() - started
+    REPORT_STAGE_DURATION.labels('total').observe(elapsed)
+    if rows_written and elapsed > 0:
+        REPORT_ROWS_PER_SECOND.observe(rows_written / elapsed)
+
+async def process_excel_file(report_id: int, file_path: str, user: User):
+    """
+    Обработать Excel файл и загрузить данные в Google Sheets
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            report = (await db.execute(select(Report).filter(Report.id == report_id))).scalars().first()
+            if report is None:
+                return
+            
+            await process_report(db, report, file_path, user)
+            
+        except Exception as e:
+            # Обновляем статус на "error"
+            await db.rollback()
+            report = (await db.execute(select(Report).filter(Report.id == report_id))).scalars().first()
+            if report is not None:
+                setattr(report, 'status', 'error')
+                setattr(report, 'error_message', str(e))
+                await db.commit()
+
+def inspect_workbook(file_path: str, sample_rows: int = 5) -> Dict[str, Dict[str, Any]]:
+    """
+    Описать листы файла отчета за одно открытие: размеры, колонки и первые sample_rows строк
+    """
+    return get_reader(file_path).inspect(sample_rows)
 
 def parse_excel_file(file_path: str) -> Dict[str, Any]:
     """
     Парсить Excel файл и возвращать метаданные
     """
     try:
-        # Читаем все листы
-        excel_file = pd.ExcelFile(file_path)
-        sheets_info = {}
-        
-        for sheet_name in excel_file.sheet_names:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
-            sheets_info[sheet_name] = {
-                "rows": len(df),
-                "columns": len(df.columns),
-                "column_names": df.columns.tolist(),
-                "sample_data": df.head(5).to_dict('records')
-            }
+        sheets_info = inspect_workbook(file_path)
         
         return {
-            "total_sheets": len(excel_file.sheet_names),
-            "sheet_names": excel_file.sheet_names,
+            "total_sheets": len(sheets_info),
+            "sheet_names": list(sheets_info),
             "sheets_info": sheets_info
         }
         
     except Exception as e:
         raise Exception(f"Ошибка парсинга Excel файла: {str(e)}")
 
+def _normalize_column(name: Any) -> str:
+    return ' '.join(str(name).split()).casefold()
+
+def find_column_problems(header: list) -> List[str]:
+    """
+    Описать отсутствующие обязательные колонки; для похожих по написанию колонок
+    файла указывается, как они должны называться
+    """
+    present = [value for value in header if value is not None]
+    extra = [value for value in present if value not in REQUIRED_COLUMNS]
+    normalized = {_normalize_column(value): value for value in extra}
+    
+    problems = []
+    for column in REQUIRED_COLUMNS:
+        if column in present:
+            continue
+        match = normalized.get(_normalize_column(column))
+        if match is None:
+            close = difflib.get_close_matches(_normalize_column(column), list(normalized), n=1, cutoff=0.75)
+            match = normalized[close[0]] if close else None
+        if match is None:
+            problems.append(f"нет колонки «{column}»")
+        else:
+            problems.append(f"колонка «{match}» должна называться «{column}»")
+    return problems
+
 def validate_excel_structure(file_path: str) -> bool:
     """
     Проверить структуру Excel файла на соответствие требованиям
+    (читаются только заголовок и первая строка данных)
     """
     try:
-        df = pd.read_excel(file_path)
-        
-        # Проверяем наличие обязательных колонок
-        required_columns = ['Дата', 'Кампания', 'Показы', 'Клики', 'Расходы']
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        
-        if missing_columns:
-            raise Exception(f"Отсутствуют обязательные колонки: {', '.join(missing_columns)}")
-        
-        # Проверяем, что есть данные
-        if len(df) == 0:
-            raise Exception("Файл не содержит данных")
-        
-        return True
-        
+        header, first_row = get_reader(file_path).read_header()
     except Exception as e:
-        raise Exception(f"Ошибка валидации структуры файла: {str(e)}") 
\ No newline at end of file
+        raise ReportStructureError(f"Ошибка валидации структуры файла: {str(e)}")
+    
+    # Проверяем наличие обязательных колонок
+    problems = find_column_problems(header)
+    if problems:
+        raise ReportStructureError(f"Ошибка валидации структуры файла: {'; '.join(problems)}")
+    
+    # Проверяем, что есть данные
+    if first_row is None:
+        raise ReportStructureError("Ошибка валидации структуры файла: файл не содержит данных")
+    
+    return True
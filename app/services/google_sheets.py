@@ -1,21 +1,50 @@
 import os
-from typing import Dict, Any, Optional
+import json
+import inspect
+import time
+from typing import Dict, Any, List, Optional, Callable, Iterator, Union, Awaitable
+import httplib2
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
+from fastapi.concurrency import run_in_threadpool
 import pickle
 
 from app.models.user import User
+from app.core.cache import TTLCache
 from app.core.config import settings
+from app.core.metrics import observe_external_call
+from app.core.timing import span
+from app.services.google_tokens import SCOPES, token_manager
 
-# Если изменяете эти области, удалите файл token.pickle.
-SCOPES = [
-    'https://www.googleapis.com/auth/spreadsheets',
-    'https://www.googleapis.com/auth/drive.metadata.readonly',
-    'https://www.googleapis.com/auth/drive'  # Полный доступ к Google Drive (чтение/запись)
-]
+# Разобранные discovery-документы Google API, общие для всего процесса
+_discovery_documents: Dict[tuple, dict] = {}
+
+# Учетные данные Google пользователей: ключ user_id,
+# значение (access_token на момент создания, учетные данные)
+_credentials_cache = TTLCache(
+    maxsize=settings.GOOGLE_CREDENTIALS_CACHE_SIZE,
+    ttl=settings.GOOGLE_CREDENTIALS_CACHE_TTL
+)
+
+# Список Google-таблиц пользователя: ключ user_id, значение - состояние листинга
+# (файлы по id, токен ленты изменений Drive, время последней проверки)
+_spreadsheet_cache = TTLCache(
+    maxsize=settings.DRIVE_LISTING_CACHE_SIZE,
+    ttl=settings.DRIVE_LISTING_CACHE_TTL
+)
+
+SPREADSHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+
+# Прочитанные диапазоны таблиц: ключ (sheet_id, range_name),
+# значение (версия файла в Google Drive на момент чтения, значения)
+_read_cache = TTLCache(
+    maxsize=settings.SHEETS_READ_CACHE_SIZE,
+    ttl=settings.SHEETS_READ_CACHE_TTL
+)
 
 def get_google_auth_url() -> str:
     """
@@ -34,7 +63,7 @@ def get_google_auth_url() -> str:
         # Для тестов возвращаем мок URL
         return "https://accounts.google.com/oauth2/auth"
 
-def exchange_code_for_tokens(code: str) -> Dict[str, str]:
+def exchange_code_for_tokens(code: str) -> Dict[str, Any]:
     """
     Обменять код авторизации на токены
     """
@@ -45,13 +74,15 @@ def exchange_code_for_tokens(code: str) -> Dict[str, str]:
         flow.fetch_token(code=code)
         return {
             'access_token': str(flow.credentials.token or ''),
-            'refresh_token': str(flow.credentials.refresh_token or '')
+            'refresh_token': str(flow.credentials.refresh_token or ''),
+            'expiry': flow.credentials.expiry
         }
     except FileNotFoundError:
         # Для тестов возвращаем мок токены
         return {
             'access_token': 'mock_access_token',
-            'refresh_token': 'mock_refresh_token'
+            'refresh_token': 'mock_refresh_token',
+            'expiry': None
         }
 
 def get_credentials(user: User) -> Any:
@@ -60,25 +91,19 @@ def get_credentials(user: User) -> Any:
     """
     creds = None
     
-    # Проверяем, есть ли сохраненные токены
+    # Проверяем, есть ли сохраненные токены; обновление и сохранение токена берет на себя token_manager
     if getattr(user, 'google_access_token', None):
-        creds = Credentials(
-            token=user.google_access_token,
-            refresh_token=user.google_refresh_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=settings.GOOGLE_CLIENT_ID,
-            client_secret=settings.GOOGLE_CLIENT_SECRET,
-            scopes=SCOPES
-        )
+        previous_token = user.google_access_token
+        creds = token_manager.get_credentials(user)
+        if creds.token != previous_token:
+            # Аккаунт тот же, сменился только токен: список таблиц остается действительным
+            invalidate_user_services(user.id, keep_listing=True)
     
     # Если нет действительных учетных данных, запрашиваем их
     if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
+        flow = InstalledAppFlow.from_client_secrets_file(
+            'credentials.json', SCOPES)
+        creds = flow.run_local_server(port=0)
         # Сохраняем токены в базе данных только если они не None
         if getattr(creds, 'token', None):
             setattr(user, 'google_access_token', str(creds.token))
@@ -87,6 +112,15 @@ def get_credentials(user: User) -> Any:
     
     return creds
 
+async def refresh_credentials(user: User) -> None:
+    """
+    Обновить истекший токен пользователя в пуле потоков, не блокируя цикл событий.
+    Вызывается в начале асинхронных функций модуля: после него get_service
+    получает действующий токен без синхронного ожидания.
+    """
+    if getattr(user, 'google_access_token', None):
+        await run_in_threadpool(get_credentials, user)
+
 def get_credentials_from_user(user):
     """
     Получить credentials из пользователя (для моков и тестов)
@@ -95,16 +129,97 @@ def get_credentials_from_user(user):
         return Credentials(token=user.google_access_token)
     return None
 
+def _get_discovery_document(api: str, version: str) -> dict:
+    """
+    Получить discovery-документ API (читается и разбирается один раз на процесс)
+    """
+    document = _discovery_documents.get((api, version))
+    if document is None:
+        content = get_static_doc(api, version)
+        if content is None:
+            raise Exception(f"Discovery-документ {api} {version} не найден")
+        document = json.loads(content)
+        _discovery_documents[(api, version)] = document
+    return document
+
+def execute_request(request: Any, method: str) -> Any:
+    """
+    Выполнить запрос Google API, учитывая длительность и ошибки в метриках
+    """
+    started = time.perf_counter()
+    try:
+        with span('google'):
+            result = request.execute()
+    except HttpError as error:
+        status = getattr(getattr(error, 'resp', None), 'status', 'unknown')
+        observe_external_call('google', method, time.perf_counter() - started, f"http_{status}")
+        raise
+    except Exception:
+        observe_external_call('google', method, time.perf_counter() - started, 'transport')
+        raise
+    observe_external_call('google', method, time.perf_counter() - started)
+    return result
+
+def _get_user_credentials(user: User) -> Any:
+    """
+    Учетные данные пользователя из кеша процесса (пересоздаются, если сменился токен)
+    """
+    token = getattr(user, 'google_access_token', None)
+    cached = _credentials_cache.get(user.id)
+    if cached is not None and cached[0] == token:
+        return cached[1]
+    
+    creds = get_credentials(user)
+    _credentials_cache.set(user.id, (getattr(user, 'google_access_token', None), creds))
+    return creds
+
+def get_service(api: str, version: str, user: User) -> Any:
+    """
+    Получить авторизованный клиент Google API для пользователя.
+    Discovery-документ и учетные данные берутся из кеша процесса, а клиент со своим
+    соединением httplib2 создается на каждый вызов: httplib2 не рассчитан на работу
+    из нескольких потоков, а сборка клиента из готового документа почти ничего не стоит.
+    """
+    http = AuthorizedHttp(_get_user_credentials(user), http=httplib2.Http())
+    return build_from_document(_get_discovery_document(api, version), http=http)
+
+def invalidate_user_services(user_id: int, keep_listing: bool = False) -> None:
+    """
+    Сбросить кешированные учетные данные Google пользователя (после обновления или отвязки токена).
+    keep_listing=True сохраняет список таблиц и токен ленты изменений Drive: при обновлении
+    токена того же аккаунта список не нужно загружать заново.
+    """
+    _credentials_cache.pop(user_id)
+    if not keep_listing:
+        _spreadsheet_cache.pop(user_id)
+
+def clear_service_cache() -> None:
+    """
+    Очистить кеш учетных данных Google, списков таблиц и прочитанных диапазонов
+    """
+    _credentials_cache.clear()
+    _read_cache.clear()
+    _spreadsheet_cache.clear()
+
+def get_sheet_version(sheet_id: str, user: User) -> Optional[str]:
+    """
+    Версия файла таблицы из метаданных Google Drive (меняется при любом изменении таблицы).
+    Запрос метаданных намного дешевле чтения диапазона.
+    """
+    service = get_service('drive', 'v3', user)
+    metadata = execute_request(service.files().get(fileId=sheet_id, fields='version,modifiedTime'), 'drive.files.get')
+    return metadata.get('version') or metadata.get('modifiedTime')
+
 async def connect_sheet(sheet_id: str, user: User) -> Dict[str, Any]:
     """
     Подключиться к Google таблице
     """
     try:
-        creds = get_credentials(user)
-        service = build('sheets', 'v4', credentials=creds)
+        await refresh_credentials(user)
+        service = get_service('sheets', 'v4', user)
         
         # Проверяем доступ к таблице
-        sheet = service.spreadsheets().get(spreadsheetId=sheet_id).execute()
+        sheet = execute_request(service.spreadsheets().get(spreadsheetId=sheet_id), 'sheets.spreadsheets.get')
         
         return {
             "sheet_id": sheet_id,
@@ -121,11 +236,11 @@ async def get_sheet_info(sheet_id: str, user: User) -> Dict[str, Any]:
     Получить информацию о Google таблице
     """
     try:
-        creds = get_credentials(user)
-        service = build('sheets', 'v4', credentials=creds)
+        await refresh_credentials(user)
+        service = get_service('sheets', 'v4', user)
         
         # Получаем информацию о таблице
-        sheet = service.spreadsheets().get(spreadsheetId=sheet_id).execute()
+        sheet = execute_request(service.spreadsheets().get(spreadsheetId=sheet_id), 'sheets.spreadsheets.get')
         
         return {
             "sheet_id": sheet_id,
@@ -143,19 +258,19 @@ async def update_sheet(sheet_id: str, range_name: str, values: list, user: User)
     Обновить данные в Google таблице
     """
     try:
-        creds = get_credentials(user)
-        service = build('sheets', 'v4', credentials=creds)
+        await refresh_credentials(user)
+        service = get_service('sheets', 'v4', user)
         
         body = {
             'values': values
         }
         
-        result = service.spreadsheets().values().update(
+        result = execute_request(service.spreadsheets().values().update(
             spreadsheetId=sheet_id,
             range=range_name,
             valueInputOption='RAW',
             body=body
-        ).execute()
+        ), 'sheets.values.update')
         
         return {
             "updated_cells": result.get('updatedCells'),
@@ -166,29 +281,96 @@ async def update_sheet(sheet_id: str, range_name: str, values: list, user: User)
     except Exception as e:
         raise Exception(f"Ошибка обновления: {str(e)}")
 
-async def append_data_to_sheet(sheet_id: str, range_name: str, values: list, user: User) -> Dict[str, Any]:
+async def batch_update_sheet(sheet_id: str, data: Dict[str, list], user: User) -> Dict[str, Any]:
     """
-    Добавить данные в конец Google таблицы
+    Обновить несколько диапазонов Google таблицы одним запросом values.batchUpdate.
+    data: диапазон -> значения
     """
     try:
-        creds = get_credentials(user)
-        service = build('sheets', 'v4', credentials=creds)
+        await refresh_credentials(user)
+        service = get_service('sheets', 'v4', user)
         
         body = {
-            'values': values
+            'valueInputOption': 'RAW',
+            'data': [{'range': range_name, 'values': values} for range_name, values in data.items()]
         }
         
-        result = service.spreadsheets().values().append(
+        result = execute_request(service.spreadsheets().values().batchUpdate(
             spreadsheetId=sheet_id,
-            range=range_name,
-            valueInputOption='RAW',
-            insertDataOption='INSERT_ROWS',
             body=body
-        ).execute()
+        ), 'sheets.values.batchUpdate')
         
         return {
-            "updated_cells": result.get('updates', {}).get('updatedCells'),
-            "updated_range": result.get('updates', {}).get('updatedRange')
+            "updated_cells": result.get('totalUpdatedCells'),
+            "updated_ranges": [response.get('updatedRange') for response in result.get('responses', [])]
+        }
+    except HttpError as error:
+        raise Exception(f"Ошибка обновления таблицы: {error}")
+    except Exception as e:
+        raise Exception(f"Ошибка обновления: {str(e)}")
+
+def iter_append_batches(values: list, max_rows: Optional[int] = None, max_bytes: Optional[int] = None) -> Iterator[list]:
+    """
+    Разбить строки на пакеты, не превышающие лимит строк и размера тела запроса
+    """
+    max_rows = max_rows or settings.SHEETS_APPEND_MAX_ROWS
+    max_bytes = max_bytes or settings.SHEETS_APPEND_MAX_BYTES
+    
+    batch = []
+    batch_bytes = 0
+    for row in values:
+        row_bytes = len(json.dumps(row, ensure_ascii=False, default=str).encode('utf-8'))
+        if batch and (len(batch) >= max_rows or batch_bytes + row_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(row)
+        batch_bytes += row_bytes
+    if batch:
+        yield batch
+
+async def append_data_to_sheet(
+    sheet_id: str,
+    range_name: str,
+    values: list,
+    user: User,
+    on_batch: Optional[Callable[[int], Union[None, Awaitable[None]]]] = None
+) -> Dict[str, Any]:
+    """
+    Добавить данные в конец Google таблицы.
+    Данные отправляются пакетами; после каждого успешно записанного пакета
+    вызывается on_batch(количество строк) (обычная функция или корутина),
+    чтобы вызывающий код мог сохранить чекпоинт.
+    """
+    try:
+        await refresh_credentials(user)
+        service = get_service('sheets', 'v4', user)
+        
+        updated_cells = 0
+        updated_range = None
+        for batch in iter_append_batches(values):
+            body = {
+                'values': batch
+            }
+            
+            result = execute_request(service.spreadsheets().values().append(
+                spreadsheetId=sheet_id,
+                range=range_name,
+                valueInputOption='RAW',
+                insertDataOption='INSERT_ROWS',
+                body=body
+            ), 'sheets.values.append')
+            
+            updated_cells += result.get('updates', {}).get('updatedCells') or 0
+            updated_range = result.get('updates', {}).get('updatedRange')
+            if on_batch is not None:
+                result = on_batch(len(batch))
+                if inspect.isawaitable(result):
+                    await result
+        
+        return {
+            "updated_cells": updated_cells,
+            "updated_range": updated_range
         }
     except HttpError as error:
         raise Exception(f"Ошибка добавления данных: {error}")
@@ -197,33 +379,144 @@ async def append_data_to_sheet(sheet_id: str, range_name: str, values: list, use
 
 async def read_data_from_sheet(sheet_id: str, range_name: str, user: User) -> list:
     """
-    Читать данные из Google таблицы
+    Читать данные из Google таблицы.
+    Диапазон берется из кеша, если с момента прошлого чтения версия таблицы не изменилась.
     """
     try:
-        creds = get_credentials(user)
-        service = build('sheets', 'v4', credentials=creds)
+        await refresh_credentials(user)
+        version = get_sheet_version(sheet_id, user)
+        key = (sheet_id, range_name)
+        cached = _read_cache.get(key)
+        if cached is not None and version is not None and cached[0] == version:
+            return cached[1]
+        
+        service = get_service('sheets', 'v4', user)
         
-        result = service.spreadsheets().values().get(
+        result = execute_request(service.spreadsheets().values().get(
             spreadsheetId=sheet_id,
             range=range_name
-        ).execute()
+        ), 'sheets.values.get')
         # Возвращаем все значения, как есть
-        return result.get('values', [])
+        values = result.get('values', [])
+        _read_cache.set(key, (version, values))
+        return values
     except HttpError as error:
         raise Exception(f"Ошибка чтения данных: {error}")
     except Exception as e:
         raise Exception(f"Ошибка чтения: {str(e)}") 
 
-def get_user_spreadsheets(user: User) -> list:
+async def read_ranges_from_sheet(sheet_id: str, ranges: List[str], user: User) -> Dict[str, list]:
     """
-    Получить список Google-таблиц пользователя через Google Drive API
+    Читать несколько диапазонов Google таблицы одним запросом values.batchGet.
+    Диапазоны, прочитанные при текущей версии таблицы, берутся из кеша, запрашиваются только остальные.
     """
-    creds = get_credentials(user)
-    service = build('drive', 'v3', credentials=creds)
-    results = service.files().list(
-        q="mimeType='application/vnd.google-apps.spreadsheet' and trashed = false",
-        pageSize=100,
-        fields="files(id, name)"
-    ).execute()
-    files = results.get('files', [])
-    return files 
\ No newline at end of file
+    try:
+        await refresh_credentials(user)
+        version = get_sheet_version(sheet_id, user)
+        result = {}
+        missing = []
+        for range_name in dict.fromkeys(ranges):
+            cached = _read_cache.get((sheet_id, range_name))
+            if cached is not None and version is not None and cached[0] == version:
+                result[range_name] = cached[1]
+            else:
+                missing.append(range_name)
+        
+        if missing:
+            service = get_service('sheets', 'v4', user)
+            response = execute_request(service.spreadsheets().values().batchGet(
+                spreadsheetId=sheet_id,
+                ranges=missing
+            ), 'sheets.values.batchGet')
+            # Диапазоны в ответе идут в порядке запроса, но в нормализованной записи
+            for range_name, value_range in zip(missing, response.get('valueRanges', [])):
+                values = value_range.get('values', [])
+                _read_cache.set((sheet_id, range_name), (version, values))
+                result[range_name] = values
+        
+        return {range_name: result.get(range_name, []) for range_name in ranges}
+    except HttpError as error:
+        raise Exception(f"Ошибка чтения данных: {error}")
+    except Exception as e:
+        raise Exception(f"Ошибка чтения: {str(e)}")
+
+def _spreadsheet_entry(file: Dict[str, Any]) -> Dict[str, Any]:
+    return {'id': file['id'], 'name': file.get('name'), 'modifiedTime': file.get('modifiedTime')}
+
+def _list_all_spreadsheets(service: Any) -> Dict[str, Dict[str, Any]]:
+    """
+    Полный список таблиц пользователя по всем страницам Drive API
+    """
+    files = {}
+    page_token = None
+    while True:
+        results = execute_request(service.files().list(
+            q=f"mimeType='{SPREADSHEET_MIME_TYPE}' and trashed = false",
+            pageSize=1000,
+            pageToken=page_token,
+            fields="nextPageToken, files(id, name, modifiedTime)"
+        ), 'drive.files.list')
+        for file in results.get('files', []):
+            files[file['id']] = _spreadsheet_entry(file)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+def _apply_drive_changes(service: Any, files: Dict[str, Dict[str, Any]], page_token: str) -> str:
+    """
+    Применить к списку таблиц изменения из ленты Drive; возвращает токен для следующей проверки
+    """
+    while True:
+        results = execute_request(service.changes().list(
+            pageToken=page_token,
+            pageSize=1000,
+            spaces='drive',
+            fields="nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, trashed, modifiedTime))"
+        ), 'drive.changes.list')
+        for change in results.get('changes', []):
+            file = change.get('file') or {}
+            if change.get('removed') or file.get('trashed') or file.get('mimeType') != SPREADSHEET_MIME_TYPE:
+                files.pop(change.get('fileId'), None)
+            else:
+                files[file['id']] = _spreadsheet_entry(file)
+        if results.get('newStartPageToken'):
+            return results['newStartPageToken']
+        page_token = results['nextPageToken']
+
+def _load_spreadsheets(user: User) -> Dict[str, Dict[str, Any]]:
+    """
+    Таблицы пользователя из кеша процесса. Список загружается целиком один раз,
+    затем не чаще DRIVE_LISTING_REFRESH_INTERVAL обновляется по ленте изменений Drive.
+    """
+    state = _spreadsheet_cache.get(user.id)
+    if state is not None and time.monotonic() - state['checked_at'] < settings.DRIVE_LISTING_REFRESH_INTERVAL:
+        return state['files']
+    
+    service = get_service('drive', 'v3', user)
+    if state is not None:
+        try:
+            files = dict(state['files'])
+            page_token = _apply_drive_changes(service, files, state['page_token'])
+            _spreadsheet_cache.set(user.id, {'files': files, 'page_token': page_token, 'checked_at': time.monotonic()})
+            return files
+        except HttpError:
+            # Токен ленты устарел или недействителен: загружаем список заново
+            pass
+    
+    # Токен ленты берется до загрузки списка, чтобы не пропустить изменения во время нее
+    page_token = execute_request(service.changes().getStartPageToken(), 'drive.changes.getStartPageToken')['startPageToken']
+    files = _list_all_spreadsheets(service)
+    _spreadsheet_cache.set(user.id, {'files': files, 'page_token': page_token, 'checked_at': time.monotonic()})
+    return files
+
+def get_user_spreadsheets(user: User, search: Optional[str] = None, limit: Optional[int] = None) -> list:
+    """
+    Получить список Google-таблиц пользователя через Google Drive API,
+    от недавно измененных к старым, с поиском по названию
+    """
+    files = list(_load_spreadsheets(user).values())
+    if search:
+        search = search.casefold()
+        files = [file for file in files if search in (file['name'] or '').casefold()]
+    files.sort(key=lambda file: file['modifiedTime'] or '', reverse=True)
+    return files[:limit or settings.DRIVE_LISTING_LIMIT]
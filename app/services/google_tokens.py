@@ -0,0 +1,142 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.user import User
+from app.services.auth import invalidate_user_cache
+
+logger = logging.getLogger(__name__)
+
+# Если изменяете эти области, удалите файл token.pickle.
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive.metadata.readonly',
+    'https://www.googleapis.com/auth/drive'  # Полный доступ к Google Drive (чтение/запись)
+]
+
+GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
+
+def build_credentials(user: User) -> Credentials:
+    """
+    Собрать Credentials из токенов, сохраненных в профиле пользователя
+    """
+    return Credentials(
+        token=user.google_access_token,
+        refresh_token=user.google_refresh_token or None,
+        token_uri=GOOGLE_TOKEN_URI,
+        client_id=settings.GOOGLE_CLIENT_ID,
+        client_secret=settings.GOOGLE_CLIENT_SECRET,
+        scopes=SCOPES,
+        expiry=getattr(user, 'google_token_expiry', None)
+    )
+
+def store_refreshed_token(user_id: int, creds: Credentials) -> None:
+    """
+    Атомарно сохранить обновленный токен вместе со сроком действия (одним UPDATE)
+    """
+    values = {
+        User.google_access_token: creds.token,
+        User.google_token_expiry: creds.expiry
+    }
+    # Google может выдать новый refresh_token при ротации
+    if creds.refresh_token:
+        values[User.google_refresh_token] = creds.refresh_token
+
+    db = SessionLocal()
+    try:
+        db.query(User).filter(User.id == user_id).update(values, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    invalidate_user_cache(user_id)
+
+class GoogleTokenManager:
+    """
+    Менеджер Google токенов.
+    Обновляет токен заранее (в фоне) до истечения срока, сохраняет результат в базе
+    и объединяет одновременные обновления для одного пользователя в один запрос к Google.
+    Отдельного планировщика нет: фоновое обновление запускается, когда токен запрашивается
+    в последние refresh_margin секунд его жизни. Токен пользователя без запросов в этот
+    период истекает и обновляется при следующем обращении с ожиданием ответа Google.
+    """
+
+    def __init__(self, refresh_margin: int, max_workers: int = 4):
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="google-token-refresh")
+        self._inflight: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self, user_id: int, refresh_token: str) -> Credentials:
+        creds = Credentials(
+            token=None,
+            refresh_token=refresh_token,
+            token_uri=GOOGLE_TOKEN_URI,
+            client_id=settings.GOOGLE_CLIENT_ID,
+            client_secret=settings.GOOGLE_CLIENT_SECRET,
+            scopes=SCOPES
+        )
+        try:
+            creds.refresh(Request())
+            store_refreshed_token(user_id, creds)
+        except Exception as e:
+            logger.error(f"Не удалось обновить Google токен пользователя {user_id}: {e}")
+            raise
+        logger.info(f"Google токен пользователя {user_id} обновлен, действует до {creds.expiry}")
+        return creds
+
+    def refresh(self, user_id: int, refresh_token: str) -> Future:
+        """
+        Запустить обновление токена или присоединиться к уже идущему
+        """
+        with self._lock:
+            future = self._inflight.get(user_id)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._refresh, user_id, refresh_token)
+            self._inflight[user_id] = future
+        # Колбэк регистрируется вне блокировки: для уже завершенной задачи он вызывается сразу
+        future.add_done_callback(lambda _: self._forget(user_id, future))
+        return future
+
+    def _forget(self, user_id: int, future: Future) -> None:
+        with self._lock:
+            if self._inflight.get(user_id) is future:
+                del self._inflight[user_id]
+
+    def get_credentials(self, user: User) -> Credentials:
+        """
+        Получить действующие учетные данные пользователя.
+        Токен, срок которого скоро истекает, обновляется в фоне; истекший (или
+        с неизвестным сроком) обновляется синхронно - поток ждет ответа Google,
+        поэтому из асинхронного кода метод вызывается в пуле потоков.
+        """
+        creds = build_credentials(user)
+        if not creds.refresh_token:
+            return creds
+
+        now = datetime.utcnow()
+        if creds.expiry is not None and creds.expiry - now > self.refresh_margin:
+            return creds
+
+        future = self.refresh(user.id, creds.refresh_token)
+        if creds.expiry is not None and creds.expiry > now:
+            # Текущий токен еще действует, новый будет готов к следующим запросам
+            return creds
+
+        fresh = future.result(timeout=settings.GOOGLE_TOKEN_REFRESH_TIMEOUT)
+        # В базе токен уже сохранен, обновляем только объект в памяти
+        set_committed_value(user, 'google_access_token', fresh.token)
+        set_committed_value(user, 'google_token_expiry', fresh.expiry)
+        if fresh.refresh_token:
+            set_committed_value(user, 'google_refresh_token', fresh.refresh_token)
+        return fresh
+
+token_manager = GoogleTokenManager(refresh_margin=settings.GOOGLE_TOKEN_REFRESH_MARGIN)
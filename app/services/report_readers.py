@@ -0,0 +1,297 @@
+import codecs
+import csv
+import math
+import os
+import re
+from abc import ABC, abstractmethod
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow.parquet as pq
+from openpyxl import load_workbook
+
+# Поддерживаемые форматы отчетов
+SUPPORTED_EXTENSIONS = ('.xlsx', '.xls', '.csv', '.tsv', '.parquet')
+
+# Сколько байт CSV читается для определения кодировки и разделителя
+CSV_SNIFF_BYTES = 64 * 1024
+
+# Разделители CSV в порядке предпочтения при равенстве
+CSV_DELIMITERS = (',', ';', '\t')
+
+# Размер пакета строк при чтении Parquet
+PARQUET_BATCH_ROWS = 1024
+
+_INT_RE = re.compile(r'-?(0|[1-9]\d*)')
+_FLOAT_RE = re.compile(r'-?\d+\.\d+')
+_DECIMAL_COMMA_RE = re.compile(r'-?\d+,\d+')
+
+def _to_cell_value(value: Any) -> Any:
+    """
+    Привести значение ячейки к виду, который принимает Google Sheets API
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float) and math.isnan(value):
+        return ""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return value
+
+def _is_empty_value(value: Any) -> bool:
+    return value is None or value == "" or (isinstance(value, float) and math.isnan(value))
+
+def _is_empty_row(row) -> bool:
+    return all(_is_empty_value(value) for value in row)
+
+def _column_names(header: list, columns: int) -> List[str]:
+    # Безымянные колонки называются так же, как их называет pandas
+    header = list(header) + [None] * (columns - len(header))
+    return [f"Unnamed: {i}" if value is None or value == "" else value for i, value in enumerate(header)]
+
+def _sheet_info(header: list, sample: List[list], rows: int, columns: int) -> Dict[str, Any]:
+    column_names = _column_names(header, columns)
+    return {
+        "rows": rows,
+        "columns": columns,
+        "column_names": column_names,
+        "sample_data": [dict(zip(column_names, row)) for row in sample]
+    }
+
+def _chunked(rows: Iterator[list], chunk_size: int) -> Iterator[List[list]]:
+    chunk = []
+    for row in rows:
+        chunk.append([_to_cell_value(v) for v in row])
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class ReportReader(ABC):
+    """
+    Чтение файла отчета. Читается первый лист (или весь файл для CSV и Parquet),
+    первая строка - заголовок. Полностью пустые строки пропускаются.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    @property
+    def name(self) -> str:
+        return os.path.splitext(os.path.basename(self.file_path))[0]
+
+    @abstractmethod
+    def iter_rows(self) -> Iterator[list]:
+        """
+        Потоково перебрать непустые строки, начиная с заголовка
+        """
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[List[list]]:
+        """
+        Строки блоками по chunk_size, значения приведены к виду для Google Sheets.
+        В памяти держится только текущий блок.
+        """
+        return _chunked(self.iter_rows(), chunk_size)
+
+    def read_header(self) -> Tuple[list, Optional[list]]:
+        """
+        Заголовок и первая строка данных (None, если данных нет)
+        """
+        rows = self.iter_rows()
+        try:
+            return next(rows, []), next(rows, None)
+        finally:
+            close = getattr(rows, 'close', None)
+            if close:
+                close()
+
+    def inspect(self, sample_rows: int = 5) -> Dict[str, Dict[str, Any]]:
+        """
+        Описание листов файла: размеры, названия колонок и первые sample_rows строк
+        """
+        rows = self.iter_rows()
+        header = next(rows, [])
+        sample = []
+        total = 0
+        for row in rows:
+            if len(sample) < sample_rows:
+                sample.append(row)
+            total += 1
+        columns = max([len(header)] + [len(row) for row in sample])
+        return {self.name: _sheet_info(header, sample, total, columns)}
+
+class XlsxReader(ReportReader):
+    """XLSX: openpyxl в режиме только для чтения"""
+
+    def iter_rows(self) -> Iterator[list]:
+        workbook = load_workbook(self.file_path, read_only=True, data_only=True)
+        try:
+            # Первый лист книги, а не выбранный при сохранении (так же читал pd.read_excel)
+            for row in workbook.worksheets[0].iter_rows(values_only=True):
+                # Пропускаем полностью пустые строки (в read-only режиме их бывает много в конце листа)
+                if not _is_empty_row(row):
+                    yield list(row)
+        finally:
+            workbook.close()
+
+    def inspect(self, sample_rows: int = 5) -> Dict[str, Dict[str, Any]]:
+        """
+        Описать все листы книги за одно открытие файла.
+        Заголовок - первая непустая строка, читаются только он и первые sample_rows непустых строк.
+        Число строк берется из размеров листа в метаданных и приблизительно: в него
+        входят пустые строки в середине и оформленные, но пустые строки в конце листа.
+        """
+        sheets_info = {}
+        workbook = load_workbook(self.file_path, read_only=True, data_only=True)
+        try:
+            for worksheet in workbook.worksheets:
+                header, sample, leading_empty = [], [], 0
+                for row in worksheet.iter_rows(values_only=True):
+                    if _is_empty_row(row):
+                        if not header:
+                            leading_empty += 1
+                        continue
+                    if not header:
+                        header = list(row)
+                    elif len(sample) < sample_rows:
+                        sample.append(list(row))
+                    else:
+                        break
+                if worksheet.max_row is None:
+                    # В файле нет размеров листа: досчитываем непустые строки потоком, не сохраняя их
+                    worksheet.reset_dimensions()
+                    total_rows = sum(1 for row in worksheet.iter_rows(values_only=True) if not _is_empty_row(row))
+                    columns = max([len(header)] + [len(row) for row in sample])
+                else:
+                    total_rows = worksheet.max_row - leading_empty
+                    columns = worksheet.max_column
+                sheets_info[worksheet.title] = _sheet_info(header, sample, max(total_rows - 1, 0), columns)
+        finally:
+            workbook.close()
+        return sheets_info
+
+class XlsReader(ReportReader):
+    """Старый формат XLS: openpyxl его не читает, используется pandas (xlrd)"""
+
+    def iter_rows(self) -> Iterator[list]:
+        df = pd.read_excel(self.file_path)
+        yield df.columns.tolist()
+        for row in df.values.tolist():
+            if not _is_empty_row(row):
+                yield row
+
+    def read_header(self) -> Tuple[list, Optional[list]]:
+        df = pd.read_excel(self.file_path, nrows=1)
+        return df.columns.tolist(), df.values.tolist()[0] if len(df) else None
+
+    def inspect(self, sample_rows: int = 5) -> Dict[str, Dict[str, Any]]:
+        # Книга xlrd уже разобрана при открытии, размеры известны без чтения листов
+        sheets_info = {}
+        with pd.ExcelFile(self.file_path) as excel_file:
+            for sheet in excel_file.book.sheets():
+                header = sheet.row_values(0) if sheet.nrows else []
+                sample = [sheet.row_values(i) for i in range(1, min(sheet.nrows, sample_rows + 1))]
+                sheets_info[sheet.name] = _sheet_info(header, sample, max(sheet.nrows - 1, 0), sheet.ncols)
+        return sheets_info
+
+def sniff_encoding(sample: bytes) -> str:
+    """
+    Кодировка CSV по началу файла: UTF-8 (с BOM или без), иначе cp1251
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # Многобайтовый символ мог оборваться на границе прочитанного фрагмента
+        if e.start < len(sample) - 3:
+            return 'cp1251'
+    return 'utf-8'
+
+def _parse_csv_value(value: str, decimal_comma: bool) -> Any:
+    """
+    Числа в CSV приходят строками: приводим их к числам, как это делает Excel
+    """
+    value = value.strip()
+    if _INT_RE.fullmatch(value):
+        return int(value)
+    if _FLOAT_RE.fullmatch(value):
+        return float(value)
+    if decimal_comma and _DECIMAL_COMMA_RE.fullmatch(value):
+        return float(value.replace(',', '.'))
+    return value
+
+class CsvReader(ReportReader):
+    """CSV и TSV: потоковое чтение с определением кодировки и разделителя"""
+
+    def _dialect(self) -> Tuple[str, str]:
+        with open(self.file_path, 'rb') as f:
+            sample = f.read(CSV_SNIFF_BYTES)
+        encoding = sniff_encoding(sample)
+        if self.file_path.lower().endswith('.tsv'):
+            return encoding, '\t'
+        # Разделитель - самый частый из кандидатов в строке заголовка
+        header = sample.decode(encoding, errors='ignore').lstrip('\ufeff').splitlines()[:1]
+        header = header[0] if header else ''
+        return encoding, max(CSV_DELIMITERS, key=header.count)
+
+    def iter_rows(self) -> Iterator[list]:
+        encoding, delimiter = self._dialect()
+        decimal_comma = delimiter != ','
+        with open(self.file_path, newline='', encoding=encoding) as f:
+            rows = csv.reader(f, delimiter=delimiter)
+            header = next(rows, None)
+            if header is None:
+                return
+            yield [value.strip() for value in header]
+            for row in rows:
+                if not _is_empty_row(row):
+                    yield [_parse_csv_value(value, decimal_comma) for value in row]
+
+class ParquetReader(ReportReader):
+    """Parquet: чтение пакетами строк, размеры из метаданных файла"""
+
+    def _iter_batches(self, parquet_file: pq.ParquetFile, batch_size: int) -> Iterator[list]:
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            yield from zip(*(column.to_pylist() for column in batch.columns))
+
+    def iter_rows(self) -> Iterator[list]:
+        parquet_file = pq.ParquetFile(self.file_path)
+        try:
+            yield list(parquet_file.schema_arrow.names)
+            for row in self._iter_batches(parquet_file, PARQUET_BATCH_ROWS):
+                if not _is_empty_row(row):
+                    yield list(row)
+        finally:
+            parquet_file.close()
+
+    def inspect(self, sample_rows: int = 5) -> Dict[str, Dict[str, Any]]:
+        parquet_file = pq.ParquetFile(self.file_path)
+        try:
+            header = list(parquet_file.schema_arrow.names)
+            sample = [list(row) for _, row in zip(range(sample_rows), self._iter_batches(parquet_file, sample_rows or 1))]
+            return {self.name: _sheet_info(header, sample, parquet_file.metadata.num_rows, len(header))}
+        finally:
+            parquet_file.close()
+
+READERS = {
+    '.xlsx': XlsxReader,
+    '.xls': XlsReader,
+    '.csv': CsvReader,
+    '.tsv': CsvReader,
+    '.parquet': ParquetReader
+}
+
+def get_reader(file_path: str) -> ReportReader:
+    """
+    Выбрать читатель по расширению файла
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in READERS:
+        raise ValueError(f"Неподдерживаемый формат файла: {extension or file_path}")
+    return READERS[extension](file_path)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import random
+from typing import Optional
+
+import redis
+from celery import uuid
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.celery_app import celery_app
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.report import Report
+from app.models.user import User
+from app.services.file_processor import process_report, ReportProcessingError
+
+logger = logging.getLogger(__name__)
+
+# Статусы, после которых отчет больше не обрабатывается
+FINAL_STATUSES = ('completed', 'error', 'dead_letter')
+
+_redis_client = None
+
+def get_redis() -> redis.Redis:
+    """
+    Получить общий клиент Redis (создается лениво)
+    """
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(settings.REDIS_URL)
+    return _redis_client
+
+def _user_slot_key(user_id: int) -> str:
+    return f"adstat:reports:active:{user_id}"
+
+def acquire_user_slot(user_id: int) -> Optional[bool]:
+    """
+    Занять слот обработки для пользователя.
+    True - слот занят, False - лимит исчерпан,
+    None - Redis недоступен, обработка идет без ограничения.
+    """
+    key = _user_slot_key(user_id)
+    try:
+        client = get_redis()
+        active = client.incr(key)
+        client.expire(key, settings.REPORT_SLOT_TTL)
+        if active > settings.REPORT_USER_CONCURRENCY:
+            client.decr(key)
+            return False
+        return True
+    except redis.RedisError as e:
+        logger.warning(f"Лимит параллельной обработки не применен, Redis недоступен: {e}")
+        return None
+
+def release_user_slot(user_id: int) -> None:
+    """
+    Освободить слот обработки пользователя
+    """
+    try:
+        get_redis().decr(_user_slot_key(user_id))
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось освободить слот обработки пользователя {user_id}: {e}")
+
+def retry_countdown(attempt: int) -> int:
+    """
+    Экспоненциальная задержка перед повтором с небольшим случайным разбросом
+    """
+    delay = min(settings.REPORT_RETRY_BACKOFF_MAX, settings.REPORT_RETRY_BACKOFF_BASE * 2 ** (attempt - 1))
+    return int(delay + random.uniform(0, delay / 4))
+
+async def enqueue_report(report: Report, db: AsyncSession) -> None:
+    """
+    Поставить отчет в очередь обработки.
+    Статус "queued" фиксируется до отправки задачи, чтобы воркер не мог его перезаписать.
+    Публикация в брокер блокирующая (с повторами подключения), поэтому идет в пуле потоков.
+    """
+    task_id = uuid()
+    setattr(report, 'status', 'queued')
+    setattr(report, 'task_id', task_id)
+    await db.commit()
+
+    try:
+        await run_in_threadpool(process_report_task.apply_async, args=[report.id], task_id=task_id)
+    except Exception as e:
+        logger.error(f"Не удалось поставить отчет {report.id} в очередь: {e}")
+        setattr(report, 'status', 'error')
+        setattr(report, 'error_message', 'Очередь обработки недоступна')
+        await db.commit()
+        raise
+
+@celery_app.task(bind=True, name="reports.process", max_retries=None)
+def process_report_task(self, report_id: int):
+    """
+    Фоновая обработка отчета.
+    Повторы с экспоненциальной задержкой, после REPORT_MAX_RETRIES
+    отчет переводится в статус "dead_letter".
+    """
+    db = SessionLocal()
+    slot = None
+
+    try:
+        report = db.query(Report).filter(Report.id == report_id).first()
+        if report is None or report.status in FINAL_STATUSES:
+            return
+
+        slot = acquire_user_slot(report.user_id)
+        if slot is False:
+            # Ожидание слота не считается попыткой обработки
+            raise self.retry(countdown=settings.REPORT_SLOT_WAIT)
+
+        user = db.query(User).filter(User.id == report.user_id).first()
+        setattr(report, 'attempts', (report.attempts or 0) + 1)
+
+        try:
+            asyncio.run(process_report(db, report, str(report.file_path), user))
+        except ReportProcessingError as e:
+            setattr(report, 'status', 'error')
+            setattr(report, 'error_message', str(e))
+            db.commit()
+        except Exception as e:
+            if not db.is_active:
+                db.rollback()
+            setattr(report, 'error_message', str(e))
+
+            if report.attempts > settings.REPORT_MAX_RETRIES:
+                logger.error(f"Отчет {report_id} перемещен в dead letter после {report.attempts} попыток: {e}")
+                setattr(report, 'status', 'dead_letter')
+                db.commit()
+                return
+
+            countdown = retry_countdown(report.attempts)
+            logger.warning(f"Ошибка обработки отчета {report_id}, повтор через {countdown} с: {e}")
+            setattr(report, 'status', 'retrying')
+            db.commit()
+            raise self.retry(exc=e, countdown=countdown)
+
+    finally:
+        if slot:
+            release_user_slot(report.user_id)
+        db.close()
@@ -1,9 +1,16 @@
-import requests
+import asyncio
+import httpx
 import logging
+import time
 import urllib.parse
+from dataclasses import dataclass
 from app.core.config import settings
+from app.core.metrics import observe_external_call
+from app.core.timing import record_span, span
+from app.services.vk_client import vk_client
+from app.services.vk_rate_limiter import VK_RATE_LIMIT_ERROR_CODES, vk_rate_limiter
 from urllib.parse import urlencode
-from typing import Optional, Dict, List
+from typing import Any, Optional, Dict, List
 import json
 import base64
 import hashlib
@@ -54,13 +61,13 @@ class VKIDAuth:
             query_string = urllib.parse.urlencode(params)
             return f"https://oauth.vk.com/authorize?{query_string}"
 
-    def exchange_code_for_token(self, code: str, use_vk_id: bool = False, code_verifier: Optional[str] = None, device_id: Optional[str] = None) -> Optional[Dict]:
+    async def exchange_code_for_token(self, code: str, use_vk_id: bool = False, code_verifier: Optional[str] = None, device_id: Optional[str] = None) -> Optional[Dict]:
         if use_vk_id:
-            return self._try_vk_id_token_exchange(code, code_verifier, device_id)
+            return await self._try_vk_id_token_exchange(code, code_verifier, device_id)
         else:
-            return self._try_vk_oauth_token_exchange(code)
+            return await self._try_vk_oauth_token_exchange(code)
 
-    def _try_vk_id_token_exchange(self, code: str, code_verifier: Optional[str], device_id: Optional[str]) -> Optional[Dict]:
+    async def _try_vk_id_token_exchange(self, code: str, code_verifier: Optional[str], device_id: Optional[str]) -> Optional[Dict]:
         data = {
             'grant_type': 'authorization_code',
             'client_id': self.client_id,
@@ -79,7 +86,7 @@ class VKIDAuth:
         try:
             logger.info(f"Trying VK ID endpoint: {self.vkid_token_url}")
             logger.info(f"VK ID token exchange data: {data}")
-            response = requests.post(self.vkid_token_url, data=data, headers=headers)
+            response = await vk_client.post(self.vkid_token_url, data=data, headers=headers)
             logger.info(f"VK ID Response status: {response.status_code}")
             logger.info(f"VK ID Response text: {response.text}")
             if response.status_code == 200:
@@ -98,11 +105,11 @@ class VKIDAuth:
                     }
                 else:
                     logger.warning(f"No access_token in VK ID response: {result}")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"VK ID request failed: {e}")
         return None
 
-    def _try_vk_oauth_token_exchange(self, code: str) -> Optional[Dict]:
+    async def _try_vk_oauth_token_exchange(self, code: str) -> Optional[Dict]:
         data = {
             'grant_type': 'authorization_code',
             'client_id': self.client_id,
@@ -116,7 +123,7 @@ class VKIDAuth:
         }
         try:
             logger.info(f"Trying VK OAuth endpoint: {self.vk_token_url}")
-            response = requests.post(self.vk_token_url, data=data, headers=headers)
+            response = await vk_client.post(self.vk_token_url, data=data, headers=headers)
             logger.info(f"VK OAuth Response status: {response.status_code}")
             logger.info(f"VK OAuth Response text: {response.text}")
             if response.status_code == 200:
@@ -134,21 +141,21 @@ class VKIDAuth:
                     }
                 else:
                     logger.warning(f"No access_token in VK OAuth response: {result}")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"VK OAuth request failed: {e}")
         return None
 
-    def get_user_info(self, access_token: str, token_source: str = 'vk_oauth') -> Optional[Dict]:
-        return self._get_vk_oauth_user_info(access_token)
+    async def get_user_info(self, access_token: str, token_source: str = 'vk_oauth') -> Optional[Dict]:
+        return await self._get_vk_oauth_user_info(access_token)
 
-    def _get_vk_oauth_user_info(self, access_token: str) -> Optional[Dict]:
+    async def _get_vk_oauth_user_info(self, access_token: str) -> Optional[Dict]:
         params = {
             'access_token': access_token,
             'v': '5.131',
             'fields': 'photo_50,photo_100,photo_200,email'
         }
         try:
-            response = requests.get(self.vk_api_url, params=params)
+            response = await vk_client.get(self.vk_api_url, params=params)
             if response.status_code == 200:
                 result = response.json()
                 if 'response' in result and result['response']:
@@ -168,11 +175,11 @@ class VKIDAuth:
                     }
                 else:
                     logger.error(f"Invalid VK API response: {result}")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"VK API request failed: {e}")
         return None
 
-    def refresh_token(self, refresh_token: str) -> Optional[Dict]:
+    async def refresh_token(self, refresh_token: str) -> Optional[Dict]:
         # VK OAuth не поддерживает refresh_token
         return None
 
@@ -200,7 +207,7 @@ def get_vk_id_auth_url() -> str:
     )
     return vk_auth.get_auth_url(scope="phone email ads", state="vk_oauth")
 
-def exchange_vk_code_for_tokens(code: str) -> dict:
+async def exchange_vk_code_for_tokens(code: str) -> dict:
     """
     Обменять код авторизации на токены через VK OAuth API
     Использует правильные endpoints с fallback механизмом
@@ -211,7 +218,7 @@ def exchange_vk_code_for_tokens(code: str) -> dict:
         redirect_uri=settings.VK_REDIRECT_URI
     )
     
-    result = vk_auth.exchange_code_for_token(code)
+    result = await vk_auth.exchange_code_for_token(code)
     
     if not result:
         raise Exception("Не удалось обменять код на токены через VK OAuth API")
@@ -224,7 +231,7 @@ def exchange_vk_code_for_tokens(code: str) -> dict:
         'source': result.get('source', 'vk_oauth')
     }
 
-def get_vk_user_info(access_token: str, token_source: str = 'vk_oauth') -> Optional[Dict]:
+async def get_vk_user_info(access_token: str, token_source: str = 'vk_oauth') -> Optional[Dict]:
     """
     Получить информацию о пользователе через VK API
     """
@@ -234,136 +241,219 @@ def get_vk_user_info(access_token: str, token_source: str = 'vk_oauth') -> Optio
         redirect_uri=settings.VK_REDIRECT_URI
     )
     
-    result = vk_auth.get_user_info(access_token, token_source)
+    result = await vk_auth.get_user_info(access_token, token_source)
     
     if result and result.get('success'):
         return result['user']
     
     return None
 
-def get_vk_ad_campaigns(access_token: str) -> list:
-    """
-    Получить последние 10 рекламных кампаний VK и их статистику.
-    Возвращает список словарей с нужными полями.
-    """
-    # Сначала получаем список рекламных аккаунтов
-    accounts_url = 'https://api.vk.com/method/ads.getAccounts'
-    headers = {
+VK_API_URL = 'https://api.vk.com/method'
+VK_ADS_STATS_URL = 'https://ads.vk.com/api/v2/statistics/ad_plans/day.json'
+
+class VKAPIError(Exception):
+    """Ошибка ответа VK API"""
+    
+    def __init__(self, message: str, error_code: Optional[int] = None):
+        super().__init__(message)
+        self.error_code = error_code
+
+def _auth_headers(access_token: str) -> Dict[str, str]:
+    return {
         'Authorization': f'Bearer {access_token}',
         'Accept': 'application/json'
     }
-    
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
     try:
-        # Получаем аккаунты
-        accounts_resp = requests.get(accounts_url, headers=headers)
-        if accounts_resp.status_code != 200:
-            logger.error(f"Ошибка получения аккаунтов VK: {accounts_resp.status_code} {accounts_resp.text}")
-            return []
-        
-        accounts_data = accounts_resp.json()
-        if 'error' in accounts_data:
-            logger.error(f"Ошибка VK API: {accounts_data['error']}")
-            return []
-        
-        accounts = accounts_data.get('response', [])
-        if not accounts:
-            logger.error("Нет доступных рекламных аккаунтов")
-            return []
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
+
+async def _scheduled_get(method: str, url: str, access_token: str, params: Optional[Dict] = None) -> httpx.Response:
+    """
+    GET-запрос к VK через планировщик квот.
+    При ответе о превышении лимита (HTTP 429 или код ошибки VK) запрос повторяется
+    после паузы; если попытки исчерпаны, возвращается последний ответ.
+    """
+    attempt = 0
+    while True:
+        with span('vk_quota'):
+            await vk_rate_limiter.acquire(access_token, method)
+        started = time.perf_counter()
+        try:
+            response = await vk_client.get(url, headers=_auth_headers(access_token), params=params)
+        except httpx.HTTPError:
+            observe_external_call('vk', method, time.perf_counter() - started, 'transport')
+            raise
+        elapsed = time.perf_counter() - started
+        record_span('vk', elapsed)
         
-        # Берем первый аккаунт
-        account_id = accounts[0]['account_id']
-        logger.info(f"Используем аккаунт: {account_id}")
+        retry_after = None
+        if response.status_code == 429:
+            observe_external_call('vk', method, elapsed, 'rate_limited')
+            retry_after = _retry_after(response)
+        elif response.status_code == 200:
+            try:
+                error = response.json().get('error')
+            except ValueError:
+                error = None
+            if not (isinstance(error, dict) and error.get('error_code') in VK_RATE_LIMIT_ERROR_CODES):
+                observe_external_call('vk', method, elapsed, 'api_error' if error else None)
+                return response
+            observe_external_call('vk', method, elapsed, 'rate_limited')
+        else:
+            observe_external_call('vk', method, elapsed, f"http_{response.status_code}")
+            return response
         
-        # Получаем кампании
-        campaigns_url = 'https://api.vk.com/method/ads.getCampaigns'
+        if attempt >= settings.VK_RATE_LIMIT_MAX_RETRIES:
+            return response
+        await asyncio.sleep(await vk_rate_limiter.throttled(access_token, method, attempt, retry_after))
+        attempt += 1
+
+async def call_vk_api(method: str, access_token: str, params: Optional[Dict] = None) -> Any:
+    """
+    Вызвать метод VK API и вернуть поле response.
+    Ошибки HTTP и VK API поднимаются как VKAPIError.
+    """
+    response = await _scheduled_get(method, f"{VK_API_URL}/{method}", access_token, params)
+    if response.status_code != 200:
+        raise VKAPIError(f"{method}: HTTP {response.status_code} {response.text}")
+    
+    data = response.json()
+    if 'error' in data:
+        error = data['error']
+        raise VKAPIError(f"{method}: {error}", error.get('error_code') if isinstance(error, dict) else None)
+    return data.get('response', [])
+
+async def _fetch_campaign_pages(access_token: str, account_id: Any, client_id: Any = None) -> List[Dict]:
+    """
+    Получить все кампании аккаунта (или клиента агентства) постранично.
+    Общее число кампаний VK не сообщает, поэтому после первой полной страницы
+    следующие запрашиваются параллельно волнами по VK_CAMPAIGNS_PAGES_CONCURRENCY,
+    пока не придет неполная страница. Все запросы проходят через планировщик квот.
+    """
+    page_size = settings.VK_CAMPAIGNS_PAGE_SIZE
+    
+    async def fetch_page(offset: int) -> List[Dict]:
         params = {
             'account_id': account_id,
             'include_deleted': 0,
-            'limit': 10
+            'limit': page_size,
+            'offset': offset
         }
-        
-        campaigns_resp = requests.get(campaigns_url, headers=headers, params=params)
-        if campaigns_resp.status_code != 200:
-            logger.error(f"Ошибка получения кампаний VK: {campaigns_resp.status_code} {campaigns_resp.text}")
+        if client_id is not None:
+            params['client_id'] = client_id
+        return await call_vk_api('ads.getCampaigns', access_token, params)
+    
+    campaigns = await fetch_page(0)
+    if len(campaigns) < page_size:
+        return campaigns
+    
+    wave = max(settings.VK_CAMPAIGNS_PAGES_CONCURRENCY, 1)
+    offset = page_size
+    while True:
+        offsets = [offset + i * page_size for i in range(wave)]
+        # Страницы складываются в порядке смещений; за неполной страницей данных уже нет
+        for page in await asyncio.gather(*(fetch_page(page_offset) for page_offset in offsets)):
+            campaigns.extend(page)
+            if len(page) < page_size:
+                return campaigns
+        offset += wave * page_size
+
+async def fetch_campaign_stats(
+    access_token: str,
+    campaign_ids: List[str],
+    date_from: str,
+    date_to: str
+) -> List[Dict]:
+    """
+    Получить дневную статистику кампаний за период (даты в формате YYYY-MM-DD);
+    идентификаторы отправляются пачками параллельно
+    """
+    batch_size = settings.VK_STATS_IDS_PER_REQUEST
+    
+    async def fetch_batch(ids: List[str]) -> List[Dict]:
+        # Используем VK Ads API v2 для получения статистики
+        stats_params = {
+            'id': ','.join(ids),
+            'date_from': date_from,
+            'date_to': date_to,
+            'metrics': 'base'
+        }
+        response = await _scheduled_get('statistics', VK_ADS_STATS_URL, access_token, stats_params)
+        if response.status_code != 200:
+            logger.error(f"Ошибка получения статистики: {response.status_code} {response.text}")
             return []
-        
-        campaigns_data = campaigns_resp.json()
-        if 'error' in campaigns_data:
-            logger.error(f"Ошибка VK API: {campaigns_data['error']}")
+        try:
+            return response.json().get('items', [])
+        except Exception as e:
+            logger.error(f"Ошибка парсинга статистики: {e}")
             return []
-        
-        campaigns = campaigns_data.get('response', [])
-        result = []
-        
-        # Получаем статистику для всех кампаний сразу
-        if campaigns:
-            campaign_ids = [str(camp.get('id')) for camp in campaigns if camp.get('id')]
-            if campaign_ids:
-                # Используем VK Ads API v2 для получения статистики
-                stats_url = 'https://ads.vk.com/api/v2/statistics/ad_plans/day.json'
-                stats_params = {
-                    'id': ','.join(campaign_ids),
-                    'date_from': '2024-01-01',
-                    'date_to': '2024-12-31',
-                    'metrics': 'base'
-                }
-                
-                stats_resp = requests.get(stats_url, headers=headers, params=stats_params)
-                stats_data = {}
-                if stats_resp.status_code == 200:
-                    try:
-                        stats_data = stats_resp.json()
-                        logger.info(f"Получена статистика: {stats_data}")
-                    except Exception as e:
-                        logger.error(f"Ошибка парсинга статистики: {e}")
-                else:
-                    logger.error(f"Ошибка получения статистики: {stats_resp.status_code} {stats_resp.text}")
-        
-        for camp in campaigns:
-            camp_id = camp.get('id')
-            camp_stats = {}
-            
-            # Ищем статистику для этой кампании
-            if 'items' in stats_data:
-                for item in stats_data['items']:
-                    if item.get('id') == camp_id:
-                        if 'rows' in item and item['rows']:
-                            # Берем последнюю строку статистики
-                            camp_stats = item['rows'][-1]
-                        break
-            
-            result.append({
-                'id': camp_id,
-                'name': camp.get('name', 'Без названия'),
-                'created': camp.get('create_time'),
-                'status': camp.get('status'),
-                'report_from': camp_stats.get('date'),
-                'report_to': camp_stats.get('date'),
-                'impressions': camp_stats.get('shows', 0),
-                'clicks': camp_stats.get('clicks', 0),
-                'subscribers': 0,  # VK не предоставляет эту метрику напрямую
-                'spent': camp_stats.get('spent', 0),
-                'cpc': camp_stats.get('cpc', 0),
-                'ctr': camp_stats.get('ctr', 0),
-            })
-        
-        return result
-    except Exception as e:
-        logger.error(f"Ошибка при получении кампаний VK: {e}")
-        return []
+    
+    batches = [campaign_ids[i:i + batch_size] for i in range(0, len(campaign_ids), batch_size)]
+    results = await asyncio.gather(*(fetch_batch(batch) for batch in batches))
+    return [item for items in results for item in items]
+
+@dataclass(slots=True, frozen=True)
+class CampaignStatsRecord:
+    """Кампания VK со статистикой - общий формат для эндпоинтов, экспорта и кеша"""
+    id: int
+    account_id: int
+    name: str
+    created: Optional[str]
+    status: Optional[int]
+    report_from: Optional[str]
+    report_to: Optional[str]
+    impressions: int
+    clicks: int
+    spent: float
+    cpc: float
+    ctr: float
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'account_id': self.account_id,
+            'name': self.name,
+            'created': self.created,
+            'status': self.status,
+            'report_from': self.report_from,
+            'report_to': self.report_to,
+            'impressions': self.impressions,
+            'clicks': self.clicks,
+            'subscribers': 0,  # VK не предоставляет эту метрику напрямую
+            'spent': self.spent,
+            'cpc': self.cpc,
+            'ctr': self.ctr,
+        }
+
+async def fetch_account_campaign_list(access_token: str, account: Dict) -> List[Dict]:
+    """
+    Получить все кампании рекламного аккаунта (без статистики).
+    Для агентских аккаунтов кампании клиентов запрашиваются параллельно.
+    """
+    account_id = account['account_id']
+    if account.get('account_type') == 'agency':
+        clients = await call_vk_api('ads.getClients', access_token, {'account_id': account_id})
+        pages = await asyncio.gather(*(
+            _fetch_campaign_pages(access_token, account_id, client.get('id')) for client in clients
+        ))
+        return [camp for page in pages for camp in page]
+    return await _fetch_campaign_pages(access_token, account_id)
 
 # Простая функция для быстрого тестирования
-def quick_vk_token_exchange(code: str) -> Optional[Dict]:
+async def quick_vk_token_exchange(code: str) -> Optional[Dict]:
     """
     Быстрая функция для обмена кода на токен
     """
     try:
-        return exchange_vk_code_for_tokens(code)
+        return await exchange_vk_code_for_tokens(code)
     except Exception as e:
         logger.error(f"Quick VK token exchange failed: {e}")
         return None
 
-def handle_vk_callback(code: str, error: Optional[str] = None) -> Dict:
+async def handle_vk_callback(code: str, error: Optional[str] = None) -> Dict:
     """
     Обработчик callback для VK OAuth
     """
@@ -387,7 +477,7 @@ def handle_vk_callback(code: str, error: Optional[str] = None) -> Dict:
     )
     
     # Обмен кода на токен
-    token_data = vk_auth.exchange_code_for_token(code)
+    token_data = await vk_auth.exchange_code_for_token(code)
     
     if not token_data or not token_data.get('success'):
         return {
@@ -400,7 +490,7 @@ def handle_vk_callback(code: str, error: Optional[str] = None) -> Dict:
     token_source = token_data.get('source', 'vk_oauth')
     
     # Получение информации о пользователе
-    user_info = vk_auth.get_user_info(access_token, token_source)
+    user_info = await vk_auth.get_user_info(access_token, token_source)
     
     if not user_info or not user_info.get('success'):
         return {
@@ -416,7 +506,7 @@ def handle_vk_callback(code: str, error: Optional[str] = None) -> Dict:
         "source": token_source
     }
 
-def handle_vk_id_callback(request_args: Dict) -> Dict:
+async def handle_vk_id_callback(request_args: Dict) -> Dict:
     """
     Обработчик callback для VK ID
     Args:
@@ -444,7 +534,7 @@ def handle_vk_id_callback(request_args: Dict) -> Dict:
         }
     device_id = request_args.get('device_id')
     # Обмен кода на токен
-    token_data = vk_auth.exchange_code_for_token(code, use_vk_id=True, code_verifier=request_args.get('code_verifier'), device_id=device_id)
+    token_data = await vk_auth.exchange_code_for_token(code, use_vk_id=True, code_verifier=request_args.get('code_verifier'), device_id=device_id)
     if not token_data or not token_data.get('success'):
         return {
             "success": False,
@@ -453,7 +543,7 @@ def handle_vk_id_callback(request_args: Dict) -> Dict:
         }
     access_token = token_data['access_token']
     token_source = token_data.get('source', 'vk_id')
-    user_info = vk_auth.get_user_info(access_token, token_source)
+    user_info = await vk_auth.get_user_info(access_token, token_source)
     if not user_info or not user_info.get('success'):
         return {
             "success": False,
@@ -478,7 +568,7 @@ def test_vk_auth_urls():
     print(f"VK ID URL: {vk_id_url}")
     
     try:
-        response = requests.get(vk_id_url, allow_redirects=False)
+        response = httpx.get(vk_id_url, follow_redirects=False)
         print(f"VK ID Status: {response.status_code}")
         if response.status_code == 302:
             print("✅ VK ID URL работает!")
@@ -492,7 +582,7 @@ def test_vk_auth_urls():
     print(f"\nVK OAuth URL: {vk_oauth_url}")
     
     try:
-        response = requests.get(vk_oauth_url, allow_redirects=False)
+        response = httpx.get(vk_oauth_url, follow_redirects=False)
         print(f"VK OAuth Status: {response.status_code}")
         if response.status_code == 302:
             print("✅ VK OAuth URL работает!")
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from typing import Optional
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+class VKClient:
+    """
+    Общий асинхронный HTTP клиент для запросов к VK.
+    Держит пул keep-alive соединений, задает таймауты и ограничивает
+    число одновременных запросов.
+    """
+
+    def __init__(
+        self,
+        timeout: float,
+        max_connections: int,
+        max_keepalive: int,
+        max_concurrency: int,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.max_concurrency = max_concurrency
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Клиент и семафор привязаны к циклу событий: в воркерах Celery
+        # цикл создается заново для каждой задачи
+        loop = asyncio.get_running_loop()
+        if self._client is not None and self._loop is not loop:
+            self._release(self._client, self._loop)
+            self._client = None
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive
+                ),
+                headers={'Accept': 'application/json'},
+                transport=self.transport
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._client
+
+    @staticmethod
+    def _release(client: httpx.AsyncClient, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Закрыть клиент, оставшийся от другого цикла событий.
+        Соединения можно закрыть только в их цикле, поэтому закрытый цикл
+        должен закрывать клиент сам (см. aclose и run_closing).
+        """
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        elif not client.is_closed:
+            logger.warning("Клиент VK не закрыт до завершения своего цикла событий, соединения пула потеряны")
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        client = self._get_client()
+        async with self._semaphore:
+            return await client.request(method, url, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', url, **kwargs)
+
+    async def aclose(self) -> None:
+        """
+        Закрыть пул соединений (при остановке приложения)
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._loop = None
+
+    def run_closing(self, coro):
+        """
+        Выполнить корутину в новом цикле событий (asyncio.run) и закрыть клиент
+        до завершения цикла. Для задач Celery, где цикл создается на каждую задачу.
+        """
+        async def run():
+            try:
+                return await coro
+            finally:
+                await self.aclose()
+        return asyncio.run(run())
+
+vk_client = VKClient(
+    timeout=settings.VK_HTTP_TIMEOUT,
+    max_connections=settings.VK_HTTP_MAX_CONNECTIONS,
+    max_keepalive=settings.VK_HTTP_MAX_KEEPALIVE,
+    max_concurrency=settings.VK_HTTP_MAX_CONCURRENCY
+)
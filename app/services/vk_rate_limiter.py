@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Callable, Dict, Optional
+
+import redis
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.services.report_tasks import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Коды ошибок VK API, означающие превышение лимитов
+# 6 - слишком много запросов в секунду, 9 - flood control,
+# 29 - достигнут количественный лимит метода, 601 - превышен лимит рекламного API
+VK_RATE_LIMIT_ERROR_CODES = {6, 9, 29, 601}
+
+def get_method_class(method: str) -> str:
+    """
+    Класс метода VK для учета квоты: статистика, рекламный API или прочие методы
+    """
+    if method == 'statistics' or method.startswith('ads.getStatistics') or method.startswith('ads.getDemographics'):
+        return 'stats'
+    if method.startswith('ads.'):
+        return 'ads'
+    return 'default'
+
+# Общее ведро в Redis (GCRA): ключ хранит теоретическое время, когда ведро снова будет полным
+# минус один интервал. Резервирование атомарно и видно всем процессам (uvicorn и Celery).
+# ARGV: интервал между запросами (1 / rate), запас burst
+_RESERVE_SCRIPT = """
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tat = math.max(tonumber(redis.call('GET', KEYS[1])) or now, now) + interval
+redis.call('SET', KEYS[1], string.format('%.6f', tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+return string.format('%.6f', math.max(tat - burst * interval - now, 0))
+"""
+
+# Пауза общего ведра: первый запрос после нее пройдет не раньше чем через ARGV[3] секунд,
+# накопленный запас сгорает
+_PAUSE_SCRIPT = """
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tat = math.max(tonumber(redis.call('GET', KEYS[1])) or now, now + tonumber(ARGV[3]) + (burst - 1) * interval)
+redis.call('SET', KEYS[1], string.format('%.6f', tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+return 1
+"""
+
+# Сколько секунд после ошибки Redis планировщик работает только с локальными ведрами
+SHARED_RETRY_INTERVAL = 30.0
+
+class TokenBucket:
+    """
+    Ведро токенов с резервированием: запрос, которому не хватило токена,
+    получает время ожидания своей очереди. Проверка и резервирование выполняются
+    без await, поэтому в пределах одного цикла событий блокировка не нужна.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self) -> float:
+        """
+        Зарезервировать токен и вернуть, сколько секунд нужно подождать
+        """
+        now = time.monotonic()
+        start = max(now, self.paused_until)
+        if start > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (start - self.updated_at) * self.rate)
+            self.updated_at = start
+        self.tokens -= 1
+        wait = start - now
+        if self.tokens < 0:
+            wait += -self.tokens / self.rate
+        return wait
+
+    def pause(self, seconds: float) -> None:
+        """
+        Приостановить выдачу токенов (после ответа VK о превышении лимита)
+        """
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        # Уже накопленные токены не действуют: VK только что отказал
+        self.tokens = min(self.tokens, 0.0)
+        self.updated_at = max(self.updated_at, self.paused_until)
+
+class VKRateLimiter:
+    """
+    Планировщик запросов к VK с учетом квот.
+    Для каждой пары (токен, класс метода) ведется свое ведро токенов; запросы сверх
+    квоты ждут своей очереди, а ошибки превышения лимита приостанавливают ведро.
+    С redis_client ведра общие для всех процессов (квота VK считается на токен, а запросы
+    идут из нескольких воркеров uvicorn и Celery); пока Redis недоступен, используются
+    ведра процесса, и суммарная скорость может превышать квоту в число процессов раз.
+    """
+
+    def __init__(
+        self,
+        rates: Dict[str, float],
+        burst: int,
+        max_buckets: int = 10000,
+        idle_ttl: float = 3600,
+        redis_client: Optional[Callable[[], redis.Redis]] = None
+    ):
+        self.rates = rates
+        self.burst = burst
+        self._buckets = TTLCache(maxsize=max_buckets, ttl=idle_ttl)
+        self._redis_client = redis_client
+        self._shared_retry_at = 0.0
+        self.queue_depth = 0
+        self.throttled_total: Dict[str, int] = {}
+        self.waited_seconds_total = 0.0
+
+    @staticmethod
+    def _token_key(access_token: str) -> str:
+        # Сам токен не храним ни в памяти, ни в Redis, только его хеш
+        return hashlib.sha256(access_token.encode('utf-8')).hexdigest()[:16]
+
+    def _rate(self, method_class: str) -> float:
+        return self.rates.get(method_class, self.rates['default'])
+
+    def _bucket(self, access_token: str, method_class: str) -> TokenBucket:
+        key = (self._token_key(access_token), method_class)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate=self._rate(method_class), burst=self.burst)
+        # Повторная запись продлевает время жизни ведра
+        self._buckets.set(key, bucket)
+        return bucket
+
+    def _shared(self, script: str, access_token: str, method_class: str, *args) -> Optional[str]:
+        """
+        Выполнить скрипт над общим ведром в Redis; None - общего ведра нет или Redis недоступен
+        """
+        if self._redis_client is None or time.monotonic() < self._shared_retry_at:
+            return None
+        key = f"adstat:vk:quota:{self._token_key(access_token)}:{method_class}"
+        try:
+            return self._redis_client().eval(script, 1, key, 1 / self._rate(method_class), self.burst, *args)
+        except redis.RedisError as e:
+            self._shared_retry_at = time.monotonic() + SHARED_RETRY_INTERVAL
+            logger.warning(f"Общие квоты VK недоступны, используются квоты процесса: {e}")
+            return None
+
+    async def acquire(self, access_token: str, method: str) -> None:
+        """
+        Дождаться разрешения на запрос метода VK
+        """
+        method_class = get_method_class(method)
+        wait = None
+        if self._redis_client is not None:
+            shared_wait = await run_in_threadpool(self._shared, _RESERVE_SCRIPT, access_token, method_class)
+            if shared_wait is not None:
+                wait = float(shared_wait)
+        if wait is None:
+            wait = self._bucket(access_token, method_class).reserve()
+        if wait <= 0:
+            return
+        self.queue_depth += 1
+        self.waited_seconds_total += wait
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            self.queue_depth -= 1
+
+    async def throttled(self, access_token: str, method: str, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Учесть ответ VK о превышении лимита и вернуть паузу перед повтором
+        """
+        method_class = get_method_class(method)
+        self.throttled_total[method_class] = self.throttled_total.get(method_class, 0) + 1
+        delay = retry_after if retry_after is not None else min(
+            settings.VK_RATE_LIMIT_BACKOFF_BASE * (2 ** attempt),
+            settings.VK_RATE_LIMIT_BACKOFF_MAX
+        )
+        self._bucket(access_token, method_class).pause(delay)
+        if self._redis_client is not None:
+            await run_in_threadpool(self._shared, _PAUSE_SCRIPT, access_token, method_class, delay)
+        logger.warning(f"VK ограничил запросы {method} ({method_class}), пауза {delay:.1f} с")
+        return delay
+
+    def snapshot(self) -> Dict:
+        """
+        Текущие метрики планировщика
+        """
+        return {
+            "queue_depth": self.queue_depth,
+            "throttled_total": dict(self.throttled_total),
+            "waited_seconds_total": round(self.waited_seconds_total, 3),
+            "buckets": len(self._buckets)
+        }
+
+vk_rate_limiter = VKRateLimiter(
+    rates={
+        'default': settings.VK_RATE_LIMIT_DEFAULT_RPS,
+        'ads': settings.VK_RATE_LIMIT_ADS_RPS,
+        'stats': settings.VK_RATE_LIMIT_STATS_RPS
+    },
+    burst=settings.VK_RATE_LIMIT_BURST,
+    redis_client=get_redis if settings.VK_RATE_LIMIT_SHARED else None
+)
@@ -0,0 +1,81 @@
+from datetime import date
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_
+from sqlalchemy.orm import Session
+
+from app.models.vk_stats import VKAdAccount, VKCampaignStat
+
+# Период агрегации pandas для каждой детализации; неделя начинается с понедельника
+GRANULARITY_PERIODS = {
+    'day': 'D',
+    'week': 'W-SUN',
+    'month': 'M'
+}
+
+METRIC_COLUMNS = ['impressions', 'clicks', 'spent']
+
+def _add_rates(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Посчитать CTR (%) и CPC для всех строк сразу; при нулевом знаменателе - 0
+    """
+    impressions = frame['impressions'].to_numpy(dtype=float)
+    clicks = frame['clicks'].to_numpy(dtype=float)
+    spent = frame['spent'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frame['ctr'] = np.where(impressions > 0, clicks / impressions * 100, 0.0).round(2)
+        frame['cpc'] = np.where(clicks > 0, spent / clicks, 0.0).round(2)
+    return frame
+
+def aggregate_vk_stats(
+    db: Session,
+    user_id: int,
+    date_from: date,
+    date_to: date,
+    granularity: str = 'day',
+    campaign_ids: Optional[List[int]] = None
+) -> Dict[str, Any]:
+    """
+    Агрегировать локальную статистику кампаний пользователя за период
+    с детализацией по дням, неделям или месяцам
+    """
+    query = db.query(
+        VKCampaignStat.account_id,
+        VKCampaignStat.campaign_id,
+        VKCampaignStat.date,
+        VKCampaignStat.impressions,
+        VKCampaignStat.clicks,
+        VKCampaignStat.spent
+    ).join(
+        VKAdAccount,
+        and_(VKAdAccount.account_id == VKCampaignStat.account_id, VKAdAccount.user_id == user_id)
+    ).filter(
+        VKCampaignStat.date >= date_from,
+        VKCampaignStat.date <= date_to
+    )
+    if campaign_ids:
+        query = query.filter(VKCampaignStat.campaign_id.in_(campaign_ids))
+
+    frame = pd.read_sql(query.statement, db.connection())
+    if frame.empty:
+        return {'items': [], 'totals': {'impressions': 0, 'clicks': 0, 'spent': 0.0, 'ctr': 0.0, 'cpc': 0.0}}
+
+    frame[METRIC_COLUMNS] = frame[METRIC_COLUMNS].fillna(0).astype(float)
+    frame['period'] = pd.to_datetime(frame['date']).dt.to_period(GRANULARITY_PERIODS[granularity]).dt.start_time
+
+    grouped = frame.groupby(['account_id', 'campaign_id', 'period'], as_index=False, sort=True)[METRIC_COLUMNS].sum()
+    grouped = _add_rates(grouped)
+    grouped['period'] = grouped['period'].dt.strftime('%Y-%m-%d')
+    grouped[['impressions', 'clicks']] = grouped[['impressions', 'clicks']].astype('int64')
+    grouped['spent'] = grouped['spent'].round(2)
+
+    totals = _add_rates(frame[METRIC_COLUMNS].sum().to_frame().T)
+    totals[['impressions', 'clicks']] = totals[['impressions', 'clicks']].astype('int64')
+    totals['spent'] = totals['spent'].round(2)
+
+    return {
+        'items': grouped.to_dict(orient='records'),
+        'totals': totals.to_dict(orient='records')[0]
+    }
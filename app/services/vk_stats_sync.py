@@ -0,0 +1,306 @@
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import redis
+from sqlalchemy import and_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core.celery_app import celery_app
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.user import User
+from app.models.vk_stats import VKAdAccount, VKCampaign, VKCampaignStat
+from app.services.report_tasks import get_redis
+from app.services.vk_ads import CampaignStatsRecord, call_vk_api, fetch_account_campaign_list, fetch_campaign_stats
+from app.services.vk_client import vk_client
+
+logger = logging.getLogger(__name__)
+
+def _parse_date(value) -> Optional[date]:
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except (TypeError, ValueError):
+        return None
+
+def _stat_rows(account_id: int, stats_items: List[Dict], date_from: date, date_to: date) -> List[Dict]:
+    """
+    Преобразовать ответ статистики VK в строки таблицы vk_campaign_stats
+    (строки вне запрошенного периода отбрасываются)
+    """
+    rows = []
+    for item in stats_items:
+        for row in item.get('rows') or []:
+            day = _parse_date(row.get('date'))
+            if day is None or not date_from <= day <= date_to:
+                continue
+            rows.append({
+                'account_id': account_id,
+                'campaign_id': int(item['id']),
+                'date': day,
+                'impressions': int(row.get('shows') or 0),
+                'clicks': int(row.get('clicks') or 0),
+                'spent': Decimal(str(row.get('spent') or 0))
+            })
+    return rows
+
+async def _fetch_account(access_token: str, account: Dict, date_from: date, date_to: date) -> Dict:
+    campaigns = await fetch_account_campaign_list(access_token, account)
+    campaign_ids = [str(camp.get('id')) for camp in campaigns if camp.get('id')]
+    stats_items = await fetch_campaign_stats(
+        access_token, campaign_ids, date_from.isoformat(), date_to.isoformat()
+    ) if campaign_ids else []
+    return {'campaigns': campaigns, 'stats_items': stats_items}
+
+def _user_sync_key(user_id: int) -> str:
+    return f"adstat:vk:sync:{user_id}"
+
+def _account_lock_key(account_id: int) -> str:
+    return f"adstat:vk:sync:account:{account_id}"
+
+def acquire_account_lock(account_id: int) -> Optional[bool]:
+    """
+    Занять запись статистики рекламного аккаунта (аккаунт может быть общим у нескольких пользователей).
+    True - аккаунт занят нами, False - его записывает другая синхронизация,
+    None - Redis недоступен, запись идет без блокировки.
+    """
+    try:
+        return bool(get_redis().set(_account_lock_key(account_id), 1, nx=True, ex=settings.VK_STATS_STORE_LOCK_TTL))
+    except redis.RedisError as e:
+        logger.warning(f"Блокировка аккаунта VK {account_id} не применена, Redis недоступен: {e}")
+        return None
+
+def release_account_lock(account_id: int) -> None:
+    try:
+        get_redis().delete(_account_lock_key(account_id))
+    except redis.RedisError as e:
+        logger.warning(f"Не удалось снять блокировку аккаунта VK {account_id}: {e}")
+
+def _store_account(db: Session, state: VKAdAccount, fetched: Dict, date_from: date, date_to: date) -> int:
+    """
+    Сохранить кампании и статистику аккаунта и сдвинуть водяной знак (одна транзакция)
+    """
+    account_id = state.account_id
+    existing = {
+        camp.campaign_id: camp
+        for camp in db.query(VKCampaign).filter(VKCampaign.account_id == account_id)
+    }
+    for camp in fetched['campaigns']:
+        if not camp.get('id'):
+            continue
+        record = existing.get(int(camp['id']))
+        if record is None:
+            record = VKCampaign(account_id=account_id, campaign_id=int(camp['id']))
+            db.add(record)
+        record.name = camp.get('name', 'Без названия')
+        record.status = camp.get('status')
+        record.create_time = camp.get('create_time')
+
+    # Перезаписываем загруженный период: статистика последнего дня могла быть неполной
+    db.query(VKCampaignStat).filter(
+        VKCampaignStat.account_id == account_id,
+        VKCampaignStat.date >= date_from,
+        VKCampaignStat.date <= date_to
+    ).delete(synchronize_session=False)
+    rows = _stat_rows(account_id, fetched['stats_items'], date_from, date_to)
+    if rows:
+        db.bulk_insert_mappings(VKCampaignStat, rows)
+
+    state.stats_synced_through = date_to
+    state.synced_at = datetime.utcnow()
+    db.commit()
+    return len(rows)
+
+async def _run_sync(db: Union[Session, AsyncSession], fn: Callable, *args):
+    # Синхронизация вызывается и из воркера Celery (Session), и из API (AsyncSession)
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args)
+    return fn(db, *args)
+
+def _prepare_accounts(db: Session, user_id: int, accounts: List[Dict], date_to: date) -> Tuple[Dict, Dict]:
+    """
+    Обновить список аккаунтов пользователя и определить период загрузки для каждого
+    """
+    states = {
+        state.account_id: state
+        for state in db.query(VKAdAccount).filter(VKAdAccount.user_id == user_id)
+    }
+
+    # Аккаунты, к которым у пользователя больше нет доступа
+    account_ids = {int(account['account_id']) for account in accounts}
+    for account_id, state in list(states.items()):
+        if account_id not in account_ids:
+            db.delete(state)
+            del states[account_id]
+
+    periods = {}
+    for account in accounts:
+        account_id = int(account['account_id'])
+        state = states.get(account_id)
+        if state is None:
+            state = VKAdAccount(user_id=user_id, account_id=account_id)
+            db.add(state)
+            states[account_id] = state
+        state.account_type = account.get('account_type')
+        periods[account_id] = state.stats_synced_through or date_to - timedelta(days=settings.VK_STATS_INITIAL_DAYS)
+    db.commit()
+    return states, periods
+
+async def sync_user_vk_stats(db: Union[Session, AsyncSession], user: User) -> int:
+    """
+    Инкрементально синхронизировать статистику VK пользователя в локальную базу.
+    Для каждого аккаунта загружаются только дни начиная с водяного знака
+    (сам день водяного знака загружается повторно). Возвращает число записанных строк.
+    """
+    access_token = user.vk_access_token
+    accounts = await call_vk_api('ads.getAccounts', access_token)
+    date_to = datetime.utcnow().date()
+    states, periods = await _run_sync(db, _prepare_accounts, user.id, accounts, date_to)
+
+    semaphore = asyncio.Semaphore(settings.VK_ACCOUNTS_CONCURRENCY)
+
+    async def fetch(account: Dict):
+        account_id = int(account['account_id'])
+        async with semaphore:
+            try:
+                return account_id, await _fetch_account(access_token, account, periods[account_id], date_to)
+            except Exception as e:
+                # Водяной знак аккаунта не сдвигается, период будет загружен при следующей синхронизации
+                logger.error(f"Ошибка синхронизации статистики аккаунта {account_id}: {e}")
+                return account_id, None
+
+    written = 0
+    for next_result in asyncio.as_completed([fetch(account) for account in accounts]):
+        account_id, fetched = await next_result
+        if fetched is None:
+            continue
+        locked = acquire_account_lock(account_id)
+        if locked is False:
+            # Те же строки сейчас перезаписывает синхронизация другого пользователя аккаунта
+            logger.info(f"Статистика аккаунта {account_id} уже записывается, пропускаем")
+            continue
+        try:
+            written += await _run_sync(db, _store_account, states[account_id], fetched, periods[account_id], date_to)
+        except Exception as e:
+            await _run_sync(db, Session.rollback)
+            logger.error(f"Ошибка сохранения статистики аккаунта {account_id}: {e}")
+        finally:
+            if locked:
+                release_account_lock(account_id)
+    logger.info(f"Статистика VK пользователя {user.id} синхронизирована: {written} строк")
+    return written
+
+def needs_sync(accounts: List[VKAdAccount]) -> bool:
+    """
+    Нужна ли синхронизация: аккаунты не загружались или данные устарели
+    """
+    threshold = datetime.utcnow() - timedelta(seconds=settings.VK_STATS_SYNC_INTERVAL)
+    return not accounts or any(account.synced_at is None or account.synced_at < threshold for account in accounts)
+
+def get_local_vk_campaigns(db: Session, user_id: int) -> List[CampaignStatsRecord]:
+    """
+    Кампании аккаунтов пользователя из локальной базы со статистикой за последний загруженный день
+    """
+    latest = db.query(
+        VKCampaignStat.account_id,
+        VKCampaignStat.campaign_id,
+        func.max(VKCampaignStat.date).label('date')
+    ).join(
+        VKAdAccount,
+        and_(VKAdAccount.account_id == VKCampaignStat.account_id, VKAdAccount.user_id == user_id)
+    ).group_by(VKCampaignStat.account_id, VKCampaignStat.campaign_id).subquery()
+
+    rows = db.query(VKCampaign, VKCampaignStat).join(
+        VKAdAccount,
+        and_(VKAdAccount.account_id == VKCampaign.account_id, VKAdAccount.user_id == user_id)
+    ).outerjoin(
+        latest,
+        and_(latest.c.account_id == VKCampaign.account_id, latest.c.campaign_id == VKCampaign.campaign_id)
+    ).outerjoin(
+        VKCampaignStat,
+        and_(
+            VKCampaignStat.account_id == latest.c.account_id,
+            VKCampaignStat.campaign_id == latest.c.campaign_id,
+            VKCampaignStat.date == latest.c.date
+        )
+    ).order_by(VKCampaign.account_id, VKCampaign.campaign_id).all()
+
+    result = []
+    for camp, stat in rows:
+        impressions = stat.impressions if stat else 0
+        clicks = stat.clicks if stat else 0
+        spent = float(stat.spent) if stat and stat.spent is not None else 0
+        result.append(CampaignStatsRecord(
+            id=camp.campaign_id,
+            account_id=camp.account_id,
+            name=camp.name,
+            created=camp.create_time,
+            status=camp.status,
+            report_from=stat.date.isoformat() if stat else None,
+            report_to=stat.date.isoformat() if stat else None,
+            impressions=impressions,
+            clicks=clicks,
+            spent=spent,
+            cpc=round(spent / clicks, 2) if clicks else 0,
+            ctr=round(clicks / impressions * 100, 2) if impressions else 0,
+        ))
+    return result
+
+def schedule_vk_stats_sync(user_id: int) -> None:
+    """
+    Поставить фоновую синхронизацию в очередь; недоступность брокера не мешает чтению данных.
+    Ключ пользователя держится с постановки в очередь до конца синхронизации (его снимает задача),
+    поэтому синхронизации одного пользователя из API и по расписанию не идут одновременно.
+    """
+    try:
+        if not get_redis().set(_user_sync_key(user_id), 1, nx=True, ex=settings.VK_STATS_SYNC_INTERVAL):
+            return
+    except Exception as e:
+        logger.warning(f"Не удалось поставить синхронизацию VK пользователя {user_id} в очередь: {e}")
+        return
+    try:
+        sync_vk_stats_task.delay(user_id)
+    except Exception as e:
+        logger.warning(f"Не удалось поставить синхронизацию VK пользователя {user_id} в очередь: {e}")
+        # Задача не поставлена - снимаем ключ, чтобы следующий запрос попробовал снова
+        try:
+            get_redis().delete(_user_sync_key(user_id))
+        except redis.RedisError:
+            pass
+
+@celery_app.task(name="vk.sync_stats")
+def sync_vk_stats_task(user_id: int):
+    """
+    Фоновая синхронизация статистики VK пользователя
+    """
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.id == user_id).first()
+        if user is None or not user.vk_access_token:
+            return
+        vk_client.run_closing(sync_user_vk_stats(db, user))
+    except Exception as e:
+        logger.error(f"Ошибка синхронизации статистики VK пользователя {user_id}: {e}")
+    finally:
+        db.close()
+        try:
+            get_redis().delete(_user_sync_key(user_id))
+        except redis.RedisError as e:
+            logger.warning(f"Не удалось снять блокировку синхронизации VK пользователя {user_id}: {e}")
+
+@celery_app.task(name="vk.sync_all_stats")
+def sync_all_vk_stats_task():
+    """
+    Периодическая синхронизация статистики всех пользователей с привязанным VK
+    """
+    db = SessionLocal()
+    try:
+        user_ids = [row.id for row in db.query(User.id).filter(User.vk_access_token.isnot(None))]
+    finally:
+        db.close()
+    for user_id in user_ids:
+        # Через общий ключ: пользователи, синхронизация которых уже идет, пропускаются
+        schedule_vk_stats_sync(user_id)
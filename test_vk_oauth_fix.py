@@ -3,6 +3,7 @@
 Тест исправленного VK OAuth с правильными endpoints
 """
 
+import asyncio
 import requests
 import json
 from urllib.parse import urlencode
@@ -134,7 +135,7 @@ def test_quick_token_exchange():
         test_code = "test_code_456"
         
         print(f"Тестируем с кодом: {test_code}")
-        result = quick_vk_token_exchange(test_code)
+        result = asyncio.run(quick_vk_token_exchange(test_code))
         
         if result:
             print(f"✅ Функция работает, результат: {result}")
@@ -3,6 +3,7 @@
 Тест улучшенной VK OAuth реализации с правильными endpoints
 """
 
+import asyncio
 import requests
 import json
 from urllib.parse import urlencode
@@ -169,16 +170,16 @@ def test_handle_vk_callback():
         from app.services.vk_ads import handle_vk_callback
         
         # Тест с ошибкой
-        error_result = handle_vk_callback("", "test_error")
+        error_result = asyncio.run(handle_vk_callback("", "test_error"))
         print(f"Error test result: {error_result}")
         
         # Тест без кода
-        no_code_result = handle_vk_callback("")
+        no_code_result = asyncio.run(handle_vk_callback(""))
         print(f"No code test result: {no_code_result}")
         
         # Тест с тестовым кодом
         test_code = "test_code_789"
-        code_result = handle_vk_callback(test_code)
+        code_result = asyncio.run(handle_vk_callback(test_code))
         print(f"Code test result: {code_result}")
         
     except ImportError as e:
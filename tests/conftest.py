@@ -3,13 +3,15 @@ import asyncio
 from typing import Generator, Dict, Any
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool, StaticPool
 
 from app.main import app
-from app.core.database import get_db, Base
+from app.core.database import get_async_db, get_db, Base
 from app.models.user import User
 from app.models.report import Report
+from app.models.vk_stats import VKAdAccount, VKCampaign, VKCampaignStat
 from app.services.auth import create_access_token
 from tests.factories import UserFactory, ReportFactory, CompletedReportFactory, ProcessingReportFactory
 
@@ -23,6 +25,11 @@ engine = create_engine(
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронный движок для роутов: та же база, соединение на каждую сессию,
+# так как TestClient запускает приложение в собственном цикле событий
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 # Создаем таблицы
 Base.metadata.create_all(bind=engine)
 
@@ -33,18 +40,32 @@ def event_loop():
     yield loop
     loop.close()
 
+@pytest.fixture(autouse=True)
+def reset_process_caches():
+    """Сбрасывает кеши процесса, чтобы тесты не влияли друг на друга"""
+    from app.services.auth import clear_user_cache
+    from app.services.google_sheets import clear_service_cache
+    clear_service_cache()
+    clear_user_cache()
+    yield
+    clear_service_cache()
+    clear_user_cache()
+
 @pytest.fixture
 def db_session() -> Generator[Session, None, None]:
-    """Фикстура для тестовой сессии базы данных"""
-    connection = engine.connect()
-    transaction = connection.begin()
-    session = TestingSessionLocal(bind=connection)
+    """
+    Фикстура для тестовой сессии базы данных.
+    Данные фиксируются по-настоящему, чтобы их видели асинхронные сессии роутов;
+    после теста все таблицы очищаются.
+    """
+    session = TestingSessionLocal()
     
     yield session
     
     session.close()
-    transaction.rollback()
-    connection.close()
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
 
 @pytest.fixture
 def client(db_session: Session) -> Generator[TestClient, None, None]:
@@ -55,7 +76,12 @@ def client(db_session: Session) -> Generator[TestClient, None, None]:
         finally:
             pass
     
+    async def override_get_async_db():
+        async with TestingAsyncSessionLocal() as session:
+            yield session
+    
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
     with TestClient(app) as test_client:
         yield test_client
     app.dependency_overrides.clear()
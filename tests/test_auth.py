@@ -1,7 +1,9 @@
 import pytest
+import asyncio
 from unittest.mock import patch, MagicMock
 from fastapi import status
 from app.services.auth import verify_telegram_auth, create_access_token, verify_token
+from tests.conftest import TestingAsyncSessionLocal
 
 class TestAuthService:
     """Тесты для сервиса авторизации"""
@@ -58,6 +60,70 @@ class TestAuthService:
         # Пока просто проверяем, что функция вызывается
         result = verify_telegram_auth(telegram_data)
         assert isinstance(result, bool)
+    
+    def test_get_current_user_uses_cache(self, db_session, test_user):
+        """Тест кеша пользователей: повторный запрос не читает базу до инвалидации"""
+        from fastapi.security import HTTPAuthorizationCredentials
+        from app.models.user import User
+        from app.services.auth import get_current_user, invalidate_user_cache
+        
+        credentials = HTTPAuthorizationCredentials(
+            scheme="Bearer", credentials=create_access_token({"sub": str(test_user.id)})
+        )
+        user_id, email = test_user.id, test_user.email
+        
+        async def load_user():
+            # Каждый вызов - как новый запрос со своей сессией
+            async with TestingAsyncSessionLocal() as session:
+                return await get_current_user(credentials, session)
+        
+        asyncio.run(load_user())
+        db_session.query(User).filter(User.id == user_id).update({"email": "changed@example.com"})
+        db_session.commit()
+        
+        assert asyncio.run(load_user()).email == email
+        
+        invalidate_user_cache(user_id)
+        assert asyncio.run(load_user()).email == "changed@example.com"
+
+    @staticmethod
+    def make_init_data(bot_token: str, auth_date: int, user: dict) -> str:
+        """Собрать подписанный initData Telegram WebApp"""
+        import hashlib
+        import hmac
+        import json
+        from urllib.parse import urlencode
+        
+        fields = {"auth_date": str(auth_date), "query_id": "AAH", "user": json.dumps(user)}
+        data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+        secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+        fields["hash"] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+        return urlencode(fields)
+    
+    @patch('app.services.auth.settings.TELEGRAM_BOT_TOKEN', "123:ABC")
+    def test_verify_web_app_init_data(self):
+        """Тест проверки initData Telegram WebApp и кеша проверенных данных"""
+        import time
+        from app.services.auth import verify_web_app_init_data
+        
+        init_data = self.make_init_data("123:ABC", int(time.time()), {"id": 42, "first_name": "Иван & Co"})
+        
+        assert verify_web_app_init_data(init_data) == {"id": 42, "first_name": "Иван & Co"}
+        with patch('app.services.auth.hmac.new') as hmac_new:
+            assert verify_web_app_init_data(init_data)["id"] == 42
+            hmac_new.assert_not_called()
+    
+    @patch('app.services.auth.settings.TELEGRAM_BOT_TOKEN', "123:ABC")
+    def test_verify_web_app_init_data_rejects_invalid(self):
+        """Тест: чужая подпись и истекший auth_date отклоняются"""
+        import time
+        from app.services.auth import verify_web_app_init_data
+        
+        forged = self.make_init_data("999:XYZ", int(time.time()), {"id": 1})
+        expired = self.make_init_data("123:ABC", int(time.time()) - 2 * 86400, {"id": 1})
+        
+        assert verify_web_app_init_data(forged) is None
+        assert verify_web_app_init_data(expired) is None
 
 class TestAuthEndpoints:
     """Тесты для эндпоинтов авторизации"""
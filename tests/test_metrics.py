@@ -0,0 +1,85 @@
+import pytest
+from unittest.mock import MagicMock
+from fastapi import status
+
+class TestMetrics:
+    """Тесты для эндпоинта метрик Prometheus"""
+    
+    def test_metrics_endpoint_exposes_route_latency(self, client):
+        """Тест экспорта времени запросов по шаблону маршрута и метрик планировщика VK"""
+        client.get("/health")
+        client.get("/api/upload/report/12345/status")
+        
+        response = client.get("/metrics")
+        
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'adstat_http_request_duration_seconds_count{method="GET",route="/health",status="200"}' in response.text
+        # В метке маршрута шаблон пути, а не идентификатор отчета
+        assert 'route="/api/upload/report/{report_id}/status"' in response.text
+        assert "report/12345" not in response.text
+        assert "adstat_vk_scheduler_queue_depth" in response.text
+    
+    def test_google_request_errors_are_counted(self):
+        """Тест учета ошибок вызовов Google API по методу"""
+        from googleapiclient.errors import HttpError
+        from app.core.metrics import EXTERNAL_CALL_ERRORS
+        from app.services.google_sheets import execute_request
+        
+        request = MagicMock()
+        request.execute.side_effect = HttpError(MagicMock(status=403), b"forbidden")
+        errors = EXTERNAL_CALL_ERRORS.labels("google", "sheets.values.get", "http_403")
+        before = errors._value.get()
+        
+        with pytest.raises(HttpError):
+            execute_request(request, "sheets.values.get")
+        
+        assert errors._value.get() == before + 1
+
+class TestServerTiming:
+    """Тесты для разбивки времени запроса"""
+    
+    def test_server_timing_header_lists_phases(self, authenticated_client):
+        """Тест заголовка Server-Timing с фазами аутентификации и сериализации"""
+        response = authenticated_client.get("/api/user/profile")
+        
+        assert response.status_code == status.HTTP_200_OK
+        phases = [part.split(";")[0].strip() for part in response.headers["Server-Timing"].split(",")]
+        assert {"jwt", "user", "serialize"} <= set(phases)
+        assert phases[-1] == "total"
+    
+    def test_request_timing_log_line(self, client, caplog, monkeypatch):
+        """Тест структурированной строки лога с разбивкой запроса"""
+        import json
+        import logging
+        from app.core.config import settings
+        monkeypatch.setattr(settings, "REQUEST_TIMING_LOG", True)
+        
+        with caplog.at_level(logging.INFO, logger="app.core.timing"):
+            client.get("/health")
+        
+        records = [json.loads(r.getMessage()) for r in caplog.records if r.name == "app.core.timing"]
+        assert records[-1]["event"] == "request_timing"
+        assert records[-1]["path"] == "/health"
+        assert "serialize" in records[-1]["spans"]
+    
+    def test_summarize_spans_merges_repeated_phases(self):
+        """Тест сложения повторяющихся фаз и формата заголовка"""
+        from app.core.timing import server_timing_header, summarize_spans
+        
+        summary = summarize_spans([("db", 0.002), ("vk", 0.1), ("db", 0.003)])
+        
+        assert summary == {"db": {"ms": 5.0, "count": 2}, "vk": {"ms": 100.0, "count": 1}}
+        assert server_timing_header(summary, 120) == 'db;dur=5.0;desc="x2", vk;dur=100.0, total;dur=120'
+    
+    def test_nested_spans_are_not_counted_twice(self):
+        """Тест вычитания вложенных фаз из внешней"""
+        from app.core.timing import record_span, span, start_request_timing, summarize_spans
+        
+        spans = start_request_timing()
+        with span("user"):
+            record_span("db", 0.5)
+        
+        summary = summarize_spans(spans)
+        assert summary["db"]["ms"] == 500.0
+        assert summary["user"]["ms"] == 0.0
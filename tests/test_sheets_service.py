@@ -51,7 +51,7 @@ class TestGoogleSheetsService:
         credentials = get_credentials_from_user(test_user)
         assert credentials is None
     
-    @patch('app.services.google_sheets.build')
+    @patch('app.services.google_sheets.build_from_document')
     def test_get_sheet_info_success(self, mock_build, test_user):
         """Тест успешного получения информации о таблице"""
         from app.services.google_sheets import get_sheet_info
@@ -76,7 +76,7 @@ class TestGoogleSheetsService:
             assert result["sheet_id"] == "test_sheet_id"
     
     @patch('app.services.google_sheets.Credentials')
-    @patch('app.services.google_sheets.build')
+    @patch('app.services.google_sheets.build_from_document')
     def test_get_sheet_info_http_error(self, mock_build, mock_credentials, test_user):
         """Тест ошибки HTTP при получении информации о таблице"""
         from app.services.google_sheets import get_sheet_info
@@ -101,7 +101,7 @@ class TestGoogleSheetsService:
             with pytest.raises(Exception, match="Ошибка доступа к Google Sheets"):
                 asyncio.run(get_sheet_info("test_sheet_id", test_user))
     
-    @patch('app.services.google_sheets.build')
+    @patch('app.services.google_sheets.build_from_document')
     def test_append_data_to_sheet_success(self, mock_build, test_user):
         """Тест успешного добавления данных в таблицу"""
         from app.services.google_sheets import append_data_to_sheet
@@ -131,7 +131,7 @@ class TestGoogleSheetsService:
             assert result["updated_cells"] == 10
     
     @patch('app.services.google_sheets.Credentials')
-    @patch('app.services.google_sheets.build')
+    @patch('app.services.google_sheets.build_from_document')
     def test_read_data_from_sheet_success(self, mock_build, mock_credentials, test_user):
         """Тест успешного чтения данных из таблицы"""
         from app.services.google_sheets import read_data_from_sheet
@@ -163,4 +163,281 @@ class TestGoogleSheetsService:
             
             assert len(result) == 2
             assert result[0] == ["Дата", "Кампания", "Показы"]
-            assert result[1] == ["2023-01-01", "Test Campaign", "1000"] 
\ No newline at end of file
+            assert result[1] == ["2023-01-01", "Test Campaign", "1000"]
+
+    @patch('app.services.google_sheets.build_from_document')
+    def test_read_data_from_sheet_cached_by_version(self, mock_build, test_user):
+        """Тест кеша чтения: диапазон перечитывается только после изменения версии таблицы"""
+        from app.services.google_sheets import read_data_from_sheet
+        
+        mock_service = MagicMock()
+        mock_service.files().get().execute.return_value = {"version": "7"}
+        mock_service.spreadsheets().values().get().execute.return_value = {"values": [["a", "b"]]}
+        mock_build.return_value = mock_service
+        values_get = mock_service.spreadsheets().values().get()
+        values_get.execute.reset_mock()
+        
+        assert asyncio.run(read_data_from_sheet("test_sheet_id", "A1:B2", test_user)) == [["a", "b"]]
+        assert asyncio.run(read_data_from_sheet("test_sheet_id", "A1:B2", test_user)) == [["a", "b"]]
+        assert values_get.execute.call_count == 1
+        
+        mock_service.files().get().execute.return_value = {"version": "8"}
+        mock_service.spreadsheets().values().get().execute.return_value = {"values": [["c"]]}
+        assert asyncio.run(read_data_from_sheet("test_sheet_id", "A1:B2", test_user)) == [["c"]]
+        assert values_get.execute.call_count == 2
+    
+    @patch('app.services.google_sheets.build_from_document')
+    def test_read_ranges_from_sheet_fetches_only_missing(self, mock_build, test_user):
+        """Тест пакетного чтения: уже прочитанные при той же версии диапазоны не запрашиваются"""
+        from app.services.google_sheets import read_data_from_sheet, read_ranges_from_sheet
+        
+        mock_service = MagicMock()
+        mock_service.files().get().execute.return_value = {"version": "3"}
+        mock_service.spreadsheets().values().get().execute.return_value = {"values": [["cached"]]}
+        mock_service.spreadsheets().values().batchGet().execute.return_value = {
+            "valueRanges": [{"range": "'Итоги'!A1:B2", "values": [["fresh"]]}]
+        }
+        mock_build.return_value = mock_service
+        mock_service.spreadsheets().values().batchGet.reset_mock()
+        
+        asyncio.run(read_data_from_sheet("test_sheet_id", "Данные!A1:C10", test_user))
+        result = asyncio.run(read_ranges_from_sheet("test_sheet_id", ["Данные!A1:C10", "Итоги!A1:B2"], test_user))
+        
+        assert result == {"Данные!A1:C10": [["cached"]], "Итоги!A1:B2": [["fresh"]]}
+        mock_service.spreadsheets().values().batchGet.assert_called_once_with(
+            spreadsheetId="test_sheet_id",
+            ranges=["Итоги!A1:B2"]
+        )
+    
+    @patch('app.services.google_sheets.build_from_document')
+    def test_batch_update_sheet(self, mock_build, test_user):
+        """Тест записи нескольких диапазонов одним запросом"""
+        from app.services.google_sheets import batch_update_sheet
+        
+        mock_service = MagicMock()
+        mock_service.spreadsheets().values().batchUpdate().execute.return_value = {
+            "totalUpdatedCells": 3,
+            "responses": [{"updatedRange": "Данные!A1:B1"}, {"updatedRange": "Итоги!A1"}]
+        }
+        mock_build.return_value = mock_service
+        
+        result = asyncio.run(batch_update_sheet(
+            "test_sheet_id",
+            {"Данные!A1:B1": [["a", "b"]], "Итоги!A1": [[1]]},
+            test_user
+        ))
+        
+        assert result == {"updated_cells": 3, "updated_ranges": ["Данные!A1:B1", "Итоги!A1"]}
+        body = mock_service.spreadsheets().values().batchUpdate.call_args.kwargs["body"]
+        assert [item["range"] for item in body["data"]] == ["Данные!A1:B1", "Итоги!A1"]
+    
+    @patch('app.services.google_sheets.build_from_document')
+    def test_get_user_spreadsheets_pages_and_follows_changes(self, mock_build, test_user):
+        """Тест списка таблиц: все страницы загружаются один раз, дальше применяется лента изменений"""
+        from app.services.google_sheets import SPREADSHEET_MIME_TYPE, get_user_spreadsheets
+        
+        mock_service = MagicMock()
+        mock_service.changes().getStartPageToken().execute.return_value = {"startPageToken": "t1"}
+        mock_service.files().list().execute.side_effect = [
+            {"files": [{"id": "1", "name": "Отчет VK", "modifiedTime": "2023-01-02"}], "nextPageToken": "p2"},
+            {"files": [{"id": "2", "name": "Бюджет", "modifiedTime": "2023-01-03"}]}
+        ]
+        mock_service.changes().list().execute.return_value = {
+            "newStartPageToken": "t2",
+            "changes": [
+                {"fileId": "2", "removed": True},
+                {"fileId": "3", "file": {"id": "3", "name": "Отчет Google", "mimeType": SPREADSHEET_MIME_TYPE, "modifiedTime": "2023-01-04"}}
+            ]
+        }
+        mock_build.return_value = mock_service
+        
+        assert [f["id"] for f in get_user_spreadsheets(test_user)] == ["2", "1"]
+        assert [f["id"] for f in get_user_spreadsheets(test_user, search="отчет")] == ["1"]
+        assert mock_service.files().list().execute.call_count == 2
+        mock_service.changes().list().execute.assert_not_called()
+        
+        with patch('app.services.google_sheets.settings.DRIVE_LISTING_REFRESH_INTERVAL', 0):
+            result = get_user_spreadsheets(test_user, limit=1)
+        
+        assert [f["id"] for f in result] == ["3"]
+        assert mock_service.files().list().execute.call_count == 2
+        mock_service.changes().list.assert_called_with(
+            pageToken="t1",
+            pageSize=1000,
+            spaces='drive',
+            fields="nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, trashed, modifiedTime))"
+        )
+    
+    def test_iter_append_batches_respects_limits(self):
+        """Тест разбиения строк на пакеты по числу строк и размеру"""
+        from app.services.google_sheets import iter_append_batches
+        
+        rows = [["2023-01-01", "Кампания", i] for i in range(10)]
+        
+        assert [len(b) for b in iter_append_batches(rows, max_rows=4, max_bytes=10 ** 6)] == [4, 4, 2]
+        # Лимит по размеру меньше одной строки: каждая строка уходит отдельным пакетом
+        assert [len(b) for b in iter_append_batches(rows, max_rows=100, max_bytes=1)] == [1] * 10
+    
+    @patch('app.services.google_sheets.build_from_document')
+    def test_append_data_to_sheet_reports_each_batch(self, mock_build, test_user):
+        """Тест пакетной записи с вызовом чекпоинта после каждого пакета"""
+        from app.services.google_sheets import append_data_to_sheet
+        
+        mock_service = MagicMock()
+        mock_service.spreadsheets().values().append().execute.return_value = {"updates": {"updatedCells": 2}}
+        mock_build.return_value = mock_service
+        committed = []
+        
+        with patch('app.services.google_sheets.settings.SHEETS_APPEND_MAX_ROWS', 2):
+            result = asyncio.run(append_data_to_sheet(
+                "test_sheet_id",
+                "A1",
+                [["a"], ["b"], ["c"], ["d"], ["e"]],
+                test_user,
+                on_batch=committed.append
+            ))
+        
+        assert committed == [2, 2, 1]
+        assert result["updated_cells"] == 6
+    
+    @patch('app.services.google_sheets.build_from_document')
+    def test_get_service_reuses_credentials_not_clients(self, mock_build, test_user):
+        """Тест: учетные данные кешируются, а клиент со своим соединением создается на каждый вызов"""
+        from app.services.google_sheets import get_service, invalidate_user_services
+        
+        with patch('app.services.google_sheets.get_credentials', return_value=MagicMock()) as mock_get_creds:
+            test_user.google_access_token = "token_1"
+            get_service('sheets', 'v4', test_user)
+            get_service('sheets', 'v4', test_user)
+            assert mock_get_creds.call_count == 1
+            first_http, second_http = (call.kwargs['http'] for call in mock_build.call_args_list)
+            assert first_http is not second_http
+            
+            # Новый токен - новые учетные данные
+            test_user.google_access_token = "token_2"
+            get_service('sheets', 'v4', test_user)
+            assert mock_get_creds.call_count == 2
+            
+            invalidate_user_services(test_user.id)
+            get_service('sheets', 'v4', test_user)
+            assert mock_get_creds.call_count == 3
+
+    def test_token_refresh_keeps_spreadsheet_listing(self, test_user):
+        """Тест: обновление токена сбрасывает учетные данные, но не список таблиц"""
+        from app.services import google_sheets
+        
+        google_sheets._credentials_cache.set(test_user.id, ("token_1", MagicMock()))
+        google_sheets._spreadsheet_cache.set(test_user.id, {"files": {}, "page_token": "t1", "checked_at": 0})
+        
+        google_sheets.invalidate_user_services(test_user.id, keep_listing=True)
+        assert google_sheets._credentials_cache.get(test_user.id) is None
+        assert google_sheets._spreadsheet_cache.get(test_user.id)["page_token"] == "t1"
+        
+        google_sheets.invalidate_user_services(test_user.id)
+        assert google_sheets._spreadsheet_cache.get(test_user.id) is None
+
+class TestGoogleTokenManager:
+    """Тесты для менеджера Google токенов"""
+    
+    def _fresh_credentials(self, token="new_token"):
+        from datetime import datetime, timedelta
+        creds = MagicMock()
+        creds.token = token
+        creds.refresh_token = None
+        creds.expiry = datetime.utcnow() + timedelta(hours=1)
+        return creds
+    
+    def test_expired_token_is_refreshed_once_for_concurrent_calls(self, test_user):
+        """Тест объединения одновременных обновлений токена в одно"""
+        import threading
+        import time
+        from datetime import datetime, timedelta
+        from app.services.google_tokens import GoogleTokenManager
+        
+        test_user.google_access_token = "old_token"
+        test_user.google_refresh_token = "refresh_token"
+        test_user.google_token_expiry = datetime.utcnow() - timedelta(minutes=1)
+        manager = GoogleTokenManager(refresh_margin=300)
+        
+        def slow_refresh(user_id, refresh_token):
+            time.sleep(0.2)
+            return self._fresh_credentials()
+        
+        with patch.object(manager, '_refresh', side_effect=slow_refresh) as mock_refresh:
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(manager.get_credentials(test_user).token))
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        
+        assert mock_refresh.call_count == 1
+        assert results == ["new_token"] * 5
+        assert test_user.google_access_token == "new_token"
+    
+    def test_async_refresh_does_not_block_event_loop(self, test_user):
+        """Тест: ожидание обновления токена в асинхронном коде не останавливает цикл событий"""
+        import time
+        from app.services.google_sheets import refresh_credentials
+
+        test_user.google_access_token = "old_token"
+
+        def slow_get_credentials(user):
+            time.sleep(0.2)
+            return self._fresh_credentials()
+
+        async def run():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            await refresh_credentials(test_user)
+            task.cancel()
+            return ticks
+
+        with patch('app.services.google_sheets.get_credentials', side_effect=slow_get_credentials) as mock_get_creds:
+            ticks = asyncio.run(run())
+
+        mock_get_creds.assert_called_once_with(test_user)
+        assert ticks >= 5
+
+    def test_expiring_token_is_refreshed_in_background(self, test_user):
+        """Тест фонового обновления токена, срок которого скоро истекает"""
+        from datetime import datetime, timedelta
+        from app.services.google_tokens import GoogleTokenManager
+        
+        test_user.google_access_token = "old_token"
+        test_user.google_refresh_token = "refresh_token"
+        test_user.google_token_expiry = datetime.utcnow() + timedelta(minutes=2)
+        manager = GoogleTokenManager(refresh_margin=300)
+        
+        with patch.object(manager, '_refresh', return_value=self._fresh_credentials()) as mock_refresh:
+            creds = manager.get_credentials(test_user)
+            manager._executor.shutdown(wait=True)
+        
+        # Текущий токен еще действует и возвращается сразу
+        assert creds.token == "old_token"
+        mock_refresh.assert_called_once_with(test_user.id, "refresh_token")
+    
+    def test_store_refreshed_token(self, test_user, db_session):
+        """Тест сохранения обновленного токена вместе со сроком действия"""
+        from app.models.user import User
+        from app.services.google_tokens import store_refreshed_token
+        
+        user_id = test_user.id
+        creds = self._fresh_credentials("stored_token")
+        with patch('app.services.google_tokens.SessionLocal', return_value=db_session):
+            store_refreshed_token(user_id, creds)
+        
+        user = db_session.query(User).filter(User.id == user_id).first()
+        db_session.refresh(user)
+        assert user.google_access_token == "stored_token"
+        assert user.google_token_expiry == creds.expiry
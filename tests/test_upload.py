@@ -1,8 +1,22 @@
 import pytest
 import io
-from unittest.mock import patch, MagicMock
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
 from fastapi import status
 from app.models.report import Report
+from tests.conftest import TestingAsyncSessionLocal
+
+def make_report_workbook(header=None, rows=1) -> bytes:
+    """Содержимое XLSX отчета с заданным заголовком"""
+    from openpyxl import Workbook
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(header or ["Дата", "Кампания", "Показы", "Клики", "Расходы"])
+    for i in range(rows):
+        sheet.append(["2023-01-01", f"Кампания {i}", 100, 10, 50.5])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
 
 class TestUploadEndpoints:
     """Тесты для эндпоинтов загрузки файлов"""
@@ -14,10 +28,10 @@ class TestUploadEndpoints:
         ProcessingReportFactory._meta.sqlalchemy_session = db_session
         ErrorReportFactory._meta.sqlalchemy_session = db_session
         # Создаем тестовый Excel файл
-        excel_content = b"test excel content"
+        excel_content = make_report_workbook()
         files = {"file": ("test_report.xlsx", io.BytesIO(excel_content), "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")}
         
-        with patch('app.api.routes.upload.process_excel_file') as mock_process:
+        with patch('app.api.routes.upload.enqueue_report') as mock_enqueue:
             response = authenticated_client.post("/upload/report", files=files)
             
             assert response.status_code == status.HTTP_200_OK
@@ -30,8 +44,79 @@ class TestUploadEndpoints:
             assert data["filename"] == "test_report.xlsx"
             assert data["status"] == "uploaded"
             
-            # Проверяем, что функция обработки была вызвана
-            mock_process.assert_called_once()
+            # Проверяем, что отчет поставлен в очередь обработки
+            mock_enqueue.assert_called_once()
+    
+    def test_upload_report_duplicate_content(self, authenticated_client, db_session, test_user, tmp_path, monkeypatch):
+        """Тест повторной загрузки того же файла: новый отчет не создается"""
+        from app.core.config import settings
+        monkeypatch.setattr(settings, "UPLOAD_DIR", str(tmp_path))
+        content = make_report_workbook()
+
+        with patch('app.api.routes.upload.enqueue_report', new_callable=AsyncMock) as mock_enqueue:
+            first = authenticated_client.post("/api/upload/report", files={"file": ("export.xlsx", io.BytesIO(content))})
+            second = authenticated_client.post("/api/upload/report", files={"file": ("export (1).xlsx", io.BytesIO(content))})
+
+        assert first.status_code == status.HTTP_200_OK
+        assert second.status_code == status.HTTP_200_OK
+        assert second.json()["report_id"] == first.json()["report_id"]
+        assert second.json()["duplicate"] is True
+        mock_enqueue.assert_awaited_once()
+
+        reports = db_session.query(Report).filter(Report.user_id == test_user.id).all()
+        assert len(reports) == 1
+        assert reports[0].content_hash is not None
+        assert len(list(tmp_path.iterdir())) == 1
+
+    def test_upload_report_duplicate_race(self, authenticated_client, db_session, test_user, tmp_path, monkeypatch):
+        """Тест гонки двух загрузок одного файла: уникальный индекс не дает создать второй отчет"""
+        import hashlib
+        from app.api.routes import upload
+        from app.core.config import settings
+        monkeypatch.setattr(settings, "UPLOAD_DIR", str(tmp_path))
+        content = make_report_workbook()
+
+        existing = Report(
+            user_id=test_user.id, filename="a.xlsx", original_filename="a.xlsx", file_path="a.xlsx",
+            file_size=len(content), content_hash=hashlib.sha256(content).hexdigest(), status="queued"
+        )
+        db_session.add(existing)
+        db_session.commit()
+
+        # Параллельный запрос создал отчет уже после проверки на дубликат
+        lookups = []
+        original_find = upload.find_active_report
+
+        async def find_after_race(db, user_id, content_hash):
+            lookups.append(content_hash)
+            return None if len(lookups) == 1 else await original_find(db, user_id, content_hash)
+
+        with patch('app.api.routes.upload.find_active_report', side_effect=find_after_race), \
+             patch('app.api.routes.upload.enqueue_report', new_callable=AsyncMock) as mock_enqueue:
+            response = authenticated_client.post("/api/upload/report", files={"file": ("export.xlsx", io.BytesIO(content))})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["report_id"] == existing.id
+        assert response.json()["duplicate"] is True
+        mock_enqueue.assert_not_awaited()
+        assert db_session.query(Report).filter(Report.user_id == test_user.id).count() == 1
+        assert list(tmp_path.iterdir()) == []
+
+    def test_upload_report_rejects_bad_header(self, authenticated_client, tmp_path, monkeypatch):
+        """Тест отклонения файла без обязательных колонок при загрузке"""
+        from app.core.config import settings
+        monkeypatch.setattr(settings, "UPLOAD_DIR", str(tmp_path))
+        content = make_report_workbook(header=["Дата", "кампания ", "Показы", "Клики"])
+        
+        with patch('app.api.routes.upload.enqueue_report', new_callable=AsyncMock) as mock_enqueue:
+            response = authenticated_client.post("/api/upload/report", files={"file": ("bad.xlsx", io.BytesIO(content))})
+        
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        detail = response.json()["detail"]
+        assert "колонка «кампания » должна называться «Кампания»" in detail
+        assert "нет колонки «Расходы»" in detail
+        mock_enqueue.assert_not_called()
+        assert list(tmp_path.iterdir()) == []
     
     def test_upload_report_invalid_file_type(self, authenticated_client):
         """Тест загрузки файла неподдерживаемого типа"""
@@ -53,6 +138,47 @@ class TestUploadEndpoints:
         assert response.status_code == status.HTTP_400_BAD_REQUEST
         assert "Размер файла превышает" in response.json()["detail"]
     
+    def test_save_upload_aborts_over_limit(self, tmp_path, monkeypatch):
+        """Тест записи загрузки без заявленного размера: превышение лимита обнаруживается по потоку"""
+        import asyncio
+        from fastapi import HTTPException, UploadFile
+        from app.api.routes.upload import save_upload
+        from app.core.config import settings
+        monkeypatch.setattr(settings, "MAX_FILE_SIZE", 10)
+        monkeypatch.setattr(settings, "UPLOAD_CHUNK_SIZE", 4)
+        file_path = tmp_path / "chunked.xlsx"
+
+        upload = UploadFile(io.BytesIO(b"x" * 8), filename="chunked.xlsx")
+        assert asyncio.run(save_upload(upload, str(file_path)))[0] == 8
+
+        upload = UploadFile(io.BytesIO(b"x" * 16), filename="chunked.xlsx")
+        with pytest.raises(HTTPException) as exc_info:
+            asyncio.run(save_upload(upload, str(file_path)))
+        assert exc_info.value.status_code == status.HTTP_400_BAD_REQUEST
+        assert not file_path.exists()
+
+    def test_upload_rejects_large_body_before_parsing_form(self, authenticated_client, monkeypatch):
+        """Тест отклонения большого тела запроса до разбора формы: по Content-Length и по потоку"""
+        from app.core.config import settings
+        monkeypatch.setattr(settings, "MAX_FILE_SIZE", 1000)
+        monkeypatch.setattr(settings, "UPLOAD_FORM_OVERHEAD", 100)
+        files = {"file": ("large.xlsx", io.BytesIO(b"x" * 5000))}
+
+        with patch('app.api.routes.upload.save_upload', new_callable=AsyncMock) as mock_save:
+            response = authenticated_client.post("/api/upload/report", files=files)
+            # Без Content-Length (chunked) чтение прерывается, как только тело превысит лимит
+            chunked = authenticated_client.post(
+                "/api/upload/report",
+                content=iter([b"x" * 600, b"x" * 600]),
+                headers={"Content-Type": "multipart/form-data; boundary=boundary"}
+            )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert "Размер файла превышает" in response.json()["detail"]
+        assert chunked.status_code == status.HTTP_400_BAD_REQUEST
+        assert "Размер файла превышает" in chunked.json()["detail"]
+        mock_save.assert_not_called()
+
     def test_upload_report_unauthenticated(self, client):
         """Тест загрузки файла без аутентификации"""
         files = {"file": ("test.xlsx", io.BytesIO(b"test"), "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")}
@@ -158,19 +284,17 @@ class TestReportModels:
 class TestFileProcessor:
     """Тесты для обработки файлов"""
     
-    @patch('app.services.file_processor.pd.read_excel')
+    @patch('app.services.file_processor.iter_excel_chunks')
     @patch('app.services.file_processor.append_data_to_sheet')
-    @patch('app.services.file_processor.SessionLocal')
-    def test_process_excel_file_success(self, mock_session_local, mock_append, mock_read_excel, test_user, db_session):
+    @patch('app.services.file_processor.AsyncSessionLocal', TestingAsyncSessionLocal)
+    def test_process_excel_file_success(self, mock_append, mock_iter_chunks, test_user, db_session):
         """Тест успешной обработки Excel файла"""
         from app.services.file_processor import process_excel_file
         
-        mock_session_local.return_value = db_session
-        
-        mock_df = MagicMock()
-        mock_df.columns.tolist.return_value = ["Дата", "Кампания", "Показы"]
-        mock_df.values.tolist.return_value = [["2023-01-01", "Test Campaign", 1000]]
-        mock_read_excel.return_value = mock_df
+        mock_iter_chunks.return_value = iter([
+            [["Дата", "Кампания", "Показы"], ["2023-01-01", "Test Campaign", 1000]],
+            [["2023-01-02", "Test Campaign", 2000]]
+        ])
         mock_append.return_value = {"updated_rows": 1}
         
         report = Report(
@@ -191,17 +315,51 @@ class TestFileProcessor:
         import asyncio
         asyncio.run(process_excel_file(report_id, "/uploads/test.xlsx", test_user))
         
-        # Получаем отчет заново из базы данных
+        # Получаем отчет заново из базы данных (его изменила другая сессия)
+        db_session.expire_all()
         updated_report = db_session.query(Report).filter(Report.id == report_id).first()
         assert updated_report.status == "completed"
         assert updated_report.error_message is None
+        # Каждый блок отправляется отдельным запросом
+        assert mock_append.call_count == 2
     
-    @patch('app.services.file_processor.pd.read_excel')
-    @patch('app.services.file_processor.SessionLocal')
-    def test_process_excel_file_no_google_sheet(self, mock_session_local, mock_read_excel, test_user, db_session):
+    @patch('app.services.file_processor.iter_excel_chunks')
+    @patch('app.services.file_processor.append_data_to_sheet')
+    @patch('app.services.file_processor.AsyncSessionLocal', TestingAsyncSessionLocal)
+    def test_process_excel_file_resumes_from_checkpoint(self, mock_append, mock_iter_chunks, test_user, db_session):
+        """Тест продолжения загрузки с сохраненного чекпоинта"""
+        from app.services.file_processor import process_excel_file
+        
+        mock_iter_chunks.return_value = iter([
+            [["Дата", "Кампания"], ["2023-01-01", "A"]],
+            [["2023-01-02", "B"], ["2023-01-03", "C"]]
+        ])
+        
+        report = Report(
+            user_id=test_user.id,
+            filename="test.xlsx",
+            original_filename="test.xlsx",
+            file_path="/uploads/test.xlsx",
+            file_size=1024,
+            status="retrying",
+            rows_committed=3
+        )
+        db_session.add(report)
+        test_user.google_sheet_id = "test_sheet_id"
+        db_session.commit()
+        
+        import asyncio
+        asyncio.run(process_excel_file(report.id, "/uploads/test.xlsx", test_user))
+        
+        # Отправляется только последняя незаписанная строка
+        mock_append.assert_called_once()
+        assert mock_append.call_args.args[2] == [["2023-01-03", "C"]]
+    
+    @patch('app.services.file_processor.iter_excel_chunks')
+    @patch('app.services.file_processor.AsyncSessionLocal', TestingAsyncSessionLocal)
+    def test_process_excel_file_no_google_sheet(self, mock_iter_chunks, test_user, db_session):
         """Тест обработки файла без подключенной Google таблицы"""
         from app.services.file_processor import process_excel_file
-        mock_session_local.return_value = db_session
         report = Report(
             user_id=test_user.id,
             filename="test.xlsx",
@@ -220,11 +378,148 @@ class TestFileProcessor:
         import asyncio
         asyncio.run(process_excel_file(report_id, "/uploads/test.xlsx", test_user))
         
-        # Получаем отчет заново из базы данных
+        # Получаем отчет заново из базы данных (его изменила другая сессия)
+        db_session.expire_all()
         updated_report = db_session.query(Report).filter(Report.id == report_id).first()
         assert updated_report.status == "error"
         assert "Google таблица не подключена" in updated_report.error_message
     
+    def test_iter_excel_chunks(self, tmp_path):
+        """Тест потокового чтения Excel файла блоками"""
+        from datetime import datetime
+        from openpyxl import Workbook
+        from app.services.file_processor import iter_excel_chunks
+        
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(["Дата", "Кампания", "Показы"])
+        for i in range(5):
+            sheet.append([datetime(2023, 1, i + 1), f"Кампания {i}", None])
+        file_path = tmp_path / "report.xlsx"
+        workbook.save(file_path)
+        
+        chunks = list(iter_excel_chunks(str(file_path), chunk_size=4))
+        
+        assert [len(chunk) for chunk in chunks] == [4, 2]
+        assert chunks[0][0] == ["Дата", "Кампания", "Показы"]
+        assert chunks[0][1] == ["2023-01-01T00:00:00", "Кампания 0", ""]
+    
+    def test_iter_excel_chunks_reads_first_sheet(self, tmp_path):
+        """Тест чтения первого листа книги, даже если при сохранении выбран другой"""
+        from openpyxl import Workbook
+        from app.services.file_processor import iter_excel_chunks
+        
+        workbook = Workbook()
+        workbook.active.append(["Дата", "Показы"])
+        workbook.active.append(["2023-01-01", 1])
+        workbook.create_sheet("Notes").append(["note"])
+        workbook.active = 1
+        file_path = tmp_path / "report.xlsx"
+        workbook.save(file_path)
+        
+        chunks = list(iter_excel_chunks(str(file_path)))
+        
+        assert chunks == [[["Дата", "Показы"], ["2023-01-01", 1]]]
+    
+    def test_parse_excel_file_opens_workbook_once(self, tmp_path):
+        """Тест описания многолистовой книги за одно открытие файла"""
+        from openpyxl import Workbook
+        from app.services import file_processor, report_readers
+        
+        workbook = Workbook()
+        workbook.remove(workbook.active)
+        for index in range(3):
+            sheet = workbook.create_sheet(f"Лист {index}")
+            sheet.append(["Дата", "Кампания", None])
+            for i in range(10 + index):
+                sheet.append([f"2023-01-{i + 1:02d}", f"Кампания {i}", i])
+        file_path = tmp_path / "book.xlsx"
+        workbook.save(file_path)
+        
+        with patch.object(report_readers, 'load_workbook', wraps=report_readers.load_workbook) as mock_load:
+            result = file_processor.parse_excel_file(str(file_path))
+        
+        mock_load.assert_called_once()
+        assert result["total_sheets"] == 3
+        assert result["sheet_names"] == ["Лист 0", "Лист 1", "Лист 2"]
+        info = result["sheets_info"]["Лист 2"]
+        assert info["rows"] == 12
+        assert info["columns"] == 3
+        assert info["column_names"] == ["Дата", "Кампания", "Unnamed: 2"]
+        assert len(info["sample_data"]) == 5
+        assert info["sample_data"][0] == {"Дата": "2023-01-01", "Кампания": "Кампания 0", "Unnamed: 2": 0}
+
+    def test_parse_excel_file_skips_leading_empty_rows(self, tmp_path):
+        """Тест описания листа, таблица которого начинается не с первой строки"""
+        from openpyxl import Workbook
+        from app.services.file_processor import parse_excel_file
+
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.title = "Отчет"
+        rows = [["Дата", "Показы"], ["2023-01-01", 1], ["2023-01-02", 2]]
+        for row_index, row in enumerate(rows, start=3):
+            for column_index, value in enumerate(row, start=1):
+                sheet.cell(row=row_index, column=column_index, value=value)
+        file_path = tmp_path / "book.xlsx"
+        workbook.save(file_path)
+
+        info = parse_excel_file(str(file_path))["sheets_info"]["Отчет"]
+        assert info["rows"] == 2
+        assert info["column_names"] == ["Дата", "Показы"]
+        assert info["sample_data"][0] == {"Дата": "2023-01-01", "Показы": 1}
+
+    def test_iter_csv_chunks_cp1251(self, tmp_path):
+        """Тест потокового чтения CSV в cp1251 с разделителем ';' и десятичной запятой"""
+        from app.services.file_processor import iter_excel_chunks, validate_excel_structure
+        
+        file_path = tmp_path / "report.csv"
+        lines = ["Дата;Кампания;Показы;Клики;Расходы", ""]
+        lines += [f"2023-01-0{i + 1};Кампания {i};100;10;50,5" for i in range(3)]
+        file_path.write_bytes("\r\n".join(lines).encode("cp1251"))
+        
+        assert validate_excel_structure(str(file_path)) is True
+        chunks = list(iter_excel_chunks(str(file_path), chunk_size=2))
+        
+        assert [len(chunk) for chunk in chunks] == [2, 2]
+        assert chunks[0][0] == ["Дата", "Кампания", "Показы", "Клики", "Расходы"]
+        assert chunks[0][1] == ["2023-01-01", "Кампания 0", 100, 10, 50.5]
+    
+    def test_parquet_reader(self, tmp_path):
+        """Тест чтения Parquet: строки блоками, размеры из метаданных"""
+        import pandas as pd
+        from app.services.file_processor import iter_excel_chunks, parse_excel_file
+        
+        file_path = tmp_path / "report.parquet"
+        pd.DataFrame({
+            "Дата": ["2023-01-01"] * 7,
+            "Кампания": [f"Кампания {i}" for i in range(7)],
+            "Показы": list(range(7))
+        }).to_parquet(file_path)
+        
+        chunks = list(iter_excel_chunks(str(file_path), chunk_size=5))
+        assert [len(chunk) for chunk in chunks] == [5, 3]
+        assert chunks[1][-1] == ["2023-01-01", "Кампания 6", 6]
+        
+        info = parse_excel_file(str(file_path))["sheets_info"]["report"]
+        assert info["rows"] == 7
+        assert info["column_names"] == ["Дата", "Кампания", "Показы"]
+        assert len(info["sample_data"]) == 5
+
+    def test_parquet_reader_skips_empty_rows(self, tmp_path):
+        """Тест пропуска пустых строк Parquet, как и в остальных форматах"""
+        import pandas as pd
+        from app.services.file_processor import iter_excel_chunks
+
+        file_path = tmp_path / "report.parquet"
+        pd.DataFrame({
+            "Дата": ["2023-01-01", None, "2023-01-02"],
+            "Показы": [1.0, float("nan"), 2.0]
+        }).to_parquet(file_path)
+
+        rows = [row for chunk in iter_excel_chunks(str(file_path), chunk_size=10) for row in chunk]
+        assert rows == [["Дата", "Показы"], ["2023-01-01", 1.0], ["2023-01-02", 2.0]]
+
     def test_parse_excel_file(self):
         """Тест парсинга Excel файла"""
         from app.services.file_processor import parse_excel_file
@@ -240,4 +535,134 @@ class TestFileProcessor:
         
         # Этот тест требует реального Excel файла
         with pytest.raises(Exception):
-            validate_excel_structure("nonexistent_file.xlsx") 
\ No newline at end of file
+            validate_excel_structure("nonexistent_file.xlsx") 
+    
+    def test_validate_excel_structure_reads_header_only(self, tmp_path):
+        """Тест валидации по заголовку и первой строке"""
+        from app.services.file_processor import ReportStructureError, validate_excel_structure
+        
+        valid = tmp_path / "valid.xlsx"
+        valid.write_bytes(make_report_workbook(rows=3))
+        assert validate_excel_structure(str(valid)) is True
+        
+        empty = tmp_path / "empty.xlsx"
+        empty.write_bytes(make_report_workbook(rows=0))
+        with pytest.raises(ReportStructureError, match="не содержит данных"):
+            validate_excel_structure(str(empty))
+        
+        typo = tmp_path / "typo.xlsx"
+        typo.write_bytes(make_report_workbook(header=["Дата", "Кампания", "Показы", "Клик", "Расходы"]))
+        with pytest.raises(ReportStructureError, match="«Клик» должна называться «Клики»"):
+            validate_excel_structure(str(typo))
+
+class TestReportTasks:
+    """Тесты для фоновой обработки отчетов"""
+    
+    def _create_report(self, db_session, test_user, **kwargs):
+        report = Report(
+            user_id=test_user.id,
+            filename="test.xlsx",
+            original_filename="test.xlsx",
+            file_path="/uploads/test.xlsx",
+            file_size=1024,
+            status="queued",
+            **kwargs
+        )
+        db_session.add(report)
+        db_session.commit()
+        return report
+    
+    @patch('app.services.report_tasks.acquire_user_slot', return_value=True)
+    @patch('app.services.report_tasks.release_user_slot')
+    @patch('app.services.report_tasks.process_report')
+    @patch('app.services.report_tasks.SessionLocal')
+    def test_process_report_task_success(self, mock_session_local, mock_process, mock_release, mock_acquire, test_user, db_session):
+        """Тест успешной обработки отчета воркером"""
+        from app.services.report_tasks import process_report_task
+        
+        async def fake_process(db, report, file_path, user):
+            report.status = 'completed'
+            db.commit()
+        
+        mock_session_local.return_value = db_session
+        mock_process.side_effect = fake_process
+        user_id = test_user.id
+        report_id = self._create_report(db_session, test_user).id
+        
+        process_report_task.apply(args=[report_id])
+        
+        report = db_session.query(Report).filter(Report.id == report_id).first()
+        assert report.status == "completed"
+        assert report.attempts == 1
+        mock_release.assert_called_once_with(user_id)
+    
+    @patch('app.services.report_tasks.acquire_user_slot', return_value=None)
+    @patch('app.services.report_tasks.process_report')
+    @patch('app.services.report_tasks.SessionLocal')
+    def test_process_report_task_dead_letter(self, mock_session_local, mock_process, mock_acquire, test_user, db_session):
+        """Тест перевода отчета в dead letter после исчерпания попыток"""
+        from app.core.config import settings
+        from app.services.report_tasks import process_report_task
+        
+        mock_session_local.return_value = db_session
+        mock_process.side_effect = Exception("Sheets API недоступен")
+        report_id = self._create_report(db_session, test_user, attempts=settings.REPORT_MAX_RETRIES).id
+        
+        process_report_task.apply(args=[report_id])
+        
+        report = db_session.query(Report).filter(Report.id == report_id).first()
+        assert report.status == "dead_letter"
+        assert "Sheets API недоступен" in report.error_message
+    
+    @patch('app.services.report_tasks.acquire_user_slot', return_value=None)
+    @patch('app.services.report_tasks.process_report')
+    @patch('app.services.report_tasks.SessionLocal')
+    def test_process_report_task_permanent_error(self, mock_session_local, mock_process, mock_acquire, test_user, db_session):
+        """Тест неустранимой ошибки: отчет не повторяется"""
+        from app.services.file_processor import ReportProcessingError
+        from app.services.report_tasks import process_report_task
+        
+        mock_session_local.return_value = db_session
+        mock_process.side_effect = ReportProcessingError("Google таблица не подключена")
+        report_id = self._create_report(db_session, test_user).id
+        
+        process_report_task.apply(args=[report_id])
+        
+        report = db_session.query(Report).filter(Report.id == report_id).first()
+        assert report.status == "error"
+        assert report.attempts == 1
+    
+    def test_retry_countdown_is_bounded(self):
+        """Тест ограничения экспоненциальной задержки"""
+        from app.core.config import settings
+        from app.services.report_tasks import retry_countdown
+        
+        assert retry_countdown(1) >= settings.REPORT_RETRY_BACKOFF_BASE
+        assert retry_countdown(50) <= settings.REPORT_RETRY_BACKOFF_MAX * 1.25
+    
+    def test_enqueue_report_publishes_off_event_loop(self, test_user):
+        """Тест: публикация задачи в брокер не выполняется в потоке цикла событий"""
+        import threading
+        from app.services.report_tasks import enqueue_report
+        
+        async def run():
+            async with TestingAsyncSessionLocal() as session:
+                report = Report(
+                    user_id=test_user.id,
+                    filename="test.xlsx",
+                    original_filename="test.xlsx",
+                    file_path="/uploads/test.xlsx",
+                    file_size=1024
+                )
+                session.add(report)
+                await session.commit()
+                await enqueue_report(report, session)
+                return report.status, threading.get_ident()
+        
+        with patch('app.services.report_tasks.process_report_task.apply_async') as mock_apply:
+            publish_thread = []
+            mock_apply.side_effect = lambda *args, **kwargs: publish_thread.append(threading.get_ident())
+            status, loop_thread = asyncio.run(run())
+        
+        assert status == "queued"
+        assert publish_thread and publish_thread[0] != loop_thread
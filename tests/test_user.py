@@ -1,4 +1,5 @@
 import pytest
+from unittest.mock import patch
 from fastapi import status
 
 class TestUserEndpoints:
@@ -92,6 +93,47 @@ class TestUserEndpoints:
         
         assert response.status_code == status.HTTP_401_UNAUTHORIZED
 
+    def test_get_user_reports_keyset_pages(self, authenticated_client, test_user, db_session):
+        """Тест постраничной выдачи отчетов по курсору с фильтром по статусу"""
+        from datetime import datetime, timedelta
+        from tests.factories import ReportFactory
+        ReportFactory._meta.sqlalchemy_session = db_session
+
+        start = datetime(2026, 1, 1, 12, 0, 0)
+        # Два отчета с одинаковым временем: порядок между ними задает id
+        moments = [start, start, start + timedelta(hours=1), start + timedelta(hours=2), start + timedelta(hours=3)]
+        reports = [
+            ReportFactory(user_id=test_user.id, status="completed", created_at=moment)
+            for moment in moments
+        ]
+        ReportFactory(user_id=test_user.id, status="error", created_at=start + timedelta(hours=4))
+        db_session.commit()
+
+        seen = []
+        cursor = None
+        while True:
+            params = {"status": "completed", "limit": 2}
+            if cursor:
+                params["cursor"] = cursor
+            response = authenticated_client.get("/api/user/reports", params=params)
+            assert response.status_code == status.HTTP_200_OK
+            seen.extend(report["id"] for report in response.json())
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+
+        expected = sorted(reports, key=lambda report: (report.created_at, report.id), reverse=True)
+        assert seen == [report.id for report in expected]
+
+        # Без limit и cursor список не обрезается, как до появления страниц
+        with patch('app.api.routes.user.settings.REPORTS_PAGE_SIZE', 2):
+            response = authenticated_client.get("/api/user/reports")
+        assert len(response.json()) == len(reports) + 1
+        assert "X-Next-Cursor" not in response.headers
+
+        response = authenticated_client.get("/api/user/reports", params={"cursor": "not-a-cursor"})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
 class TestUserModels:
     """Тесты для моделей пользователя"""
     
@@ -0,0 +1,429 @@
+import pytest
+import asyncio
+import httpx
+from datetime import date, timedelta
+from unittest.mock import MagicMock, patch
+
+from app.services.vk_client import VKClient
+from app.services.vk_rate_limiter import TokenBucket, VKRateLimiter
+
+@pytest.fixture(autouse=True)
+def fast_rate_limiter():
+    """Планировщик без ограничений, чтобы тесты не ждали квот"""
+    limiter = VKRateLimiter(rates={'default': 1000.0}, burst=1000)
+    with patch('app.services.vk_ads.vk_rate_limiter', limiter):
+        yield limiter
+
+def make_client(handler) -> VKClient:
+    """Клиент VK, отвечающий через тестовый обработчик вместо сети"""
+    return VKClient(
+        timeout=5,
+        max_connections=10,
+        max_keepalive=5,
+        max_concurrency=2,
+        transport=httpx.MockTransport(handler)
+    )
+
+class TestVKClient:
+    """Тесты для общего HTTP клиента VK"""
+    
+    def test_concurrency_is_bounded(self):
+        """Тест ограничения числа одновременных запросов"""
+        active = 0
+        peak = 0
+        
+        async def handler(request):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return httpx.Response(200, json={"response": []})
+        
+        client = make_client(handler)
+        
+        async def run():
+            await asyncio.gather(*(client.get("https://api.vk.com/method/users.get") for _ in range(6)))
+            await client.aclose()
+        
+        asyncio.run(run())
+        assert peak == 2
+    
+    def test_client_is_recreated_for_new_event_loop(self):
+        """Тест пересоздания пула соединений для нового цикла событий"""
+        client = make_client(lambda request: httpx.Response(200, json={}))
+        
+        async def first_client():
+            await client.get("https://api.vk.com/method/users.get")
+            return client._client
+        
+        first = asyncio.run(first_client())
+        second = asyncio.run(first_client())
+        assert first is not second
+
+    def test_previous_client_is_closed_in_its_loop(self):
+        """Тест: клиент живого цикла событий закрывается при переходе в другой цикл"""
+        import threading
+
+        client = make_client(lambda request: httpx.Response(200, json={}))
+
+        async def current_client():
+            await client.get("https://api.vk.com/method/users.get")
+            return client._client
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            first = asyncio.run_coroutine_threadsafe(current_client(), loop).result()
+            asyncio.run(current_client())
+            # Даем циклу первого клиента выполнить закрытие
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.05), loop).result()
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        assert first.is_closed
+
+    def test_run_closing_closes_client(self):
+        """Тест: задача в отдельном цикле событий закрывает клиент перед его завершением"""
+        client = make_client(lambda request: httpx.Response(200, json={}))
+
+        async def fetch():
+            await client.get("https://api.vk.com/method/users.get")
+            return client._client
+
+        used = client.run_closing(fetch())
+        assert used.is_closed
+        assert client._client is None
+
+class TestVKAdsService:
+    """Тесты для сервиса VK Ads"""
+    
+    def test_call_vk_api_error(self):
+        """Тест ошибки VK API: поднимается VKAPIError с кодом ошибки"""
+        from app.services.vk_ads import VKAPIError, call_vk_api
+        
+        handler = lambda request: httpx.Response(200, json={"error": {"error_code": 5}})
+        
+        with patch('app.services.vk_ads.vk_client', make_client(handler)):
+            with pytest.raises(VKAPIError) as exc_info:
+                asyncio.run(call_vk_api('ads.getAccounts', "token"))
+        assert exc_info.value.error_code == 5
+    
+    def test_fetch_account_campaign_list_clients_and_pages(self):
+        """Тест обхода клиентов агентства и страниц кампаний"""
+        from app.services.vk_ads import fetch_account_campaign_list
+        
+        def handler(request):
+            params = request.url.params
+            if request.url.path.endswith('ads.getClients'):
+                return httpx.Response(200, json={"response": [{"id": 21}, {"id": 22}]})
+            if request.url.path.endswith('ads.getCampaigns'):
+                account_id = int(params['account_id'])
+                offset = int(params['offset'])
+                if account_id == 1:
+                    # Две полные страницы и одна неполная
+                    total = 5
+                    ids = range(100 + offset, 100 + min(offset + 2, total))
+                else:
+                    ids = [int(params['client_id']) * 10] if offset == 0 else []
+                return httpx.Response(200, json={"response": [{"id": i, "name": f"c{i}"} for i in ids]})
+            return httpx.Response(200, json={"items": []})
+        
+        with patch('app.services.vk_ads.settings.VK_CAMPAIGNS_PAGE_SIZE', 2), \
+             patch('app.services.vk_ads.vk_client', make_client(handler)):
+            general = asyncio.run(fetch_account_campaign_list("token", {"account_id": 1, "account_type": "general"}))
+            agency = asyncio.run(fetch_account_campaign_list("token", {"account_id": 2, "account_type": "agency"}))
+        
+        assert [camp["id"] for camp in general] == [100, 101, 102, 103, 104]
+        assert sorted(camp["id"] for camp in agency) == [210, 220]
+    
+    def test_campaign_pages_are_fetched_in_parallel(self):
+        """Тест: после первой полной страницы следующие запрашиваются одновременно"""
+        from app.services.vk_ads import _fetch_campaign_pages
+
+        active = 0
+        peak = 0
+
+        async def handler(request):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            offset = int(request.url.params['offset'])
+            ids = range(offset, min(offset + 2, 7))
+            return httpx.Response(200, json={"response": [{"id": i} for i in ids]})
+
+        with patch('app.services.vk_ads.settings.VK_CAMPAIGNS_PAGE_SIZE', 2), \
+             patch('app.services.vk_ads.settings.VK_CAMPAIGNS_PAGES_CONCURRENCY', 2), \
+             patch('app.services.vk_ads.vk_client', make_client(handler)):
+            campaigns = asyncio.run(_fetch_campaign_pages("token", 1))
+
+        assert [camp["id"] for camp in campaigns] == list(range(7))
+        assert peak == 2
+
+class TestVKRateLimiter:
+    """Тесты для планировщика запросов VK"""
+    
+    def test_token_bucket_queues_excess_requests(self):
+        """Тест: запросы сверх запаса ждут пропорционально скорости"""
+        bucket = TokenBucket(rate=10.0, burst=2)
+        waits = [bucket.reserve() for _ in range(4)]
+        assert waits[0] == 0 and waits[1] == 0
+        assert waits[2] == pytest.approx(0.1, abs=0.02)
+        assert waits[3] == pytest.approx(0.2, abs=0.02)
+    
+    def test_buckets_are_per_token_and_method_class(self):
+        """Тест: квоты разных токенов и классов методов независимы"""
+        limiter = VKRateLimiter(rates={'default': 1.0, 'ads': 1.0, 'stats': 1.0}, burst=1)
+        assert limiter._bucket("a", "ads").reserve() == 0
+        assert limiter._bucket("b", "ads").reserve() == 0
+        assert limiter._bucket("a", "stats").reserve() == 0
+        assert limiter._bucket("a", "ads").reserve() > 0
+    
+    def test_shared_buckets_are_used_when_redis_is_available(self):
+        """Тест: с Redis квота резервируется в общем ведре, а не в ведре процесса"""
+        redis_client = MagicMock()
+        redis_client.eval.return_value = b"0.000000"
+        limiter = VKRateLimiter(rates={'default': 1.0, 'ads': 2.0}, burst=3, redis_client=lambda: redis_client)
+        
+        asyncio.run(limiter.acquire("token", "ads.getAccounts"))
+        
+        script, numkeys, key, interval, burst = redis_client.eval.call_args.args
+        assert key.startswith("adstat:vk:quota:") and key.endswith(":ads")
+        assert "token" not in key
+        assert (numkeys, interval, burst) == (1, 0.5, 3)
+        assert limiter.snapshot()["buckets"] == 0
+    
+    def test_local_buckets_are_used_when_redis_fails(self):
+        """Тест: без Redis планировщик работает с ведрами процесса и не обращается к Redis на каждый запрос"""
+        import redis
+        
+        redis_client = MagicMock()
+        redis_client.eval.side_effect = redis.ConnectionError("Connection refused")
+        limiter = VKRateLimiter(rates={'default': 1000.0}, burst=10, redis_client=lambda: redis_client)
+        
+        asyncio.run(limiter.acquire("token", "ads.getAccounts"))
+        asyncio.run(limiter.acquire("token", "ads.getAccounts"))
+        
+        assert redis_client.eval.call_count == 1
+        assert limiter.snapshot()["buckets"] == 1
+    
+    def test_throttled_request_is_retried(self, fast_rate_limiter):
+        """Тест: ошибка превышения лимита приводит к паузе и повтору, а не к пустому списку"""
+        from app.services.vk_ads import call_vk_api
+        
+        calls = 0
+        
+        def handler(request):
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                return httpx.Response(200, json={"error": {"error_code": 6}})
+            return httpx.Response(200, json={"response": [{"account_id": 1}]})
+        
+        with patch('app.services.vk_ads.vk_client', make_client(handler)), \
+             patch('app.services.vk_rate_limiter.settings.VK_RATE_LIMIT_BACKOFF_BASE', 0.01):
+            result = asyncio.run(call_vk_api('ads.getAccounts', "token"))
+        
+        assert result == [{"account_id": 1}]
+        assert calls == 2
+        assert fast_rate_limiter.snapshot()["throttled_total"] == {"ads": 1}
+
+class TestVKStatsSync:
+    """Тесты для локального хранилища статистики VK"""
+    
+    @staticmethod
+    def make_handler(requested_periods):
+        def handler(request):
+            params = request.url.params
+            if request.url.path.endswith('ads.getAccounts'):
+                return httpx.Response(200, json={"response": [{"account_id": 1}]})
+            if request.url.path.endswith('ads.getCampaigns'):
+                return httpx.Response(200, json={"response": [{"id": 10, "name": "Весна", "status": 1}]})
+            requested_periods.append((params['date_from'], params['date_to']))
+            date_to = date.fromisoformat(params['date_to'])
+            return httpx.Response(200, json={"items": [{"id": 10, "rows": [
+                {"date": (date_to - timedelta(days=1)).isoformat(), "shows": 100, "clicks": 5, "spent": 50},
+                {"date": date_to.isoformat(), "shows": 200, "clicks": 10, "spent": 30}
+            ]}]})
+        return handler
+    
+    def test_sync_is_incremental(self, db_session, test_user):
+        """Тест: повторная синхронизация загружает только дни начиная с водяного знака"""
+        from app.models.vk_stats import VKAdAccount, VKCampaignStat
+        from app.services.vk_stats_sync import sync_user_vk_stats, get_local_vk_campaigns
+        
+        test_user.vk_access_token = "token"
+        periods = []
+        
+        with patch('app.services.vk_ads.vk_client', make_client(self.make_handler(periods))):
+            assert asyncio.run(sync_user_vk_stats(db_session, test_user)) == 2
+            # Второй раз загружается только день водяного знака
+            assert asyncio.run(sync_user_vk_stats(db_session, test_user)) == 1
+        
+        account = db_session.query(VKAdAccount).filter(VKAdAccount.user_id == test_user.id).one()
+        watermark = account.stats_synced_through.isoformat()
+        assert periods[0][0] < watermark
+        assert periods[1] == (watermark, watermark)
+        # Перезагруженный период не дублирует строки
+        assert db_session.query(VKCampaignStat).filter(VKCampaignStat.account_id == 1).count() == 2
+        
+        campaigns = get_local_vk_campaigns(db_session, test_user.id)
+        assert len(campaigns) == 1
+        assert campaigns[0].report_to == watermark
+        assert campaigns[0].impressions == 200
+        assert campaigns[0].cpc == 3.0
+        assert campaigns[0].ctr == 5.0
+    
+    def test_failing_account_does_not_hide_others(self, db_session, test_user):
+        """Тест: ошибка одного аккаунта не мешает синхронизировать остальные"""
+        from app.services.vk_stats_sync import sync_user_vk_stats, get_local_vk_campaigns
+        
+        def handler(request):
+            params = request.url.params
+            if request.url.path.endswith('ads.getAccounts'):
+                return httpx.Response(200, json={"response": [{"account_id": 1}, {"account_id": 2}]})
+            if request.url.path.endswith('ads.getCampaigns'):
+                if params['account_id'] == '1':
+                    return httpx.Response(200, json={"error": {"error_code": 600}})
+                return httpx.Response(200, json={"response": [{"id": 20}]})
+            return httpx.Response(200, json={"items": []})
+        
+        test_user.vk_access_token = "token"
+        with patch('app.services.vk_ads.vk_client', make_client(handler)):
+            asyncio.run(sync_user_vk_stats(db_session, test_user))
+        
+        assert [camp.id for camp in get_local_vk_campaigns(db_session, test_user.id)] == [20]
+    
+    def _two_accounts_handler(self, request):
+        if request.url.path.endswith('ads.getAccounts'):
+            return httpx.Response(200, json={"response": [{"account_id": 1}, {"account_id": 2}]})
+        if request.url.path.endswith('ads.getCampaigns'):
+            return httpx.Response(200, json={"response": [{"id": int(request.url.params['account_id']) * 10}]})
+        return httpx.Response(200, json={"items": []})
+    
+    def test_store_error_does_not_abort_other_accounts(self, db_session, test_user):
+        """Тест: ошибка записи одного аккаунта откатывается и не мешает записать остальные"""
+        from app.services import vk_stats_sync
+        
+        store_account = vk_stats_sync._store_account
+        
+        def flaky_store(db, state, *args):
+            if state.account_id == 1:
+                raise RuntimeError("duplicate key")
+            return store_account(db, state, *args)
+        
+        test_user.vk_access_token = "token"
+        with patch('app.services.vk_ads.vk_client', make_client(self._two_accounts_handler)), \
+             patch.object(vk_stats_sync, '_store_account', side_effect=flaky_store):
+            asyncio.run(vk_stats_sync.sync_user_vk_stats(db_session, test_user))
+        
+        assert [camp.id for camp in vk_stats_sync.get_local_vk_campaigns(db_session, test_user.id)] == [20]
+    
+    def test_account_locked_by_another_sync_is_skipped(self, db_session, test_user):
+        """Тест: аккаунт, который записывает другая синхронизация, пропускается"""
+        from app.services import vk_stats_sync
+        
+        test_user.vk_access_token = "token"
+        with patch('app.services.vk_ads.vk_client', make_client(self._two_accounts_handler)), \
+             patch.object(vk_stats_sync, 'acquire_account_lock', side_effect=lambda account_id: account_id != 1), \
+             patch.object(vk_stats_sync, 'release_account_lock') as release:
+            asyncio.run(vk_stats_sync.sync_user_vk_stats(db_session, test_user))
+        
+        assert [camp.id for camp in vk_stats_sync.get_local_vk_campaigns(db_session, test_user.id)] == [20]
+        release.assert_called_once_with(2)
+    
+    def test_periodic_sync_uses_user_lock(self, db_session, test_user):
+        """Тест: синхронизация по расписанию не ставит задачу, пока синхронизация пользователя идет"""
+        from app.services import vk_stats_sync
+        
+        test_user.vk_access_token = "token"
+        db_session.commit()
+        user_id = test_user.id
+        redis_client = MagicMock()
+        redis_client.set.return_value = None
+        
+        with patch.object(vk_stats_sync, 'SessionLocal', return_value=db_session), \
+             patch.object(vk_stats_sync, 'get_redis', return_value=redis_client), \
+             patch.object(vk_stats_sync.sync_vk_stats_task, 'delay') as delay:
+            vk_stats_sync.sync_all_vk_stats_task()
+        
+        redis_client.set.assert_called_once()
+        assert redis_client.set.call_args.args[0] == f"adstat:vk:sync:{user_id}"
+        delay.assert_not_called()
+    
+    def test_endpoint_reads_local_storage(self, authenticated_client, db_session, test_user):
+        """Тест: первая загрузка уходит в фон, при актуальных данных эндпоинт не обращается к VK"""
+        from app.services.vk_stats_sync import sync_user_vk_stats
+        
+        test_user.vk_access_token = "token"
+        db_session.commit()
+        
+        with patch('app.services.vk_ads.vk_client', make_client(lambda request: httpx.Response(500))), \
+             patch('app.api.routes.auth.schedule_vk_stats_sync') as schedule:
+            first = authenticated_client.get("/api/auth/vk_ads/campaigns")
+        
+        assert first.json() == {"campaigns": [], "synced_at": None, "sync_pending": True}
+        schedule.assert_called_once_with(test_user.id)
+        
+        # Фоновая синхронизация
+        with patch('app.services.vk_ads.vk_client', make_client(self.make_handler([]))):
+            asyncio.run(sync_user_vk_stats(db_session, test_user))
+        
+        with patch('app.services.vk_ads.vk_client', make_client(lambda request: httpx.Response(500))), \
+             patch('app.api.routes.auth.schedule_vk_stats_sync') as schedule:
+            second = authenticated_client.get("/api/auth/vk_ads/campaigns")
+        
+        assert second.status_code == 200
+        assert second.json()["sync_pending"] is False
+        assert second.json()["campaigns"][0]["clicks"] == 10
+        schedule.assert_not_called()
+
+class TestVKStatsQuery:
+    """Тесты для агрегации статистики VK за период"""
+    
+    @pytest.fixture
+    def stats(self, db_session, test_user):
+        from app.models.vk_stats import VKAdAccount, VKCampaignStat
+        
+        db_session.add(VKAdAccount(user_id=test_user.id, account_id=1))
+        # Чужой аккаунт не должен попадать в выборку
+        db_session.add(VKCampaignStat(account_id=2, campaign_id=99, date=date(2026, 10, 5), impressions=1, clicks=1, spent=1))
+        for day, impressions, clicks, spent in [(5, 100, 4, 20), (6, 300, 6, 40), (13, 200, 0, 0)]:
+            db_session.add(VKCampaignStat(account_id=1, campaign_id=10, date=date(2026, 10, day),
+                                          impressions=impressions, clicks=clicks, spent=spent))
+        db_session.add(VKCampaignStat(account_id=1, campaign_id=11, date=date(2026, 10, 5), impressions=50, clicks=5, spent=5))
+        db_session.commit()
+    
+    def test_weekly_aggregation(self, db_session, test_user, stats):
+        """Тест: суммы по неделям, CTR и CPC считаются по агрегатам"""
+        from app.services.vk_stats_query import aggregate_vk_stats
+        
+        result = aggregate_vk_stats(db_session, test_user.id, date(2026, 10, 1), date(2026, 10, 31), 'week', [10])
+        
+        assert result["items"] == [
+            {"account_id": 1, "campaign_id": 10, "period": "2026-10-05", "impressions": 400, "clicks": 10,
+             "spent": 60.0, "ctr": 2.5, "cpc": 6.0},
+            {"account_id": 1, "campaign_id": 10, "period": "2026-10-12", "impressions": 200, "clicks": 0,
+             "spent": 0.0, "ctr": 0.0, "cpc": 0.0},
+        ]
+        assert result["totals"]["impressions"] == 600
+    
+    def test_stats_endpoint(self, authenticated_client, stats):
+        """Тест эндпоинта статистики с помесячной агрегацией"""
+        response = authenticated_client.get("/api/auth/vk_ads/stats", params={
+            "date_from": "2026-10-01", "date_to": "2026-10-31", "granularity": "month"
+        })
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert [(item["campaign_id"], item["period"]) for item in data["items"]] == [(10, "2026-10-01"), (11, "2026-10-01")]
+        assert data["totals"] == {"impressions": 650, "clicks": 15, "spent": 65.0, "ctr": 2.31, "cpc": 4.33}
+    
+    def test_stats_endpoint_rejects_bad_granularity(self, authenticated_client):
+        """Тест проверки параметра детализации"""
+        response = authenticated_client.get("/api/auth/vk_ads/stats", params={"granularity": "year"})
+        assert response.status_code == 400